@@ -1,16 +1,30 @@
 import setuptools
 import distutils.command.build
-from distutils.errors import DistutilsSetupError
+from distutils.errors import DistutilsError, DistutilsExecError, \
+     DistutilsSetupError
+import distutils.log
 import distutils.sysconfig
 import distutils.spawn
+import distutils.util
+import distutils.version
+import contextlib
+import errno
+import glob
 import hashlib
+import json
+import multiprocessing
 import os
+import Queue
 import re
 import shutil
 import StringIO
+import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
+import time
+import urllib
 import urllib2
 import urlparse
 import zipfile
@@ -40,16 +54,898 @@ else:
     lib_ext = "so"
     dll_ext = "so"
     toolset = None
+
+def order_steps(steps, dependencies):
+    '''Order steps so that each one comes after the steps it depends on
+
+    steps - the step names, in their preferred order
+    dependencies - a dictionary of step name to the names of the steps
+                   that have to finish first. Names that are not in steps
+                   are ignored.
+
+    Returns the steps in dependency order, keeping the preferred order
+    where the dependencies allow.
+    '''
+    remaining = list(steps)
+    done = set()
+    result = []
+    while remaining:
+        for step in remaining:
+            if all([d in done or d not in steps
+                    for d in dependencies.get(step, ())]):
+                break
+        else:
+            raise DistutilsSetupError(
+                "Circular dependency between build steps: " +
+                ", ".join(remaining))
+        remaining.remove(step)
+        done.add(step)
+        result.append(step)
+    return result
+
+def estimate_schedule(steps, dependencies, durations, workers):
+    '''Estimate how long the steps take when scheduled like run_step_graph
+    
+    steps - the step names, in their preferred order
+    dependencies - a dictionary of step name to the names of the steps
+                   that have to finish first
+    durations - a dictionary of step name to its expected seconds
+    workers - the number of steps that can run at the same time
+    
+    Returns the expected wall time and the critical path: the chain of
+    dependent steps with the longest total time.
+    '''
+    steps = order_steps(steps, dependencies)
+    def step_dependencies(step):
+        return [d for d in dependencies.get(step, ()) if d in steps]
+    #
+    # The critical path, if there were enough workers for every step
+    #
+    finish = {}
+    for step in steps:
+        finish[step] = durations.get(step, 0) + max(
+            [finish[d] for d in step_dependencies(step)] + [0])
+    critical_path = []
+    step = max(steps, key=lambda s: finish[s]) if steps else None
+    while step is not None:
+        critical_path.insert(0, step)
+        previous = step_dependencies(step)
+        step = max(previous, key=lambda s: finish[s]) if previous else None
+    #
+    # The wall time with the given number of workers
+    #
+    now = 0
+    running = []
+    done = {}
+    pending = list(steps)
+    while pending or running:
+        ready = [step for step in pending
+                 if all([d in done for d in step_dependencies(step)])]
+        while ready and len(running) < max(workers, 1):
+            step = ready.pop(0)
+            pending.remove(step)
+            running.append((now + durations.get(step, 0), step))
+        running.sort()
+        now, step = running.pop(0)
+        done[step] = now
+    return now, critical_path
+
+def run_step_graph(steps, dependencies, run_step, workers):
+    '''Run steps on a pool of worker threads, respecting their dependencies
+
+    steps - the step names, in their preferred order
+    dependencies - a dictionary of step name to the names of the steps
+                   that have to finish first
+    run_step - a callable that runs one step, given its name
+    workers - the maximum number of steps to run at the same time
+
+    A step is started as soon as all of its dependencies have finished.
+    If a step fails, no new steps are started and the first failure is
+    re-raised once the running steps have finished.
+    '''
+    pending = order_steps(steps, dependencies)
+    if workers <= 1:
+        for step in pending:
+            run_step(step)
+        return
+    done = set()
+    errors = []
+    condition = threading.Condition()
+
+    def is_ready(step):
+        return all([d in done or d not in steps
+                    for d in dependencies.get(step, ())])
+
+    def worker():
+        while True:
+            with condition:
+                while True:
+                    if errors or not pending:
+                        return
+                    ready = filter(is_ready, pending)
+                    if len(ready) > 0:
+                        step = ready[0]
+                        pending.remove(step)
+                        break
+                    condition.wait()
+            try:
+                run_step(step)
+            except BaseException:
+                with condition:
+                    errors.append(sys.exc_info())
+                    condition.notify_all()
+                return
+            with condition:
+                done.add(step)
+                condition.notify_all()
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(workers, len(pending)))]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+    except KeyboardInterrupt:
+        with condition:
+            errors.insert(0, sys.exc_info())
+        raise
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+
+def get_available_memory():
+    '''Bytes of memory new processes can use without swapping or None
+
+    This is MemAvailable on Linux and the available physical memory on
+    Windows. Elsewhere it isn't known.
+    '''
+    if is_win:
+        import ctypes
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [("dwLength", ctypes.c_ulong),
+                        ("dwMemoryLoad", ctypes.c_ulong)] + [
+                (name, ctypes.c_ulonglong) for name in (
+                    "ullTotalPhys", "ullAvailPhys", "ullTotalPageFile",
+                    "ullAvailPageFile", "ullTotalVirtual", "ullAvailVirtual",
+                    "ullAvailExtendedVirtual")]
+        status = MemoryStatus()
+        status.dwLength = ctypes.sizeof(MemoryStatus)
+        if not ctypes.windll.kernel32.GlobalMemoryStatusEx(
+            ctypes.byref(status)):
+            return None
+        return status.ullAvailPhys
+    try:
+        with open("/proc/meminfo", "r") as fd:
+            meminfo = dict([(line.split(":")[0], int(line.split()[1]) * 1024)
+                            for line in fd if line.strip().endswith("kB")])
+    except (IOError, ValueError, IndexError):
+        return None
+    if "MemAvailable" in meminfo:
+        return meminfo["MemAvailable"]
+    # Kernels before 3.14 don't estimate it
+    if "MemFree" in meminfo:
+        return meminfo["MemFree"] + meminfo.get("Cached", 0)
+    return None
+
+class MemoryGovernor(object):
+    '''Share the host's memory between the compile jobs of running steps
+    
+    A step asks for its jobs before it compiles and gives them back when
+    it is done. It gets as many as fit in the available memory, less a
+    reserve and less the part of the other steps' grants that they
+    aren't using yet. The available memory is read again for every
+    grant, so the grants follow what the running steps really use, not
+    what they were granted. If not even one job fits while other steps
+    hold grants, the step waits until one of them finishes or memory
+    frees up. A step always gets at least one job.
+    
+    grants - (step name, bytes granted, bytes available when granted)
+             for each running step, oldest first
+    '''
+    reserve = 512 * 1024 * 1024
+    poll_interval = 2.0
+    
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.grants = []
+    
+    def get_unused(self, available):
+        '''Bytes of the running steps' grants that aren't in use yet
+        
+        The steps granted since a grant can be using no more than the
+        available memory has dropped since then. Counting back from the
+        newest grant, the most that some of the steps can't be using yet
+        is what is still to come.
+        '''
+        unused = 0
+        granted = 0
+        for step_name, nbytes, granted_available in reversed(self.grants):
+            granted += nbytes
+            in_use = max(0, granted_available - available)
+            unused = max(unused, granted - in_use)
+        return unused
+        
+    def acquire(self, step_name, jobs, memory_per_job):
+        '''Wait for memory, then grant a step up to jobs compile jobs
+        
+        Returns the number of jobs granted and the bytes that were
+        available, or None if that isn't known.
+        '''
+        with self.condition:
+            while True:
+                available = get_available_memory()
+                if available is None:
+                    grant = jobs
+                    break
+                usable = available - self.reserve - self.get_unused(available)
+                if usable >= memory_per_job or len(self.grants) == 0:
+                    grant = max(1, min(jobs, int(usable // memory_per_job)))
+                    break
+                self.condition.wait(self.poll_interval)
+            self.grants.append(
+                (step_name, grant * memory_per_job, available))
+            return grant, available
+    
+    def release(self, step_name):
+        with self.condition:
+            self.grants = [grant for grant in self.grants
+                           if grant[0] != step_name]
+            self.condition.notify_all()
+            
+memory_governor = MemoryGovernor()
+
+class BuildStep(setuptools.Command, object):
+    '''Base class for the steps run by the build command
+
+    A step depends on every command whose options it borrows through
+    set_undefined_options: that command has to finish before this one
+    can run. Steps can run concurrently, so they must not change the
+    current directory. Use spawn's cwd argument instead.
+    
+    Steps keep figures for the build report:
+    
+    cpu_time - seconds of CPU time used by the processes the step spawned
+    peak_rss - the largest resident set size in bytes of those processes
+    bytes_written - bytes the step wrote: unpacked files, restored artifacts
+                    and how much a build step's outputs and intermediate
+                    trees grew
+    phase_times - (phase name, seconds) for each phase the step ran
+    
+    CPU time and peak RSS are only known on systems with wait4, which
+    leaves out Windows.
+    '''
+    def __init__(self, dist):
+        self.depends_on = []
+        self.cpu_time = 0.0
+        self.peak_rss = 0
+        self.bytes_written = 0
+        self.phase_times = []
+        setuptools.Command.__init__(self, dist)
+
+    def get_step_name(self):
+        '''The name the command is registered under, e.g. "build_zlib"'''
+        for key, value in self.distribution.command_obj.iteritems():
+            if value is self:
+                return key
+        return self.get_command_name()
+    
+    def add_dependency(self, command):
+        '''Record that the named command must run before this one'''
+        if command not in self.depends_on:
+            self.depends_on.append(command)
+
+    def set_undefined_options(self, src_cmd, *option_pairs):
+        self.add_dependency(src_cmd)
+        setuptools.Command.set_undefined_options(
+            self, src_cmd, *option_pairs)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''Time a phase of the step, e.g. "configure" or "compile"'''
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.phase_times.append((name, time.time() - start_time))
+    
+    def get_report(self):
+        '''The step's figures for the build report'''
+        return dict(skipped=getattr(self, "skipped", False),
+                    restored=getattr(self, "restored", False),
+                    cpu_time=self.cpu_time,
+                    peak_rss=self.peak_rss,
+                    bytes_downloaded=getattr(self, "bytes_downloaded", 0),
+                    decompressed_with=getattr(self, "decompressed_with", None),
+                    jobs=getattr(self, "granted_jobs", None),
+                    bytes_written=self.bytes_written,
+                    phases=self.phase_times)
+
+    def spawn(self, cmd, search_path=1, level=1, cwd=None, env=None):
+        '''Run a command, optionally in another directory
+
+        cmd - the command and its arguments
+        cwd - the directory to run the command in
+        env - environment variables to add to the current environment
+        '''
+        self.announce(" ".join(cmd), 2)
+        if self.dry_run:
+            return
+        if is_win:
+            args = " ".join(distutils.spawn._nt_quote_args(list(cmd)))
+        else:
+            args = list(cmd)
+        if env is not None:
+            env = dict(os.environ, **env)
+        try:
+            process = subprocess.Popen(args, cwd=cwd, env=env)
+        except OSError as e:
+            raise DistutilsExecError(
+                "command %r failed: %s" % (cmd[0], e.args[-1]))
+        returncode = self.wait(process)
+        if returncode != 0:
+            raise DistutilsExecError(
+                "command %r failed with exit status %d" %
+                (cmd[0], returncode))
+    
+    def wait(self, process):
+        '''Wait for a spawned process and add its resource usage
+        
+        Returns the process's exit status.
+        '''
+        if not hasattr(os, "wait4"):
+            return process.wait()
+        while True:
+            try:
+                pid, status, usage = os.wait4(process.pid, 0)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        self.cpu_time += usage.ru_utime + usage.ru_stime
+        # ru_maxrss is in bytes on OS X and in kilobytes elsewhere
+        if sys.platform == "darwin":
+            peak_rss = usage.ru_maxrss
+        else:
+            peak_rss = usage.ru_maxrss * 1024
+        self.peak_rss = max(self.peak_rss, peak_rss)
+        return process.returncode
+    
+    def find_wheel(self, key):
+        '''The path to the cached wheel with the key or None
+        
+        The step must have a wheel_cache attribute with the directory of
+        the wheel cache or None.
+        '''
+        if self.wheel_cache is None or key is None:
+            return None
+        wheel = WheelCache(self.wheel_cache).find(key)
+        if wheel is not None:
+            self.announce("Using cached wheel " + wheel, 2)
+        return wheel
+    
+    def make_wheel(self, source_dir, setup_args, dist_dir, key, env=None,
+                   skip_build=False):
+        '''Build a package's wheel and put it in the wheel cache
+        
+        source_dir - the directory with the package's setup.py
+        setup_args - setup.py arguments to go before bdist_wheel
+        dist_dir - the directory to build the wheel in, which is emptied
+        key - the wheel's key in the cache or None not to cache it
+        env - environment variables to add for setup.py
+        skip_build - True to package what setup.py has already built
+        
+        setup.py is run through setuptools, so that packages that use
+        plain distutils have bdist_wheel. Returns the wheel's path.
+        '''
+        self.check_wheel_package()
+        dist_dir = os.path.abspath(dist_dir)
+        if os.path.isdir(dist_dir):
+            shutil.rmtree(dist_dir)
+        wheel_args = ["bdist_wheel", "--dist-dir", dist_dir]
+        if skip_build:
+            wheel_args.append("--skip-build")
+        self.spawn(["python", "-c", setuptools_shim] + setup_args + wheel_args,
+                   cwd=os.path.abspath(source_dir), env=env)
+        if self.dry_run:
+            return os.path.join(dist_dir, "package.whl")
+        wheels = [filename for filename in os.listdir(dist_dir)
+                  if filename.endswith(".whl")]
+        if len(wheels) != 1:
+            raise DistutilsError("Expected one wheel in %s, found %d" %
+                                 (dist_dir, len(wheels)))
+        wheel = os.path.join(dist_dir, wheels[0])
+        if self.wheel_cache is not None and key is not None:
+            wheel = WheelCache(self.wheel_cache).store(key, wheel)
+        return wheel
+    
+    def check_wheel_package(self):
+        '''Raise a DistutilsError if Python can't make wheels
+        
+        bdist_wheel comes from the wheel package, which older setuptools
+        installs don't have.
+        '''
+        if self.dry_run or has_wheel_package():
+            return
+        raise DistutilsError(
+            "%s needs the wheel package to build wheels, install it with "
+            "\"python -m pip install wheel\"" % self.get_step_name())
+    
+    def install_wheel(self, wheel):
+        '''Install a wheel with pip, replacing any installed version'''
+        self.spawn(["python", "-m", "pip", "install", "--no-deps",
+                    "--no-index", "--force-reinstall", wheel])
+
+def has_wheel_package():
+    '''Whether the python that builds the packages can import wheel'''
+    if not hasattr(has_wheel_package, "result"):
+        with open(os.devnull, "w") as devnull:
+            try:
+                has_wheel_package.result = subprocess.call(
+                    ["python", "-c", "import wheel"],
+                    stdout=devnull, stderr=devnull) == 0
+            except OSError:
+                has_wheel_package.result = False
+    return has_wheel_package.result
+
+def source_digest(path):
+    '''Digest the names and contents of the files of a Python source tree
+    
+    Unlike tree_digest, this doesn't depend on modification times, so the
+    same source unpacked anywhere has the same digest. What setup.py
+    writes into the tree is left out: the build and dist directories,
+    egg-info directories and compiled Python files.
+    '''
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        if root == path:
+            dirs[:] = [d for d in dirs if d not in ("build", "dist")]
+        dirs[:] = sorted([d for d in dirs if not d.endswith(".egg-info")])
+        for filename in sorted(files):
+            if os.path.splitext(filename)[1] in (".pyc", ".pyo"):
+                continue
+            file_path = os.path.join(root, filename)
+            relpath = os.path.relpath(file_path, path).replace(os.sep, "/")
+            h.update(relpath + "\0")
+            if os.path.islink(file_path):
+                h.update("link\0" + os.readlink(file_path))
+            else:
+                with open(file_path, "rb") as fd:
+                    for chunk in iter(lambda: fd.read(1024 * 1024), ""):
+                        h.update(chunk)
+            h.update("\n")
+    return h.hexdigest()
+
+def tree_digest(path, exclude=()):
+    '''Digest the names, sizes and modification times of files under path
+    
+    path - the top of the tree
+    exclude - file names to leave out, wherever they are in the tree
+    '''
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename in exclude:
+                continue
+            file_path = os.path.join(root, filename)
+            stat = os.lstat(file_path)
+            relpath = os.path.relpath(file_path, path).replace(os.sep, "/")
+            h.update("%s\0%d\0%d\n" % (
+                relpath, stat.st_size, int(stat.st_mtime)))
+    return h.hexdigest()
+
+def tree_size(paths):
+    '''The total size in bytes of the files under the paths'''
+    size = 0
+    for path in set([os.path.abspath(path) for path in paths]):
+        if os.path.isfile(path):
+            size += os.path.getsize(path)
+        for root, dirs, files in os.walk(path):
+            for filename in files:
+                size += os.lstat(os.path.join(root, filename)).st_size
+    return size
+
+def get_compiler_identity():
+    '''A string that identifies the C and C++ compilers that builds use'''
+    if not hasattr(get_compiler_identity, "identity"):
+        if is_win:
+            identity = "msvc %s" % build_version
+        else:
+            identity = []
+            for variable, default in (("CC", "cc"), ("CXX", "c++")):
+                compiler = os.environ.get(variable, default)
+                try:
+                    version = subprocess.Popen(
+                        compiler.split() + ["--version"],
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT).communicate()[0]
+                except OSError:
+                    version = ""
+                identity.append(
+                    "%s: %s" % (compiler, version.strip().split("\n")[0]))
+            identity = ", ".join(identity)
+        get_compiler_identity.identity = identity
+    return get_compiler_identity.identity
+
+def compiler_cache_env(compiler_cache, compiler_cache_dir):
+    '''Environment variables that point a compiler cache at its directory
+    
+    compiler_cache - the path to ccache or sccache or None
+    compiler_cache_dir - the cache directory or None for the tool's default
+    '''
+    if compiler_cache is None or compiler_cache_dir is None:
+        return {}
+    name = os.path.basename(compiler_cache).lower()
+    if name.startswith("sccache"):
+        return dict(SCCACHE_DIR=os.path.abspath(compiler_cache_dir))
+    return dict(CCACHE_DIR=os.path.abspath(compiler_cache_dir))
+
+def parse_compiler_cache_stats(output):
+    '''The counters in the output of ccache or sccache --show-stats
+    
+    Returns a list of (name, count). Counters nested under a heading, as
+    in ccache 4's output, are named "heading / counter". Lines that
+    aren't a name followed by a whole number, e.g. cache sizes and hit
+    rates, are left out.
+    '''
+    stats = []
+    parents = []
+    for line in output.splitlines():
+        text = line.strip()
+        if len(text) == 0:
+            continue
+        indent = len(line) - len(line.lstrip())
+        while len(parents) > 0 and parents[-1][0] >= indent:
+            parents.pop()
+        match = re.match(r"(.+?):?(?:\t|\s{2,})(\d+)(\s+/.*)?$", text)
+        label = (text if match is None else match.group(1)).rstrip(":")
+        if match is not None and "timestamp" not in label:
+            name = " / ".join([parent for _, parent in parents] + [label])
+            stats.append((name, int(match.group(2))))
+        parents.append((indent, label))
+    return stats
+
+def get_python_abi():
+    '''A string that identifies the ABI of extensions for this Python'''
+    return "%s-%d.%d-%s" % (
+        distutils.util.get_platform(), sys.version_info[0],
+        sys.version_info[1], "ucs4" if sys.maxunicode > 0xffff else "ucs2")
+
+class StampedStep(BuildStep):
+    '''A build step that is skipped if nothing about it has changed
+    
+    Subclasses implement run_step to do the work and extend
+    get_stamp_inputs with everything that affects the result. After the
+    step succeeds, a digest of the inputs is written to a stamp file under
+    build_lib. The next run skips the step if the digest still matches,
+    unless build --force is given.
+    
+    The inputs are digested after the step runs, so that files the step
+    writes into its own source tree don't count as changes next time.
+    
+    compiler_cache - ccache or sccache to compile through or None. Steps
+                     pass it to their build system in their own way. The
+                     compiler cache doesn't change what gets built, so it
+                     is not a stamp input.
+    compiler_cache_dir - the directory the compiler cache keeps its objects
+                         in or None for the tool's default
+    artifact_cache - the directory or URL of the artifact cache or None.
+                     Steps whose class sets artifact_cacheable pack their
+                     outputs into the artifact cache after they run, and
+                     restore them from it instead of running if an earlier
+                     build, maybe in another checkout, had the same
+                     artifact inputs. Only the outputs are restored, so
+                     later steps must not use a cacheable step's
+                     intermediate trees.
+    scratch_dir - the directory for intermediate build trees or None to
+                  keep them next to the sources. The build removes a step's
+                  intermediate trees from the scratch directory once it has
+                  finished.
+    memory_per_job - the bytes one of the step's compile jobs can use or
+                     None if the step doesn't run parallel jobs. The build
+                     replaces the class's guess with the peak RSS recorded
+                     the last time the step ran. Steps that set it have a
+                     jobs attribute and run get_jobs() jobs, which the
+                     memory_governor grants just before run_step.
+    installs_python_packages - True for steps that install into the
+                               interpreter's site-packages. The
+                               site-packages directory is then a stamp
+                               input, so each virtualenv gets its own
+                               install.
+    '''
+    artifact_cacheable = False
+    memory_per_job = None
+    installs_python_packages = False
+    
+    def initialize_options(self):
+        self.build_lib = None
+        self.force = None
+        self.stamp_file = None
+        self.skipped = False
+        self.restored = False
+        self.compiler_cache = None
+        self.compiler_cache_dir = None
+        self.artifact_cache = None
+        self.scratch_dir = None
+        self.granted_jobs = None
+        
+    def finalize_options(self):
+        self.set_undefined_options(
+            'build', ('build_lib', 'build_lib'), ('force', 'force'),
+            ('compiler_cache', 'compiler_cache'),
+            ('compiler_cache_dir', 'compiler_cache_dir'),
+            ('artifact_cache', 'artifact_cache'),
+            ('scratch_dir', 'scratch_dir'))
+        if self.stamp_file is None:
+            self.stamp_file = os.path.join(
+                self.build_lib, "stamps", self.get_step_name() + ".json")
+    
+    def run(self):
+        if self.is_up_to_date():
+            self.announce("skipping %s (up to date)" %
+                          self.get_step_name(), 2)
+            self.skipped = True
+            return
+        if self.dry_run:
+            self.run_step()
+            return
+        with self.phase("restore artifact"):
+            self.restored = self.restore_artifact()
+        if not self.restored:
+            written_paths = self.get_outputs() + self.get_intermediate_dirs()
+            size_before = tree_size(written_paths)
+            if self.memory_per_job is None:
+                self.run_step()
+            else:
+                self.run_step_with_memory_limit()
+            self.bytes_written += max(
+                0, tree_size(written_paths) - size_before)
+        self.write_stamp()
+        if not self.restored:
+            with self.phase("store artifact"):
+                self.store_artifact()
+        
+    def run_step(self):
+        raise NotImplementedError()
+    
+    def run_step_with_memory_limit(self):
+        '''Run the step with as many jobs as the memory governor grants'''
+        with self.phase("wait for memory"):
+            self.granted_jobs, available = memory_governor.acquire(
+                self.get_step_name(), self.jobs, self.memory_per_job)
+        try:
+            if self.granted_jobs < self.jobs:
+                self.announce(
+                    "%s: running %d of %d jobs, %.0f MB available and "
+                    "%.0f MB a job" % (self.get_step_name(), self.granted_jobs,
+                                       self.jobs, available / 1e6,
+                                       self.memory_per_job / 1e6), 2)
+            self.run_step()
+        finally:
+            memory_governor.release(self.get_step_name())
+    
+    def get_jobs(self):
+        '''The number of parallel jobs to run, as granted for memory'''
+        return self.granted_jobs or self.jobs
+    
+    def spawn(self, cmd, search_path=1, level=1, cwd=None, env=None):
+        cache_env = compiler_cache_env(
+            self.compiler_cache, self.compiler_cache_dir)
+        if env is not None:
+            cache_env.update(env)
+        BuildStep.spawn(self, cmd, search_path, level, cwd=cwd,
+                        env=cache_env or None)
+    
+    def get_stamp_inputs(self):
+        '''A dictionary of everything that affects the step's result
+        
+        The base implementation covers the toolchain, where Python
+        packages are installed if the step installs any, and the stamps
+        of the steps this one depends on.
+        '''
+        inputs = dict(toolchain=get_compiler_identity(),
+                      platform=sys.platform,
+                      python=sys.version)
+        if self.installs_python_packages:
+            inputs["site_packages"] = os.path.abspath(
+                distutils.sysconfig.get_python_lib())
+        for dependency in self.depends_on:
+            command = self.distribution.get_command_obj(dependency, create=0)
+            if isinstance(command, StampedStep):
+                inputs["after " + dependency] = command.read_stamp()
+        return inputs
+    
+    def get_outputs(self):
+        '''Files or directories that have to exist for the step to be done'''
+        return []
+    
+    def get_intermediate_dirs(self):
+        '''Directories of intermediate files, e.g. object files'''
+        return []
+    
+    def get_scratch_path(self, path):
+        '''Where an intermediate tree goes
+        
+        path - where it would go under build_lib without a scratch directory
+        '''
+        if self.scratch_dir is None:
+            return path
+        relpath = os.path.relpath(os.path.abspath(path),
+                                  os.path.abspath(self.build_lib))
+        if relpath.startswith(os.pardir):
+            relpath = os.path.basename(path)
+        return os.path.join(self.scratch_dir, relpath)
     
-class BuildWithCMake(setuptools.Command):
+    def get_stamp_digest(self):
+        return hashlib.sha256(json.dumps(
+            self.get_stamp_inputs(), sort_keys=True)).hexdigest()
+    
+    def read_stamp(self):
+        '''The digest recorded when the step last succeeded or None'''
+        if not os.path.isfile(self.stamp_file):
+            return None
+        with open(self.stamp_file, "r") as fd:
+            try:
+                return json.load(fd)["digest"]
+            except (ValueError, KeyError):
+                return None
+            
+    def write_stamp(self):
+        stamp_dir = os.path.dirname(self.stamp_file)
+        if not os.path.isdir(stamp_dir):
+            try:
+                os.makedirs(stamp_dir)
+            except OSError:
+                if not os.path.isdir(stamp_dir):
+                    raise
+        with open(self.stamp_file, "w") as fd:
+            json.dump(dict(digest=self.get_stamp_digest(),
+                           finished=time.time()), fd)
+        
+    def is_up_to_date(self):
+        if self.force:
+            return False
+        if not all([os.path.exists(path) for path in self.get_outputs()]):
+            return False
+        stamp = self.read_stamp()
+        return stamp is not None and stamp == self.get_stamp_digest()
+    
+    def get_artifact_inputs(self):
+        '''A dictionary of everything that affects the step's artifact
+        
+        Unlike the stamp inputs, these have to be the same in every
+        checkout, so sources are identified by their archive and paths are
+        made relative to build_lib and the scratch directory. The base
+        implementation covers the toolchain, the Python ABI and the steps
+        this one depends on. Returns None if the step's artifact can't be
+        cached.
+        '''
+        inputs = dict(step=self.get_step_name(),
+                      toolchain=get_compiler_identity(),
+                      python=get_python_abi())
+        for dependency in self.depends_on:
+            command = self.distribution.get_command_obj(dependency, create=0)
+            if isinstance(command, StampedStep):
+                key = command.get_artifact_key()
+            elif isinstance(command, FetchSource):
+                key = command.get_source_identity()
+            else:
+                continue
+            if key is None:
+                return None
+            inputs["after " + dependency] = key
+        return inputs
+    
+    def get_artifact_key(self):
+        '''The key of the step's artifact or None if it can't be cached'''
+        if not self.artifact_cacheable:
+            return None
+        inputs = self.get_artifact_inputs()
+        if inputs is None:
+            return None
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+    
+    def relative_to_build_lib(self, value):
+        '''Replace build_lib and scratch paths in a string with placeholders
+        
+        The scratch directory is replaced first, since it can be inside
+        build_lib. Its path depends on the checkout, see build's
+        finalize_options.
+        '''
+        if self.scratch_dir is not None:
+            value = value.replace(
+                os.path.abspath(self.scratch_dir), "<scratch_dir>")
+        return value.replace(os.path.abspath(self.build_lib), "<build_lib>")
+    
+    def get_artifact_store(self):
+        '''The artifact store and key for the step or (None, None)'''
+        if self.artifact_cache is None:
+            return None, None
+        outputs = self.get_outputs()
+        build_lib = os.path.abspath(self.build_lib)
+        if len(outputs) == 0 or not all([
+            os.path.abspath(path).startswith(build_lib + os.sep)
+            for path in outputs]):
+            return None, None
+        key = self.get_artifact_key()
+        if key is None:
+            return None, None
+        return open_artifact_store(self.artifact_cache), key
+    
+    def restore_artifact(self):
+        '''Unpack the step's outputs from the artifact cache
+        
+        Returns True if they were restored, False if the step has to run.
+        '''
+        store, key = self.get_artifact_store()
+        if store is None:
+            return False
+        fd, archive = tempfile.mkstemp(suffix=".tar.gz")
+        os.close(fd)
+        try:
+            try:
+                if not store.fetch(key, archive):
+                    return False
+                self.announce("Restoring %s from the artifact cache" %
+                              self.get_step_name(), 2)
+                for path in self.get_outputs():
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                extractor = ArchiveExtractor(self.build_lib)
+                with tarfile.open(archive) as tarball:
+                    extractor.extract_tar(tarball)
+                self.bytes_written += extractor.bytes_written
+            except Exception as e:
+                self.announce("Failed to restore %s from the artifact cache, "
+                              "building it instead: %s" %
+                              (self.get_step_name(), e), 3)
+                for path in self.get_outputs():
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                return False
+        finally:
+            os.remove(archive)
+        return True
+    
+    def store_artifact(self):
+        '''Pack the step's outputs into the artifact cache'''
+        store, key = self.get_artifact_store()
+        if store is None:
+            return
+        fd, archive = tempfile.mkstemp(suffix=".tar.gz")
+        os.close(fd)
+        try:
+            with tarfile.open(archive, "w:gz") as tarball:
+                for path in self.get_outputs():
+                    tarball.add(path, os.path.relpath(path, self.build_lib))
+            store.store(key, archive)
+        except Exception as e:
+            self.announce("Failed to store %s in the artifact cache: %s" %
+                          (self.get_step_name(), e), 3)
+        finally:
+            os.remove(archive)
+
+class BuildWithCMake(StampedStep):
     user_options = [ 
         ("cmake", None, "Location of CMake executables"),
-        ("install-dir", None, "Package install directory")
+        ("install-dir", None, "Package install directory"),
+        ("jobs=", "j", "Number of parallel compile jobs"),
+        ("generator=", None,
+         'Build with "make" (NMake on Windows) or "ninja"')
     ]
+    memory_per_job = 512 * 1024 * 1024
     
     def initialize_options(self):
-        self.build_lib = None
+        StampedStep.initialize_options(self)
         self.cmake = None
+        self.jobs = None
+        self.generator = None
         self.source_dir = None
         self.target_dir = None
         self.src_command = None
@@ -59,9 +955,19 @@ class BuildWithCMake(setuptools.Command):
         self.do_install = True
         
     def finalize_options(self):
-        self.set_undefined_options(
-            'build', ('build_lib', 'build_lib'))
-        self.set_undefined_options('build', ('cmake', 'cmake'))
+        StampedStep.finalize_options(self)
+        self.set_undefined_options('build', ('cmake', 'cmake'),
+                                   ('jobs', 'jobs'),
+                                   ('generator', 'generator'))
+        self.jobs = int(self.jobs)
+        if self.generator not in ("make", "ninja"):
+            raise distutils.command.build.DistutilsOptionError(
+                'Unknown generator "%s", use "make" or "ninja"' %
+                self.generator)
+        if self.generator == "ninja" and \
+           distutils.spawn.find_executable("ninja") is None:
+            self.announce("Ninja is not installed, building with make", 3)
+            self.generator = "make"
         if self.cmake is None and is_win:
             path = r"C:\Program Files (x86)\CMake\bin"
             if os.path.exists(path):
@@ -82,7 +988,8 @@ class BuildWithCMake(setuptools.Command):
                 self.src_command, ("source_dir", "source_dir"))
         root, leaf = os.path.split(self.source_dir)
         if self.target_dir is None:
-            self.target_dir = os.path.join(root, "tmp", leaf)
+            self.target_dir = self.get_scratch_path(
+                os.path.join(root, "tmp", leaf))
         if self.install_root is None:
             self.install_root = os.path.abspath(
                 os.path.join(root, "install", leaf))
@@ -94,22 +1001,99 @@ class BuildWithCMake(setuptools.Command):
                     self.install_root, "usr", "local")
     
     def get_sub_commands(self):
-        if os.path.exists(self.source_dir):
+        if self.src_command is None or \
+           self.get_finalized_command(self.src_command).is_fetched():
             return []
         return [self.src_command]
     
     def get_cmake_generator(self):
-        if is_win:
+        if self.generator == "ninja":
+            return "Ninja"
+        elif is_win:
             return "NMake Makefiles"
         else:
             return "Unix Makefiles"
         
     def get_make_program(self):
-        if is_win:
+        if self.generator == "ninja":
+            return "ninja"
+        elif is_win:
             return "nmake"
         return "make"
+    
+    def get_make_args(self, *targets):
+        '''The make program, its parallel job option and the targets'''
+        args = [self.get_make_program()]
+        if self.generator == "ninja":
+            args += ["-j", str(self.get_jobs())]
+        elif not is_win:
+            # NMake can only run one job at a time
+            args.append("-j%d" % self.get_jobs())
+        return args + list(targets)
+    
+    def clear_stale_cache(self, target_dir):
+        '''Remove the CMake cache if it was made by another generator
         
-    def run(self):
+        CMake refuses to reconfigure a build directory with a different
+        generator.
+        '''
+        cache_path = os.path.join(target_dir, "CMakeCache.txt")
+        if not os.path.exists(cache_path):
+            return
+        with open(cache_path, "r") as fd:
+            for line in fd:
+                if line.startswith("CMAKE_GENERATOR:"):
+                    generator = line.partition("=")[2].strip()
+                    break
+            else:
+                return
+        if generator != self.get_cmake_generator():
+            self.announce("Generator changed from %s, reconfiguring %s" %
+                          (generator, target_dir), 2)
+            os.remove(cache_path)
+            cmake_files = os.path.join(target_dir, "CMakeFiles")
+            if os.path.isdir(cmake_files):
+                shutil.rmtree(cmake_files)
+    
+    def get_stamp_inputs(self):
+        inputs = StampedStep.get_stamp_inputs(self)
+        inputs.update(
+            source=tree_digest(self.source_dir),
+            cmake=self.cmake,
+            cmake_options=map(self.relative_to_build_lib,
+                              self.extra_cmake_options),
+            generator=self.get_cmake_generator(),
+            make=self.get_make_program(),
+            target_dir=self.relative_to_build_lib(
+                os.path.abspath(self.target_dir)),
+            install_root=self.relative_to_build_lib(self.install_root),
+            do_install=self.do_install)
+        return inputs
+    
+    def get_outputs(self):
+        if self.do_install:
+            return [self.install_root]
+        return [self.target_dir]
+    
+    def get_intermediate_dirs(self):
+        return [self.target_dir]
+    
+    @property
+    def artifact_cacheable(self):
+        # The build directory is only worth caching together with the source
+        return self.do_install
+    
+    def get_artifact_inputs(self):
+        inputs = StampedStep.get_artifact_inputs(self)
+        if inputs is not None:
+            inputs.update(
+                cmake_options=map(self.relative_to_build_lib,
+                                  self.extra_cmake_options),
+                generator=self.get_cmake_generator(),
+                install_root=self.relative_to_build_lib(self.install_root))
+        return inputs
+        
+    def run_step(self):
         cmake_args = [self.cmake]
         cmake_args += ["-G", self.get_cmake_generator()]
         if self.do_install and is_win:
@@ -120,58 +1104,1336 @@ class BuildWithCMake(setuptools.Command):
         if is_win:
             cmake_args.append('-DCMAKE_BUILD_TYPE:STRING="Release"')
         cmake_args += self.extra_cmake_options
+        #
+        # Always pass the launchers so that turning the compiler cache off
+        # clears them from an existing CMake cache.
+        #
+        for language in ("C", "CXX"):
+            cmake_args.append("-DCMAKE_%s_COMPILER_LAUNCHER=%s" %
+                              (language, self.compiler_cache or ""))
         if not os.path.exists(self.target_dir):
             os.makedirs(self.target_dir)
-        # I don't like changing directories. I can't see any way to make
-        # cmake build its makefiles in another directory
-        old_dir = os.path.abspath(os.curdir)
+        else:
+            self.clear_stale_cache(target_dir)
         source_dir = os.path.abspath(self.source_dir)
         cmake_args.append(source_dir)
-        os.chdir(target_dir)
-        try:
+        with self.phase("configure"):
             try:
-                self.spawn(cmake_args)
-            except SystemExit:
-                logfile = os.path.join("CMakeFiles", "CMakeError.log")
-                with open(logfile, "r") as fd:
-                    for line in fd:
-                        self.announce(line)
+                self.spawn(cmake_args, cwd=target_dir)
+            except DistutilsExecError:
+                logfile = os.path.join(
+                    target_dir, "CMakeFiles", "CMakeError.log")
+                if os.path.exists(logfile):
+                    with open(logfile, "r") as fd:
+                        for line in fd:
+                            self.announce(line)
                 raise
-            os.chdir(target_dir)
-            self.spawn([self.get_make_program()])
-            if self.do_install:
-                if is_win:
-                    self.spawn([self.get_make_program(), "install"])
-                else:
-                    self.spawn([self.get_make_program(),
-                                "DESTDIR=%s" % os.path.abspath(self.install_root),
-                                "install"])
-        finally:
-            os.chdir(old_dir)
+        with self.phase("compile"):
+            self.spawn(self.get_make_args(), cwd=target_dir)
+        if self.do_install:
+            with self.phase("install"):
+                self.install(target_dir)
+    
+    def install(self, target_dir):
+        if is_win:
+            self.spawn(self.get_make_args("install"), cwd=target_dir)
+        elif self.generator == "ninja":
+            self.spawn(self.get_make_args("install"), cwd=target_dir,
+                       env=dict(DESTDIR=os.path.abspath(self.install_root)))
+        else:
+            self.spawn(self.get_make_args(
+                "DESTDIR=%s" % os.path.abspath(self.install_root),
+                "install"), cwd=target_dir)
 
-class BuildWithNMake(setuptools.Command):
+class BuildWithNMake(StampedStep):
     user_options = []
     def initialize_options(self):
+	StampedStep.initialize_options(self)
 	self.source_dir = None
 	self.src_command = None
 	self.makefile = None
 	
     def finalize_options(self):
+	StampedStep.finalize_options(self)
 	if self.source_dir is None:
 	    self.set_undefined_options(self.src_command,
 	                               ('source_dir', 'source_dir'))
 	if self.makefile is None:
 	    self.makefile = "Makefile"
+	    
+    def get_stamp_inputs(self):
+        inputs = StampedStep.get_stamp_inputs(self)
+        inputs.update(source=tree_digest(self.source_dir),
+                      makefile=self.makefile)
+        return inputs
     
-    def run(self):
-	old_cwd = os.path.abspath(os.curdir)
-	os.chdir(self.source_dir)
-	try:
-	    self.spawn(["nmake", "-f", self.makefile])
-	finally:
-	    os.chdir(old_cwd)
+    def run_step(self):
+	args = ["nmake", "-f", self.makefile]
+	if self.compiler_cache is not None:
+	    #
+	    # The makefiles name the compiler either CC or cc
+	    #
+	    compiler = "%s cl" % self.compiler_cache
+	    args += ["CC=%s" % compiler, "cc=%s" % compiler]
+	with self.phase("compile"):
+	    self.spawn(args, cwd=self.source_dir)
 	
-class FetchSource(setuptools.Command, object):
+def default_cache_dir():
+    '''The directory for caches that are shared between build trees'''
+    if "BUILD_ILASTIK_CACHE" in os.environ:
+        return os.environ["BUILD_ILASTIK_CACHE"]
+    if is_win and "LOCALAPPDATA" in os.environ:
+        return os.path.join(os.environ["LOCALAPPDATA"], "build-ilastik")
+    return os.path.join(os.path.expanduser("~"), ".cache", "build-ilastik")
+
+#
+# The script run by get_installed_packages. It finds the packages without
+# importing them, except for h5py, which is the only place to get the
+# version of HDF5 it was built against.
+#
+probe_script = """
+import imp, json
+result = {}
+for name in ("h5py", "vigra", "ilastik"):
+    try:
+        imp.find_module(name)
+        result[name] = {}
+    except ImportError:
+        pass
+if "h5py" in result:
+    try:
+        import h5py.version
+        result["h5py"] = dict(version=h5py.version.version,
+                              hdf5_version=h5py.version.hdf5_version)
+    except Exception:
+        pass
+print(json.dumps(result))
+"""
+
+installed_packages = None
+
+def get_installed_packages():
+    '''Find out which of h5py, vigra and ilastik are installed
+    
+    Returns a dictionary with an entry for each installed package. The
+    entry for h5py has its version and the version of HDF5 it was built
+    with, if h5py could be imported.
+    
+    Importing h5py loads numpy and the HDF5 libraries, which is slow, so
+    the packages are probed in a subprocess when first asked for and the
+    result is cached in the shared cache directory. The cache is keyed
+    by the interpreter and the modification times of site-packages, which
+    change whenever a package is installed or removed.
+    '''
+    global installed_packages
+    if installed_packages is not None:
+        return installed_packages
+    h = hashlib.sha256(sys.executable)
+    h.update(sys.version)
+    h.update(os.environ.get("PYTHONPATH", ""))
+    for path in sorted(set((distutils.sysconfig.get_python_lib(),
+                            distutils.sysconfig.get_python_lib(True)))):
+        h.update(path)
+        if os.path.isdir(path):
+            h.update(repr(os.stat(path).st_mtime))
+    key = h.hexdigest()
+    cache_file = os.path.join(default_cache_dir(), "installed-packages.json")
+    try:
+        with open(cache_file, "r") as fd:
+            cache = json.load(fd)
+    except (IOError, ValueError):
+        cache = {}
+    if key in cache:
+        installed_packages = cache[key]
+        return installed_packages
+    try:
+        output = subprocess.check_output([sys.executable, "-c", probe_script])
+        installed_packages = json.loads(output.strip().splitlines()[-1])
+    except (OSError, subprocess.CalledProcessError, ValueError, IndexError):
+        #
+        # Don't cache a failed probe
+        #
+        installed_packages = {}
+        return installed_packages
+    cache[key] = installed_packages
+    try:
+        if not os.path.isdir(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+        with os.fdopen(fd, "w") as fd:
+            json.dump(cache, fd, indent=2, sort_keys=True)
+        os.rename(tmp_path, cache_file)
+    except (IOError, OSError):
+        pass
+    return installed_packages
+
+def run_pkg_config(*args):
+    '''pkg-config's output or None if it failed or isn't installed'''
+    try:
+        process = subprocess.Popen(["pkg-config"] + list(args),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    output = process.communicate()[0]
+    return output.strip() if process.returncode == 0 else None
+
+def run_cmake_find_package(cmake, name, mode):
+    '''Flags from "cmake --find-package" or None if CMake didn't find it'''
+    try:
+        process = subprocess.Popen(
+            [cmake, "--find-package", "-DNAME=" + name,
+             "-DCOMPILER_ID=" + ("MSVC" if is_win else "GNU"),
+             "-DLANGUAGE=C", "-DMODE=" + mode],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=tempfile.gettempdir())
+    except OSError:
+        return None
+    output = process.communicate()[0]
+    return output.strip() if process.returncode == 0 else None
+
+def get_default_include_dirs():
+    if is_win:
+        return []
+    return ["/usr/local/include", "/usr/include"]
+
+def get_default_library_dirs():
+    if is_win:
+        return []
+    dirs = ["/usr/local/lib64", "/usr/local/lib", "/usr/lib64"]
+    multiarch = distutils.sysconfig.get_config_var("MULTIARCH")
+    if multiarch:
+        dirs.append("/usr/lib/" + multiarch)
+    dirs += sorted(glob.glob("/usr/lib/*-linux-gnu")) + ["/usr/lib", "/lib"]
+    return dirs
+
+def get_install_prefix(include_dir):
+    '''The prefix that a library with headers in include_dir is under
+    
+    That is the parent of the "include" directory, which can be further
+    up than include_dir's parent, e.g. /usr for /usr/include/hdf5/serial.
+    '''
+    include_dir = os.path.abspath(include_dir)
+    path = include_dir
+    while os.path.basename(path) != "include":
+        parent = os.path.dirname(path)
+        if parent == path:
+            return os.path.dirname(include_dir)
+        path = parent
+    return os.path.dirname(path)
+
+def find_library(names, dirs):
+    '''The path to the first library with one of the names in dirs or None'''
+    if is_win:
+        patterns = ["%s.lib"]
+    else:
+        patterns = ["lib%s.so", "lib%s.dylib", "lib%s.a"]
+    for directory in dirs:
+        for name in names:
+            for pattern in patterns:
+                path = os.path.join(directory, pattern % name)
+                if os.path.isfile(path):
+                    return path
+    return None
+
+class SystemDependency(object):
+    '''A library the build can take from the system instead of building
+    
+    name - what the library is called in build --system-deps
+    steps - the steps that fetch and build it, which are skipped if the
+            system has a compatible version
+    header - a header that the include directory must have
+    libraries - a dictionary of role, e.g. "library", to the names the
+                library can have, without "lib" and extension
+    pkg_config - pkg-config modules to look for, in order
+    cmake - the name of the CMake find module or None
+    min_version - the oldest compatible version or None
+    below_version - the first incompatible version or None
+    version_pattern - a regular expression that finds the version in the
+                      header when pkg-config doesn't know it
+    compatible - (regular expression, version) for each drop-in
+                 replacement with versions of its own. If the expression
+                 is found in the header, the library counts as that
+                 version, e.g. libaec's szlib.h as szip 2.1.
+    cmake_options - (CMake variable, key) for each option that tells
+                    vigra's build where the library is. The key is
+                    "include_dir", "library_dir" or a role in libraries.
+    
+    The library is looked for with pkg-config, then CMake's find module,
+    then in the usual include and library directories.
+    '''
+    def __init__(self, name, steps, header, libraries, pkg_config=(),
+                 cmake=None, min_version=None, below_version=None,
+                 version_pattern=None, compatible=(), cmake_options=()):
+        self.name = name
+        self.steps = steps
+        self.header = header
+        self.libraries = libraries
+        self.pkg_config = pkg_config
+        self.cmake = cmake
+        self.min_version = min_version
+        self.below_version = below_version
+        self.version_pattern = version_pattern
+        self.compatible = compatible
+        self.cmake_options = cmake_options
+        
+    def get_requirement(self):
+        '''The compatible versions, e.g. "hdf5 >= 1.8.4, < 1.10"'''
+        requirement = []
+        if self.min_version is not None:
+            requirement.append(">= " + self.min_version)
+        if self.below_version is not None:
+            requirement.append("< " + self.below_version)
+        return " ".join([self.name, ", ".join(requirement)]).strip()
+    
+    def find(self, cmake="cmake"):
+        '''Find a compatible version of the library
+        
+        Returns a dictionary of version, found_by, include_dir, library_dir,
+        the install prefix and the path of each library role, or None if
+        there isn't one. The prefix is pkg-config's, otherwise the one
+        above the include directory. The library directory isn't always
+        directly under it, e.g. on multiarch systems.
+        '''
+        for candidate in self.get_candidates(cmake):
+            found = self.check(*candidate)
+            if found is not None:
+                return found
+        return None
+    
+    def get_candidates(self, cmake):
+        '''Yield (found_by, version, include dirs, library dirs, prefix)'''
+        for module in self.pkg_config:
+            version = run_pkg_config("--modversion", module)
+            if version is None:
+                continue
+            cflags = run_pkg_config("--cflags-only-I", module) or ""
+            libs = run_pkg_config("--libs-only-L", module) or ""
+            yield ("pkg-config " + module, version,
+                   [flag[2:] for flag in cflags.split()],
+                   [flag[2:] for flag in libs.split()],
+                   run_pkg_config("--variable=prefix", module) or None)
+        if self.cmake is not None and run_cmake_find_package(
+            cmake, self.cmake, "EXIST") is not None:
+            cflags = run_cmake_find_package(cmake, self.cmake, "COMPILE") or ""
+            libs = run_cmake_find_package(cmake, self.cmake, "LINK") or ""
+            library_dirs = [flag[2:] for flag in libs.split()
+                            if flag.startswith("-L")]
+            library_dirs += [os.path.dirname(flag) for flag in libs.split()
+                             if os.path.isabs(flag)]
+            yield ("CMake Find%s" % self.cmake, None,
+                   [flag[2:] for flag in cflags.split()
+                    if flag.startswith("-I")], library_dirs, None)
+        yield ("search", None, [], [], None)
+        
+    def check(self, found_by, version, include_dirs, library_dirs,
+              prefix=None):
+        '''The library's details if the candidate is complete and compatible'''
+        include_dirs = include_dirs + get_default_include_dirs()
+        library_dirs = library_dirs + get_default_library_dirs()
+        include_dir = None
+        for directory in include_dirs:
+            if os.path.isfile(os.path.join(directory, self.header)):
+                include_dir = directory
+                break
+        if include_dir is None:
+            return None
+        if self.compatible or \
+           (version is None and self.version_pattern is not None):
+            with open(os.path.join(include_dir, self.header), "r") as fd:
+                header = fd.read()
+            for pattern, compatible_version in self.compatible:
+                if re.search(pattern, header) is not None:
+                    version = compatible_version
+                    break
+            if version is None and self.version_pattern is not None:
+                match = re.search(self.version_pattern, header)
+                if match is not None:
+                    version = match.group(1).replace("_", ".")
+        if self.min_version is not None or self.below_version is not None:
+            if version is None:
+                return None
+            version_number = distutils.version.LooseVersion(version)
+            if self.min_version is not None and version_number < \
+               distutils.version.LooseVersion(self.min_version):
+                return None
+            if self.below_version is not None and version_number >= \
+               distutils.version.LooseVersion(self.below_version):
+                return None
+        found = dict(version=version, found_by=found_by,
+                     include_dir=include_dir,
+                     prefix=prefix or get_install_prefix(include_dir))
+        for role, names in self.libraries.items():
+            found[role] = find_library(names, library_dirs)
+            if found[role] is None:
+                return None
+        found["library_dir"] = os.path.dirname(found["library"])
+        return found
+    
+def get_library_search_state(cmake):
+    '''A digest of what decides which system libraries are found
+    
+    That is the environment, CMake and the modification times of the
+    directories that are searched and that pkg-config looks in. A
+    directory's modification time changes when a library, header or
+    subdirectory is added to it or removed from it.
+    '''
+    names = ("PATH", "PKG_CONFIG_PATH", "PKG_CONFIG_LIBDIR",
+             "CMAKE_PREFIX_PATH", "CPATH", "LIBRARY_PATH")
+    h = hashlib.sha256(json.dumps(dict(
+        platform=sys.platform, cmake=cmake,
+        environment=[os.environ.get(name, "") for name in names])))
+    pc_path = run_pkg_config("--variable=pc_path", "pkg-config") or ""
+    directories = get_default_include_dirs() + get_default_library_dirs() + \
+        (os.environ.get("PKG_CONFIG_PATH", "") + os.pathsep + pc_path).split(
+            os.pathsep)
+    for directory in sorted(set(filter(None, directories))):
+        h.update(directory)
+        if os.path.isdir(directory):
+            h.update(repr(os.stat(directory).st_mtime))
+    return h.hexdigest()
+
+def find_system_dependencies(dependencies, cmake="cmake"):
+    '''Find compatible versions of the libraries on the system
+    
+    Returns a dictionary of name to what SystemDependency.find returns
+    for each dependency. Running pkg-config and CMake for all of the
+    libraries takes seconds, so the results are cached in the shared
+    cache directory, like get_installed_packages. They are keyed by what
+    the dependency looks for and get_library_search_state, and only used
+    if the files that were found are still there.
+    '''
+    state = get_library_search_state(cmake)
+    cache_file = os.path.join(default_cache_dir(), "system-dependencies.json")
+    try:
+        with open(cache_file, "r") as fd:
+            cache = json.load(fd)
+    except (IOError, ValueError):
+        cache = {}
+    result = {}
+    changed = False
+    for dependency in dependencies:
+        key = hashlib.sha256(state + json.dumps([
+            dependency.name, dependency.header, dependency.libraries,
+            dependency.pkg_config, dependency.cmake, dependency.min_version,
+            dependency.below_version, dependency.version_pattern,
+            dependency.compatible], sort_keys=True)).hexdigest()
+        if key in cache:
+            found = cache[key]
+            if found is None or all([
+                os.path.exists(found[name]) for name in
+                ["include_dir"] + list(dependency.libraries)]):
+                result[dependency.name] = found
+                continue
+        result[dependency.name] = cache[key] = dependency.find(cmake)
+        changed = True
+    if not changed:
+        return result
+    try:
+        if not os.path.isdir(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+        with os.fdopen(fd, "w") as fd:
+            json.dump(cache, fd, indent=2, sort_keys=True)
+        replace_file(tmp_path, cache_file)
+    except (IOError, OSError):
+        pass
+    return result
+    
+#
+# vigra 1.7.1 uses libpng's jmpbuf, which went away in 1.5, and h5py 2.3
+# predates HDF5 1.10.
+#
+system_dependencies = [
+    SystemDependency(
+        "zlib", ("fetch_zlib", "build_zlib"), "zlib.h",
+        dict(library=("z", "zlib")), pkg_config=("zlib",), cmake="ZLIB",
+        min_version="1.2.3", version_pattern=r'#define ZLIB_VERSION "([^"]+)"',
+        cmake_options=(("ZLIB_LIBRARY:FILEPATH", "library"),
+                       ("ZLIB_INCLUDE_DIR:PATH", "include_dir"),
+                       ("HDF5_Z_LIBRARY:FILEPATH", "library"))),
+    SystemDependency(
+        "szip", ("fetch_szip", "build_szip"), "szlib.h",
+        dict(library=("sz", "szip")), pkg_config=("szip", "libaec"),
+        min_version="2.0", version_pattern=r'#define SZLIB_VERSION "([^"]+)"',
+        compatible=((r'#include\s*[<"]libaec\.h[">]', "2.1"),),
+        cmake_options=(("HDF5_SZ_LIBRARY:FILEPATH", "library"),)),
+    SystemDependency(
+        "hdf5", ("fetch_libhdf5", "build_libhdf5"), "hdf5.h",
+        dict(library=("hdf5", "hdf5_serial"),
+             hl=("hdf5_hl", "hdf5_serial_hl")),
+        pkg_config=("hdf5", "hdf5-serial"), cmake="HDF5",
+        min_version="1.8.4", below_version="1.10",
+        version_pattern=r'H5_VERS_INFO "HDF5 library version: ([^"]+)"',
+        cmake_options=(("HDF5_CORE_LIBRARY:FILEPATH", "library"),
+                       ("HDF5_HL_LIBRARY:FILEPATH", "hl"),
+                       ("HDF5_INCLUDE_DIR:PATH", "include_dir"))),
+    SystemDependency(
+        "libpng", ("fetch_libpng", "build_libpng"), "png.h",
+        dict(library=("png", "png14", "png12")),
+        pkg_config=("libpng14", "libpng12", "libpng"), cmake="PNG",
+        min_version="1.2", below_version="1.5",
+        version_pattern=r'#define PNG_LIBPNG_VER_STRING "([^"]+)"',
+        cmake_options=(("PNG_LIBRARY:FILEPATH", "library"),
+                       ("PNG_PNG_INCLUDE_DIR:PATH", "include_dir"))),
+    SystemDependency(
+        "libtiff", ("fetch_tiff", "build_tiff"), "tiffio.h",
+        dict(library=("tiff", "libtiff")), pkg_config=("libtiff-4",),
+        cmake="TIFF", min_version="3.8",
+        cmake_options=(("TIFF_LIBRARY:FILEPATH", "library"),
+                       ("TIFF_INCLUDE_DIR:PATH", "include_dir"))),
+    SystemDependency(
+        "jpeg", ("fetch_jpeg", "build_jpeg"), "jpeglib.h",
+        dict(library=("jpeg", "libjpeg")), pkg_config=("libjpeg",),
+        cmake="JPEG",
+        cmake_options=(("JPEG_LIBRARY:FILEPATH", "library"),
+                       ("JPEG_INCLUDE_DIR:PATH", "include_dir"))),
+    SystemDependency(
+        "boost_python", ("fetch_boost", "build_boost"), "boost/version.hpp",
+        dict(library=("boost_python%d%d" % sys.version_info[:2],
+                      "boost_python-py%d%d" % sys.version_info[:2],
+                      "boost_python")),
+        min_version="1.41",
+        version_pattern=r'#define BOOST_LIB_VERSION "([^"]+)"',
+        cmake_options=(("Boost_PYTHON_LIBRARY_RELEASE:FILEPATH", "library"),
+                       ("Boost_INCLUDE_DIR:PATH", "include_dir"),
+                       ("Boost_LIBRARY_DIR:PATH", "library_dir"))),
+    SystemDependency(
+        "fftw", (), "fftw3.h", dict(library=("fftw3",)),
+        pkg_config=("fftw3",), min_version="3.0",
+        cmake_options=(("FFTW3_LIBRARY:FILEPATH", "library"),
+                       ("FFTW3_INCLUDE_DIR:PATH", "include_dir")))]
+
+def file_sha256(path):
+    '''Compute the SHA-256 hex digest of a file's contents'''
+    h = hashlib.sha256()
+    with open(path, "rb") as fd:
+        while True:
+            data = fd.read(1024 * 1024)
+            if len(data) == 0:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def is_transient_error(e):
+    '''True if a download error is worth retrying'''
+    response = getattr(e, "response", None)
+    if response is not None:
+        # Server errors and throttling are transient, the rest are not
+        return response.status_code >= 500 or response.status_code in (
+            408, 429)
+    code = getattr(e, "code", None)
+    if isinstance(code, int):
+        # urllib2.HTTPError
+        return code >= 500 or code in (408, 429)
+    return True
+
+def get_validator(headers):
+    '''The strong ETag, or failing that the Last-Modified date, or None
+    
+    Either one can be sent back in If-Range so that a server only resumes
+    a download if the data hasn't changed. Weak ETags can't be used there.
+    '''
+    etag = headers.get("ETag")
+    if etag is not None and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+class SourceChanged(DistutilsError):
+    '''The data at a URL changed partway through downloading it'''
+
+def describe_callable(function):
+    '''A string that changes when a post_fetch or member_filter changes
+    
+    This is the function's name and a digest of its code, its constants
+    and the FilePatches in any global lists it refers to. None is None.
+    '''
+    if function is None:
+        return None
+    code = getattr(function, "func_code", None)
+    if code is None:
+        return getattr(function, "__name__", repr(function))
+    h = hashlib.sha256(code.co_code)
+    h.update(repr([const for const in code.co_consts
+                   if not isinstance(const, type(code))]))
+    for name in code.co_names:
+        value = function.func_globals.get(name)
+        if isinstance(value, list) and len(value) > 0 and \
+           all([isinstance(item, FilePatch) for item in value]):
+            h.update(name)
+            h.update(repr([sorted(item.__dict__.items()) for item in value]))
+    return "%s:%s" % (function.__name__, h.hexdigest())
+
+def replace_file(src, dest):
+    '''Move src to dest, replacing dest if it exists'''
+    if is_win and os.path.exists(dest):
+        os.remove(dest)
+    os.rename(src, dest)
+
+class DownloadManager(object):
+    '''Shares HTTP connections between downloads and limits how many run
+    
+    Each host gets one requests session, whose connections are kept alive
+    and reused by every download from that host. Transfers take a slot
+    for their duration: at most max_downloads run at the same time, at
+    most max_host_downloads of them from the same host. The manager logs
+    the progress of all transfers together.
+    '''
+    progress_interval = 5.0
+    
+    def __init__(self, max_downloads=4, max_host_downloads=2):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.transfers = []
+        self.last_progress = 0
+        self.configure(max_downloads, max_host_downloads)
+        
+    def configure(self, max_downloads, max_host_downloads):
+        '''Set the limits. Call before any downloads start.'''
+        self.max_downloads = max_downloads
+        self.max_host_downloads = max_host_downloads
+        self.slots = threading.BoundedSemaphore(max_downloads)
+        self.host_slots = {}
+        
+    def get_host(self, url):
+        return urlparse.urlparse(url).netloc
+        
+    def get_session(self, url):
+        '''The pooled session for the URL's host'''
+        import requests
+        host = self.get_host(url)
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=max(self.max_host_downloads, 4))
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.sessions[host] = session
+            return self.sessions[host]
+    
+    @contextlib.contextmanager
+    def transfer(self, url):
+        '''Hold a download slot for a transfer from the URL
+        
+        Yields a dictionary that the caller keeps up to date with the
+        "received" and "expected" bytes (expected None if not known).
+        '''
+        host = self.get_host(url)
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(
+                    self.max_host_downloads)
+            host_slots = self.host_slots[host]
+        with host_slots:
+            with self.slots:
+                transfer = dict(url=url, received=0, expected=None,
+                                start_time=time.time())
+                with self.lock:
+                    self.transfers.append(transfer)
+                    active = len(self.transfers)
+                distutils.log.info("Downloading %s (%d active)" % (url, active))
+                try:
+                    yield transfer
+                finally:
+                    with self.lock:
+                        self.transfers.remove(transfer)
+    
+    def report_progress(self):
+        '''Log the progress of all transfers, at most every few seconds'''
+        with self.lock:
+            now = time.time()
+            if now - self.last_progress < self.progress_interval or \
+               len(self.transfers) == 0:
+                return
+            self.last_progress = now
+            received = sum([t["received"] for t in self.transfers])
+            expected = [t["expected"] for t in self.transfers]
+            elapsed = max(now - min([t["start_time"]
+                                     for t in self.transfers]), .001)
+            active = len(self.transfers)
+        if None in expected:
+            total = ""
+        else:
+            total = " of %.1f MB" % (sum(expected) / 1e6)
+        distutils.log.info(
+            "Downloads: %d active, %.1f%s MB received (%.2f MB/sec)" %
+            (active, received / 1e6, total, received / 1e6 / elapsed))
+
+download_manager = DownloadManager()
+
+class UrlStream(object):
+    '''A URL opened for reading in chunks, starting at a byte offset
+    
+    http(s) URLs are read with requests, ftp URLs with urllib2 and file URLs
+    directly from the file system. Data is only ever held a chunk at a time.
+    
+    offset - the byte offset that the data starts at. This is zero if the
+             server can't resume at the requested offset.
+    length - the number of bytes to expect, or None if not known
+    validator - what identifies the version of the data at an http(s)
+                URL, see get_validator, or None
+    
+    end - if not None, ask an http(s) server for the data up to this byte
+          offset only. Servers may send more, so stop reading at it.
+    if_range - the validator of the data before the offset. An http(s)
+               server only resumes if it still matches, otherwise it sends
+               the whole file.
+    '''
+    def __init__(self, url, offset=0, timeout=None, end=None, if_range=None):
+        self.url = url
+        self.offset = offset
+        self.length = None
+        self.validator = None
+        scheme = urlparse.urlparse(url).scheme
+        if scheme in ("http", "https"):
+            self.open_http(timeout, end, if_range)
+        elif scheme == "file":
+            self.open_file()
+        else:
+            # urllib2 can't resume ftp downloads
+            self.offset = 0
+            self.fd = urllib2.urlopen(url, timeout=timeout)
+            length = self.fd.info().getheader("Content-Length")
+            if length is not None:
+                self.length = int(length)
+            
+    def open_http(self, timeout, end=None, if_range=None):
+        headers = {}
+        if end is not None:
+            headers["Range"] = "bytes=%d-%d" % (self.offset, end - 1)
+        elif self.offset > 0:
+            headers["Range"] = "bytes=%d-" % self.offset
+        if "Range" in headers and if_range is not None:
+            headers["If-Range"] = if_range
+        session = download_manager.get_session(self.url)
+        self.response = session.get(
+            self.url, stream=True, headers=headers, timeout=timeout)
+        if self.offset > 0 and self.response.status_code == 416:
+            #
+            # Nothing past the requested offset: the caller already has
+            # everything if the server says the file is that long.
+            #
+            content_range = self.response.headers.get("Content-Range", "")
+            self.response.close()
+            if content_range == "bytes */%d" % self.offset:
+                self.response = None
+                self.length = 0
+                return
+            self.response = session.get(
+                self.url, stream=True, timeout=timeout)
+        self.response.raise_for_status()
+        self.validator = get_validator(self.response.headers)
+        if self.response.status_code != 206:
+            # The server sent the whole file
+            self.offset = 0
+        length = self.response.headers.get("Content-Length")
+        if length is not None and \
+           "Content-Encoding" not in self.response.headers:
+            self.length = int(length)
+            
+    def open_file(self):
+        path = urllib.url2pathname(urlparse.urlparse(self.url).path)
+        self.fd = open(path, "rb")
+        self.fd.seek(0, os.SEEK_END)
+        size = self.fd.tell()
+        self.offset = min(self.offset, size)
+        self.fd.seek(self.offset)
+        self.length = size - self.offset
+        
+    def chunks(self, buffer_size):
+        '''Iterate over the data, buffer_size bytes at a time'''
+        if hasattr(self, "response"):
+            if self.response is not None:
+                for chunk in self.response.iter_content(
+                    chunk_size=buffer_size):
+                    yield chunk
+            return
+        while True:
+            data = self.fd.read(buffer_size)
+            if len(data) == 0:
+                break
+            yield data
+    
+    def close(self):
+        if getattr(self, "response", None) is not None:
+            self.response.close()
+        elif hasattr(self, "fd"):
+            self.fd.close()
+
+class ArchiveExtractor(object):
+    '''Unpack tar and zip archives, writing the files on a thread pool
+    
+    The archive is read, and so decompressed, exactly once, in order, by
+    the calling thread. member_filter is applied to each name before
+    anything is read or written. Directories are created before any files
+    are written into them, then the contents of each file are handed to
+    a pool of writer threads. Files bigger than large_file_size are
+    copied by the calling thread a buffer at a time and at most
+    max_pending bytes wait for the writers, so memory use stays bounded.
+    
+    dest - the directory to unpack into
+    member_filter - a function that takes a member's name and returns True
+                    if it should be unpacked
+    workers - the number of writer threads. Writing is mostly waiting on
+              the file system, so this defaults to twice the number of
+              CPUs, up to 8.
+    buffer_size - the number of bytes to copy at a time for big files
+    '''
+    large_file_size = 4 * 1024 * 1024
+    max_pending = 64 * 1024 * 1024
+    
+    def __init__(self, dest, member_filter=None, workers=None,
+                 buffer_size=256 * 1024):
+        self.dest = os.path.abspath(dest)
+        self.member_filter = member_filter
+        if workers is None:
+            workers = min(8, 2 * multiprocessing.cpu_count())
+        self.workers = max(1, workers)
+        self.buffer_size = buffer_size
+        self.files_written = 0
+        self.bytes_written = 0
+        
+    def extract_tar(self, tarball):
+        '''Unpack a tarfile.TarFile, which may be opened in stream mode'''
+        def entries():
+            for member in tarball:
+                if member.isdir():
+                    kind = "dir"
+                elif member.issym():
+                    kind = "symlink"
+                elif member.islnk():
+                    kind = "hardlink"
+                elif member.isfile():
+                    kind = "file"
+                else:
+                    continue
+                yield (member.name, kind, member.mode, member.mtime,
+                       member.size, member.linkname,
+                       lambda member=member: tarball.extractfile(member))
+        self.extract(entries())
+        
+    def extract_zip(self, zip_file):
+        '''Unpack a zipfile.ZipFile'''
+        infos = zip_file.infolist()
+        def entries():
+            for info in infos:
+                mode = (info.external_attr >> 16) & 07777
+                if mode == 0:
+                    mode = None
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                kind = "dir" if info.filename.endswith("/") else "file"
+                yield (info.filename, kind, mode, mtime, info.file_size,
+                       None, lambda info=info: zip_file.open(info))
+        # The zip directory lists everything, so make the directories now
+        self.extract(entries(), [
+            info.filename.rpartition("/")[0] for info in infos
+            if self.member_filter is None or
+            self.member_filter(info.filename)])
+        
+    def extract(self, entries, directories=()):
+        '''Unpack archive members
+        
+        entries - an iterator of (name, kind, mode, mtime, size, linkname,
+                  opener) tuples. kind is one of "dir", "file", "symlink"
+                  or "hardlink", mode and mtime may be None and opener
+                  returns a file-like object with the member's data.
+        directories - names of directories that can be created up front
+        '''
+        self.made_dirs = set()
+        for directory in sorted(set(directories)):
+            self.make_dirs(self.get_path(directory))
+        dir_attributes = []
+        links = []
+        self.start_writers()
+        try:
+            for name, kind, mode, mtime, size, linkname, opener in entries:
+                if self.member_filter is not None and \
+                   not self.member_filter(name):
+                    continue
+                path = self.get_path(name)
+                if kind == "dir":
+                    self.make_dirs(path)
+                    dir_attributes.append((path, mode, mtime))
+                    continue
+                self.make_dirs(os.path.dirname(path))
+                if kind != "file":
+                    links.append((path, kind, linkname))
+                elif size > self.large_file_size:
+                    self.copy_file(path, opener(), mode, mtime)
+                else:
+                    self.submit(path, opener().read(), mode, mtime)
+        except:
+            self.stop_writers(raise_errors=False)
+            raise
+        self.stop_writers()
+        for path, kind, linkname in links:
+            self.make_link(path, kind, linkname)
+        #
+        # Set the directory attributes last, deepest first, because
+        # writing the files changes the modification times.
+        #
+        dir_attributes.sort(reverse=True)
+        for path, mode, mtime in dir_attributes:
+            self.set_attributes(path, mode, mtime)
+        
+    def get_path(self, name):
+        '''Map a member name to a path, refusing ones outside dest'''
+        path = os.path.normpath(os.path.join(self.dest, name))
+        if path != self.dest and not path.startswith(
+            os.path.join(self.dest, "")):
+            raise DistutilsError(
+                "Archive member %s would unpack outside of %s" %
+                (name, self.dest))
+        return path
+    
+    def make_dirs(self, path):
+        if path in self.made_dirs:
+            return
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+        while path not in self.made_dirs and path != self.dest:
+            self.made_dirs.add(path)
+            path = os.path.dirname(path)
+            
+    def make_link(self, path, kind, linkname):
+        if os.path.lexists(path):
+            os.remove(path)
+        if kind == "symlink":
+            if hasattr(os, "symlink"):
+                os.symlink(linkname, path)
+                return
+            source = os.path.join(os.path.dirname(path), linkname)
+        else:
+            # Hard link names are relative to the top of the archive
+            source = self.get_path(linkname)
+            if hasattr(os, "link"):
+                os.link(source, path)
+                return
+        if os.path.isfile(source):
+            shutil.copy2(source, path)
+            
+    def set_attributes(self, path, mode, mtime):
+        if mode is not None:
+            os.chmod(path, mode & 07777)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+            
+    def copy_file(self, path, fdsrc, mode, mtime):
+        with open(path, "wb") as fd:
+            while True:
+                data = fdsrc.read(self.buffer_size)
+                if len(data) == 0:
+                    break
+                fd.write(data)
+                self.bytes_written += len(data)
+        self.set_attributes(path, mode, mtime)
+        self.files_written += 1
+        
+    def start_writers(self):
+        self.queue = Queue.Queue()
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.errors = []
+        self.threads = [threading.Thread(target=self.writer)
+                        for _ in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+            
+    def stop_writers(self, raise_errors=True):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors and raise_errors:
+            exc_type, exc_value, exc_tb = self.errors[0]
+            raise exc_type, exc_value, exc_tb
+        
+    def submit(self, path, data, mode, mtime):
+        '''Queue a file's data to be written by a writer thread'''
+        with self.condition:
+            while self.pending > 0 and \
+                  self.pending + len(data) > self.max_pending:
+                self.condition.wait()
+            if self.errors:
+                exc_type, exc_value, exc_tb = self.errors[0]
+                raise exc_type, exc_value, exc_tb
+            self.pending += len(data)
+        self.queue.put((path, data, mode, mtime))
+        
+    def writer(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            path, data, mode, mtime = item
+            try:
+                with open(path, "wb") as fd:
+                    fd.write(data)
+                self.set_attributes(path, mode, mtime)
+            except:
+                with self.condition:
+                    self.errors.append(sys.exc_info())
+            with self.condition:
+                self.pending -= len(data)
+                self.files_written += 1
+                self.bytes_written += len(data)
+                self.condition.notify_all()
+
+class ChunkReader(object):
+    '''A file-like object that reads from an iterator of data chunks
+    
+    Everything read is hashed and, if tee is given, copied to the tee file.
+    '''
+    def __init__(self, chunks, tee=None):
+        self.chunks = iter(chunks)
+        self.tee = tee
+        self.sha256 = hashlib.sha256()
+        self.buffer = ""
+        self.position = 0
+        self.bytes_read = 0
+        
+    def read(self, size=-1):
+        result = []
+        while size != 0:
+            if self.position == len(self.buffer):
+                try:
+                    self.buffer = next(self.chunks)
+                except StopIteration:
+                    break
+                self.position = 0
+                self.bytes_read += len(self.buffer)
+                self.sha256.update(self.buffer)
+                if self.tee is not None:
+                    self.tee.write(self.buffer)
+            if size < 0:
+                end = len(self.buffer)
+            else:
+                end = min(len(self.buffer), self.position + size)
+                size -= end - self.position
+            result.append(self.buffer[self.position:end])
+            self.position = end
+        return "".join(result)
+
+#
+# Programs that decompress faster than Python's gzip and bz2 modules, by
+# archive suffix, best first. Each reads the file given as its last
+# argument or stdin and writes to stdout. Python can't read zstd at all.
+#
+decompressors = [
+    ((".gz", ".tgz"), [["pigz", "-d", "-c"]]),
+    ((".bz2", ".tbz", ".tbz2"), [["lbzip2", "-d", "-c"],
+                                 ["pbzip2", "-d", "-c"]]),
+    ((".zst", ".tzst"), [["zstd", "-d", "-c", "-q"]])]
+
+def find_decompressor(archive_name, program=None):
+    '''The command line for decompressing an archive or None
+    
+    archive_name - the archive's file name, which picks the format
+    program - the name of the program to use, or None for the first one
+              installed
+    
+    Returns None if no program that can decompress the archive is on
+    the PATH.
+    '''
+    name = archive_name.lower()
+    for suffixes, commands in decompressors:
+        if not name.endswith(suffixes):
+            continue
+        for command in commands:
+            if program is not None and command[0] != program:
+                continue
+            path = distutils.spawn.find_executable(command[0])
+            if path is not None:
+                return [path] + command[1:]
+        break
+    return None
+
+class DecompressorPipe(object):
+    '''Decompress an archive in a child process
+    
+    The decompressed data is read from the stdout attribute. Call close
+    once it has been read, to check that decompression succeeded.
+    
+    command - the decompressor's command line
+    source - the path to the archive or a file-like object to read it
+             from. A file-like object is copied to the decompressor by a
+             thread, so errors from reading it surface in close.
+    buffer_size - the number of bytes to copy at a time
+    '''
+    def __init__(self, command, source, buffer_size=256 * 1024):
+        self.command = command
+        self.error = None
+        self.stderr = tempfile.TemporaryFile()
+        if isinstance(source, basestring):
+            self.process = subprocess.Popen(
+                command + [source], stdout=subprocess.PIPE,
+                stderr=self.stderr)
+            self.feeder = None
+        else:
+            self.process = subprocess.Popen(
+                command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=self.stderr)
+            self.feeder = threading.Thread(
+                target=self.feed, args=(source, buffer_size))
+            self.feeder.daemon = True
+            self.feeder.start()
+        self.stdout = self.process.stdout
+        
+    def feed(self, source, buffer_size):
+        try:
+            while True:
+                data = source.read(buffer_size)
+                if len(data) == 0:
+                    break
+                self.process.stdin.write(data)
+        except:
+            self.error = sys.exc_info()
+        finally:
+            try:
+                self.process.stdin.close()
+            except IOError:
+                pass
+            
+    def raise_feeder_error(self):
+        '''Raise the error from reading the source, if there was one
+        
+        A broken pipe means the decompressor quit, which it reports.
+        '''
+        if self.error is not None and not (
+            isinstance(self.error[1], IOError) and
+            self.error[1].errno == errno.EPIPE):
+            raise self.error[0], self.error[1], self.error[2]
+        
+    def close(self):
+        # Read whatever follows the end of the tar archive, so the
+        # decompressor can finish
+        while len(self.stdout.read(1024 * 1024)) > 0:
+            pass
+        if self.feeder is not None:
+            self.feeder.join()
+        returncode = self.process.wait()
+        self.raise_feeder_error()
+        if returncode != 0:
+            self.stderr.seek(0)
+            raise DistutilsError("%s failed: %s" % (
+                os.path.basename(self.command[0]),
+                self.stderr.read().strip()))
+        self.stderr.close()
+        
+    def abort(self):
+        '''Stop the decompressor after the archive couldn't be read'''
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        self.stdout.close()
+        self.process.wait()
+        if self.feeder is not None:
+            self.feeder.join()
+        self.stderr.close()
+        self.raise_feeder_error()
+
+class LocalArtifactStore(object):
+    '''An artifact cache in a directory'''
+    def __init__(self, directory):
+        self.directory = directory
+        
+    def get_path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".tar.gz")
+    
+    def contains(self, key):
+        return os.path.isfile(self.get_path(key))
+    
+    def fetch(self, key, path):
+        '''Copy the artifact to path, returning False if there is none'''
+        artifact_path = self.get_path(key)
+        if not os.path.isfile(artifact_path):
+            return False
+        shutil.copyfile(artifact_path, path)
+        return True
+    
+    def store(self, key, path):
+        '''Add the artifact at path to the cache'''
+        artifact_path = self.get_path(key)
+        artifact_dir = os.path.dirname(artifact_path)
+        if not os.path.isdir(artifact_dir):
+            try:
+                os.makedirs(artifact_dir)
+            except OSError:
+                if not os.path.isdir(artifact_dir):
+                    raise
+        # Copy under a unique name first so readers never see part of it
+        fd, part_path = tempfile.mkstemp(dir=artifact_dir, suffix=".part")
+        os.close(fd)
+        shutil.copyfile(path, part_path)
+        replace_file(part_path, artifact_path)
+
+class HttpArtifactStore(object):
+    '''An artifact cache on a web server
+    
+    Artifacts are read with GET and written with PUT, at the same paths
+    as in a LocalArtifactStore, so a static file server over a local
+    artifact cache directory can serve it.
+    '''
+    def __init__(self, url, timeout=60, buffer_size=256*1024):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.buffer_size = buffer_size
+        
+    def get_url(self, key):
+        return "%s/%s/%s.tar.gz" % (self.url, key[:2], key)
+    
+    def contains(self, key):
+        url = self.get_url(key)
+        response = download_manager.get_session(url).head(
+            url, timeout=self.timeout)
+        return response.status_code == 200
+    
+    def fetch(self, key, path):
+        import requests
+        try:
+            stream = UrlStream(self.get_url(key), timeout=self.timeout)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return False
+            raise
+        try:
+            with open(path, "wb") as fd:
+                for chunk in stream.chunks(self.buffer_size):
+                    fd.write(chunk)
+        finally:
+            stream.close()
+        return True
+    
+    def store(self, key, path):
+        with open(path, "rb") as fd:
+            url = self.get_url(key)
+            response = download_manager.get_session(url).put(
+                url, data=fd, timeout=self.timeout)
+        response.raise_for_status()
+
+#
+# Artifact store classes by URL scheme. A path without a scheme is a
+# local directory.
+#
+artifact_stores = {
+    "http": HttpArtifactStore,
+    "https": HttpArtifactStore
+}
+
+def open_artifact_store(location):
+    '''Make the artifact store for a directory or URL'''
+    scheme = urlparse.urlparse(location).scheme
+    if scheme == "file":
+        return LocalArtifactStore(
+            urllib.url2pathname(urlparse.urlparse(location).path))
+    if scheme in artifact_stores:
+        return artifact_stores[scheme](location)
+    # Windows drive letters look like one-letter schemes
+    return LocalArtifactStore(location)
+
+#
+# Runs setup.py with setuptools imported first, which is what pip does
+#
+setuptools_shim = (
+    "import setuptools, tokenize; __file__ = 'setup.py'; "
+    "exec(compile(getattr(tokenize, 'open', open)(__file__).read()"
+    ".replace('\\r\\n', '\\n'), __file__, 'exec'))")
+
+class WheelCache(object):
+    '''Wheels of the Python packages the build installs
+    
+    Each wheel is in a directory named after its key, a digest of
+    everything that went into it.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        
+    def get_dir(self, key):
+        return os.path.join(self.directory, key[:2], key)
+    
+    def find(self, key):
+        '''The path to the wheel with the key or None'''
+        directory = self.get_dir(key)
+        if os.path.isdir(directory):
+            for filename in sorted(os.listdir(directory)):
+                if filename.endswith(".whl"):
+                    return os.path.join(directory, filename)
+        return None
+    
+    def store(self, key, wheel):
+        '''Copy a wheel into the cache, returning the copy's path'''
+        directory = self.get_dir(key)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, os.path.basename(wheel))
+        shutil.copyfile(wheel, path + ".part")
+        replace_file(path + ".part", path)
+        return path
+
+class MirrorStats(object):
+    '''Download throughput per host, remembered between builds
+    
+    The figures are kept in a JSON file of host to bytes per second.
+    '''
+    lock = threading.Lock()
+    # Transfers shorter than this say more about latency than throughput
+    min_transfer_size = 64 * 1024
+    
+    def __init__(self, path):
+        self.path = path
+        
+    def get_host(self, url):
+        parts = urlparse.urlparse(url)
+        return parts.netloc or parts.scheme
+    
+    def read(self):
+        if not os.path.isfile(self.path):
+            return {}
+        with open(self.path, "r") as fd:
+            try:
+                return json.load(fd)
+            except ValueError:
+                return {}
+    
+    def get_throughput(self, url):
+        '''The remembered bytes per second for the URL's host or None'''
+        with self.lock:
+            return self.read().get(self.get_host(url))
+        
+    def update(self, url, update):
+        with self.lock:
+            stats = self.read()
+            host = self.get_host(url)
+            stats[host] = update(stats.get(host))
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, part_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, "w") as fd:
+                json.dump(stats, fd, indent=2, sort_keys=True)
+            replace_file(part_path, self.path)
+    
+    def record(self, url, nbytes, seconds):
+        '''Blend a transfer's throughput into the host's figure'''
+        if nbytes < self.min_transfer_size:
+            return
+        throughput = nbytes / max(seconds, .001)
+        self.update(url, lambda old: throughput if old is None
+                    else (old + throughput) / 2)
+        
+    def record_failure(self, url):
+        '''Rank a host lower after it failed'''
+        if self.get_throughput(url) is not None:
+            self.update(url, lambda old: None if old is None else old / 2)
+
+class FetchSource(BuildStep):
     '''Download and untar a tarball or zipfile
     
     interesting configurable attributes:
@@ -201,6 +2463,61 @@ class FetchSource(setuptools.Command, object):
                  as the single argument
     member_filter - a function that evaluates a path in the tarball and returns
                     True only if the associated member should be untarred.
+    sha256 - the expected SHA-256 digest of the archive. The fetch fails if
+             the download doesn't match.
+    cacheable - False if the content at the URL can change, e.g. a branch
+                tarball. Otherwise, the archive is kept in the download cache
+                under the build's cache directory, keyed by the URL and
+                sha256, and later fetches take it from there.
+    retries - how many times to retry an interrupted download. Defaults to 5.
+    retry_delay - seconds to wait before the first retry. The delay doubles
+                  on each retry. Defaults to 1.
+    timeout - seconds to wait for the server before giving up. Defaults to 60.
+    buffer_size - the number of bytes to transfer at a time, which bounds the
+                  memory used by a download. Defaults to 256 KiB.
+    stream_extract - unpack tarballs while they download instead of saving
+                     them first. Zip files are always saved first.
+    extract_workers - the number of threads that write unpacked files.
+                      Defaults to twice the number of CPUs, up to 8.
+    decompressor - the program to decompress tarballs with, e.g. "lbzip2",
+                   or "python" for Python's own gzip and bz2 support.
+                   Defaults to the first installed program that handles
+                   the archive's format, see decompressors.
+    decompressed_with - the program the tarball was decompressed with,
+                        once the step has run
+    
+    Once a cacheable archive is unpacked, filtered and patched, the source
+    directory and extra_paths are packed into <cache_dir>/prepared as a
+    zstd-compressed tar, or a plain tar if zstd isn't installed. Later
+    fetches of the same archive with the same member_filter and post_fetch
+    unpack the pack instead, so the archive isn't decompressed and the
+    patches aren't applied again.
+    archive_digest - the SHA-256 digest of the archive, known once the
+                     step has run
+    patched_files - the patched files' digests, set by apply_patches
+    extra_paths - paths in the unpack directory, outside the source
+                  directory, that post_fetch writes. The unpack directory
+                  also holds the build steps' trees, so only these and the
+                  source directory go into the prepared pack.
+    mirrors - other URLs for the same archive, parameterized like url.
+              If there are any, all of the URLs are probed at the same time
+              with a small ranged read, and the download starts with the
+              fastest, also counting the throughput remembered from earlier
+              downloads in <cache_dir>/mirrors.json. If a download fails,
+              it carries on from the next URL.
+    probe_size - the number of bytes to read when probing a URL
+    fetched_from - the URL that the download finished from
+    stamp_file - written once the source is completely unpacked and
+                 patched, and removed when a fetch starts, see is_fetched.
+                 A fetch whose stamp matches is skipped unless build
+                 --force is given.
+    git_repository - the URL of a git repository, to fetch the commit that
+                     git_ref, a branch or tag, names in it. The commit is
+                     looked up with git ls-remote and can be used in url
+                     and tarball_source_dir as {commit}, e.g. a Github
+                     archive URL. If git can't reach the repository, the
+                     commit of the last fetch is used.
+    commit - the commit git_ref resolved to
     '''
     user_options = [
         ( 'package-name', None, 'Name of the package being fetched' ),
@@ -208,17 +2525,36 @@ class FetchSource(setuptools.Command, object):
         ( 'full-name', None, "Package name + version" ),
         ( 'version' , None, 'Revision # of the package' ),
         ( 'url', None, 'URL to download the package' ),
+        ( 'mirrors=', None, 'Comma-separated alternative URLs' ),
         ( 'unpack-dir', None, 'Where to unpack the source' ),
         ( 'source-dir', None, 'Where the package will be after unpacking'),
         ( 'tarball-source-dir', None, 'The top-level directory of the tarball'),
         ( 'post-fetch', None, 'Callable to run after unpacking' ),
-        ( 'member-filter', None, 'Function to filter tarball members' )
+        ( 'member-filter', None, 'Function to filter tarball members' ),
+        ( 'sha256=', None, 'Expected SHA-256 digest of the archive' ),
+        ( 'retries=', None, 'Number of times to retry a failed download' ),
+        ( 'retry-delay=', None,
+          'Seconds to wait before the first retry, doubled on each retry' ),
+        ( 'timeout=', None, 'Seconds to wait for the server to send data' ),
+        ( 'buffer-size=', None, 'Bytes to transfer at a time' ),
+        ( 'stream-extract', None, 'Unpack tarballs while downloading' ),
+        ( 'extract-workers=', None, 'Number of threads writing unpacked files' ),
+        ( 'decompressor=', None,
+          'Program to decompress tarballs with or "python" '
+          '[default: fastest installed]' ),
+        ( 'cache-dir=', None, 'Directory for caches shared between builds'),
+        ( 'git-repository=', None, 'Git repository to resolve git-ref in' ),
+        ( 'git-ref=', None, 'Branch or tag to fetch the commit of' )
         ]
+    boolean_options = ['stream-extract']
+    
     def initialize_options(self):
         #
         # attributes fetched from build command
         #
         self.build_lib = None
+        self.cache_dir = None
+        self.stream_extract = None
         #
         # command attributes
         #
@@ -227,24 +2563,49 @@ class FetchSource(setuptools.Command, object):
         self.full_name = None
         self.version = None
         self.url = None
+        self.mirrors = None
+        self.probe_size = None
+        self.fetched_from = None
         self.unpack_dir = None
         self.source_dir = None
 	self.tarball_source_dir = None
         self.post_fetch = None
         self.member_filter = None
+        self.sha256 = None
+        self.cacheable = True
+        self.retries = None
+        self.retry_delay = None
+        self.timeout = None
+        self.buffer_size = None
+        self.extract_workers = None
+        self.decompressor = None
+        self.decompressed_with = None
+        self.bytes_downloaded = 0
+        self.archive_digest = None
+        self.extra_paths = []
+        self.stamp_file = None
+        self.force = None
+        self.git_repository = None
+        self.git_ref = None
+        self.commit = None
+        self.git_error = None
         
     def finalize_options(self):
         self.set_undefined_options(
-            'build', ('build_lib', 'build_lib'))
+            'build', ('build_lib', 'build_lib'), ('cache_dir', 'cache_dir'),
+            ('stream_extract', 'stream_extract'), ('force', 'force'))
+        if self.stamp_file is None:
+            self.stamp_file = os.path.join(
+                self.build_lib, "stamps", self.get_step_name() + ".json")
+        if self.git_repository is not None and self.commit is None:
+            self.commit = self.resolve_git_ref()
         if self.package_name is None:
             # "fetch_foo" has a default package name of "foo"
-            for key, value in self.distribution.command_obj.iteritems():
-                if value == self:
-                    self.package_name = key.rpartition("_")[-1]
-                    break
-            else:
+            step_name = self.get_step_name()
+            if "_" not in step_name:
                 raise DistutilsSetupError(
                     "package-name must be defined")
+            self.package_name = step_name.rpartition("_")[-1]
         if self.github_owner is None:
             self.github_owner = self.package_name
         if self.version is None and self.full_name is None:
@@ -260,6 +2621,18 @@ class FetchSource(setuptools.Command, object):
         elif self.url is None:
             self.url = "https://github.com/{github_owner}/{package_name}/archive/{version}.tar.gz"
         self.url = self.url.format(**self.__dict__)
+        if self.mirrors is None:
+            self.mirrors = []
+        elif isinstance(self.mirrors, basestring):
+            self.mirrors = [mirror.strip()
+                            for mirror in self.mirrors.split(",")]
+        self.urls = [self.url]
+        for mirror in self.mirrors:
+            mirror = mirror.format(**self.__dict__)
+            if mirror not in self.urls:
+                self.urls.append(mirror)
+        self.probe_size = 64 * 1024 if self.probe_size is None \
+            else int(self.probe_size)
         if self.unpack_dir is None:
             self.unpack_dir = os.path.join(
                 self.build_lib, self.package_name)
@@ -269,52 +2642,1171 @@ class FetchSource(setuptools.Command, object):
             self.source_dir = os.path.join(
                 self.unpack_dir, self.full_name)
         else:
-            self.source_dir = self.source_dir.format(**self.__dict__)
-	if self.tarball_source_dir is None:
-	    self.tarball_source_dir = self.source_dir
+            self.source_dir = self.source_dir.format(**self.__dict__)
+	if self.tarball_source_dir is None:
+	    self.tarball_source_dir = self.source_dir
+	else:
+	    self.tarball_source_dir = \
+	        self.tarball_source_dir.format(**self.__dict__)
+        self.retries = 5 if self.retries is None else int(self.retries)
+        self.retry_delay = \
+            1.0 if self.retry_delay is None else float(self.retry_delay)
+        self.timeout = 60.0 if self.timeout is None else float(self.timeout)
+        self.buffer_size = 256 * 1024 if self.buffer_size is None \
+            else int(self.buffer_size)
+        if self.extract_workers is not None:
+            self.extract_workers = int(self.extract_workers)
+        
+    def resolve_git_ref(self):
+        '''The commit that git_ref names in git_repository
+        
+        Tags are resolved to the commit they point at. If git isn't
+        installed or can't reach the repository, this is the commit of
+        the last fetch, so a fetched source can be built offline. Without
+        one, it is None and git_error says why, for run to raise.
+        '''
+        if self.git_ref is None:
+            raise DistutilsSetupError(
+                "git-ref must be defined with git-repository")
+        git = distutils.spawn.find_executable("git")
+        error = "git is not installed"
+        if git is not None:
+            try:
+                process = subprocess.Popen(
+                    [git, "ls-remote", self.git_repository, self.git_ref],
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                output, error = process.communicate()
+            except OSError as e:
+                process = None
+                error = str(e)
+            if process is not None and process.returncode == 0:
+                refs = dict([line.split("\t")[::-1]
+                             for line in output.splitlines() if "\t" in line])
+                for ref in ("refs/heads/%s", "refs/tags/%s^{}",
+                            "refs/tags/%s", "%s"):
+                    ref = ref % self.git_ref
+                    if ref in refs:
+                        return refs[ref]
+                raise DistutilsError("%s has no branch or tag %s" %
+                                     (self.git_repository, self.git_ref))
+        stamp = self.read_stamp()
+        if stamp.get("commit") is None:
+            self.git_error = "Can't find the commit of %s in %s: %s" % (
+                self.git_ref, self.git_repository, error.strip())
+            self.announce(self.git_error, 3)
+            return None
+        self.announce("Can't reach %s, using %s from the last fetch: %s" % (
+            self.git_repository, stamp["commit"], error.strip()), 3)
+        return stamp["commit"]
+        
+    def run(self):
+        if not self.force and self.is_fetched():
+            self.announce("skipping %s (already fetched)" %
+                          self.get_step_name(), 2)
+            self.skipped = True
+            return
+        if self.git_error is not None:
+            raise DistutilsError(self.git_error)
+        #
+        # A fetch that fails or is interrupted leaves no stamp
+        #
+        if os.path.exists(self.stamp_file):
+            os.remove(self.stamp_file)
+        if not os.path.exists(self.source_dir):
+            os.makedirs(self.source_dir)
+        pack = self.get_prepared_pack()
+        if pack is not None:
+            with self.phase("restore"):
+                self.restore_prepared(pack)
+            self.write_stamp()
+            return
+        archive = self.get_cached_archive()
+        if archive is None and self.stream_extract and \
+           not self.get_archive_name().lower().endswith(".zip"):
+            with self.phase("download and extract"):
+                self.fetch_and_extract()
+        else:
+            if archive is None:
+                with self.phase("download"):
+                    archive = self.get_archive()
+            with self.phase("extract"):
+                self.extract_archive(archive)
+	tarball_source_dir = os.path.join(
+	    self.unpack_dir, self.tarball_source_dir)
+	if self.source_dir != self.tarball_source_dir:
+	    if os.path.isdir(self.source_dir):
+		shutil.rmtree(self.source_dir)
+	    shutil.move(tarball_source_dir, self.source_dir)
+        if self.post_fetch is not None:
+            with self.phase("patch"):
+                self.post_fetch(self)
+        if not self.dry_run:
+            with self.phase("store prepared"):
+                self.store_prepared()
+        self.write_stamp()
+    
+    def write_stamp(self):
+        '''Record that the source is completely unpacked and patched'''
+        if self.dry_run:
+            return
+        stamp_dir = os.path.dirname(self.stamp_file)
+        if not os.path.isdir(stamp_dir):
+            try:
+                os.makedirs(stamp_dir)
+            except OSError:
+                if not os.path.isdir(stamp_dir):
+                    raise
+        with open(self.stamp_file, "w") as fd:
+            json.dump(dict(self.get_stamp_key(), commit=self.commit,
+                           finished=time.time()), fd)
+    
+    def get_stamp_key(self):
+        '''What the stamp of a finished fetch has to match
+        
+        The URL names the archive, with its commit if git_repository is
+        given, and the patches are the ones post_fetch applies now.
+        '''
+        return dict(url=self.url,
+                    source_dir=os.path.abspath(self.source_dir),
+                    member_filter=describe_callable(self.member_filter),
+                    post_fetch=describe_callable(self.post_fetch))
+    
+    def read_stamp(self):
+        '''The stamp of the last finished fetch or an empty dictionary'''
+        if not os.path.isfile(self.stamp_file):
+            return {}
+        try:
+            with open(self.stamp_file, "r") as fd:
+                return json.load(fd)
+        except (IOError, ValueError):
+            return {}
+    
+    def is_fetched(self):
+        '''Whether the last fetch of this source into source_dir finished'''
+        if not os.path.isdir(self.source_dir):
+            return False
+        stamp = self.read_stamp()
+        return all([stamp.get(name) == value
+                    for name, value in self.get_stamp_key().items()])
+            
+    def get_archive_digest(self):
+        '''The archive's SHA-256 digest if known, otherwise None
+        
+        Before the step has run, the digest is known if it is pinned by the
+        sha256 option or recorded by the download cache.
+        '''
+        digest = self.sha256 or self.archive_digest
+        cache_path = self.get_cache_path()
+        if digest is None and cache_path is not None and \
+           os.path.isfile(cache_path + ".sha256"):
+            with open(cache_path + ".sha256", "r") as fd:
+                digest = fd.read().strip()
+        return None if digest is None else digest.lower()
+    
+    def get_prepared_base(self):
+        '''The path, less its extension, of the prepared pack or None
+        
+        The pack is keyed by everything that goes into it: the archive,
+        how it is laid out, what the member_filter and post_fetch do and
+        which paths are packed.
+        '''
+        if not self.cacheable or self.cache_dir is None:
+            return None
+        digest = self.get_archive_digest()
+        if digest is None:
+            return None
+        key = hashlib.sha256(json.dumps(dict(
+            archive=digest,
+            platform=sys.platform,
+            source_dir=os.path.relpath(self.source_dir, self.unpack_dir),
+            tarball_source_dir=os.path.relpath(
+                os.path.join(self.unpack_dir, self.tarball_source_dir),
+                self.unpack_dir),
+            member_filter=describe_callable(self.member_filter),
+            post_fetch=describe_callable(self.post_fetch),
+            paths=self.get_prepared_paths()),
+            sort_keys=True)).hexdigest()
+        return os.path.join(self.cache_dir, "prepared", key[:2], key)
+    
+    def get_prepared_paths(self):
+        '''The paths that go into the prepared pack, relative to unpack_dir'''
+        return [os.path.relpath(path, self.unpack_dir)
+                for path in [self.source_dir] + list(self.extra_paths)]
+    
+    def get_prepared_pack(self):
+        '''The path to the prepared pack for this fetch or None'''
+        base = self.get_prepared_base()
+        if base is None or not os.path.isfile(base + ".json"):
+            return None
+        extensions = [".tar"]
+        if self.decompressor != "python" and \
+           find_decompressor(".tar.zst") is not None:
+            extensions.append(".tar.zst")
+        for extension in extensions:
+            if os.path.isfile(base + extension):
+                return base + extension
+        return None
+    
+    def restore_prepared(self, pack):
+        '''Unpack the prepared pack into the unpack directory'''
+        self.announce("Using prepared copy of " + self.url, 2)
+        with open(self.get_prepared_base() + ".json", "r") as fd:
+            metadata = json.load(fd)
+        extractor = ArchiveExtractor(
+            self.unpack_dir, workers=self.extract_workers,
+            buffer_size=self.buffer_size)
+        start_time = time.time()
+        self.extract_tarball(extractor, pack, os.path.basename(pack))
+        self.announce_extraction(extractor, start_time)
+        self.archive_digest = metadata["archive_digest"]
+        self.patched_files = metadata["patched_files"]
+        self.restored = True
+    
+    def store_prepared(self):
+        '''Pack the source directory and extra_paths into the prepared cache
+        
+        Failing to do so is only a warning, since the source is unpacked.
+        '''
+        base = self.get_prepared_base()
+        if base is None:
+            return
+        zstd = distutils.spawn.find_executable("zstd")
+        path = base + (".tar" if zstd is None else ".tar.zst")
+        part_path = None
+        start_time = time.time()
+        try:
+            names = self.get_prepared_paths()
+            for name in names:
+                if name.startswith(os.pardir):
+                    raise DistutilsError(
+                        "%s is outside %s" % (name, self.unpack_dir))
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    # Another build might have made it
+                    if not os.path.isdir(os.path.dirname(path)):
+                        raise
+            fd, part_path = tempfile.mkstemp(
+                dir=os.path.dirname(path), suffix=".part")
+            with os.fdopen(fd, "wb") as fd:
+                if zstd is None:
+                    process = None
+                    tarball = tarfile.open(fileobj=fd, mode="w|")
+                else:
+                    process = subprocess.Popen(
+                        [zstd, "-q", "-c"], stdin=subprocess.PIPE, stdout=fd)
+                    tarball = tarfile.open(fileobj=process.stdin, mode="w|")
+                try:
+                    for name in names:
+                        full_path = os.path.join(self.unpack_dir, name)
+                        if os.path.exists(full_path):
+                            tarball.add(full_path, name)
+                finally:
+                    tarball.close()
+                    if process is not None:
+                        process.stdin.close()
+                        if process.wait() != 0:
+                            raise DistutilsError("zstd failed")
+            replace_file(part_path, path)
+            fd, part_path = tempfile.mkstemp(
+                dir=os.path.dirname(path), suffix=".part")
+            with os.fdopen(fd, "w") as fd:
+                json.dump(dict(archive_digest=self.archive_digest,
+                               patched_files=getattr(
+                                   self, "patched_files", None)),
+                          fd, indent=2, sort_keys=True)
+            replace_file(part_path, base + ".json")
+        except (IOError, OSError, DistutilsError) as e:
+            self.announce("Couldn't store the prepared source of %s: %s" %
+                          (self.url, e), 3)
+            if part_path is not None and os.path.exists(part_path):
+                os.remove(part_path)
+            return
+        elapsed = max(time.time() - start_time, .001)
+        self.announce("Stored prepared source in %s (%.1f MB) in %.1f sec" %
+                      (path, os.path.getsize(path) / 1e6, elapsed), 2)
+            
+    def extract_archive(self, archive):
+        '''Unpack the archive into the unpack directory'''
+        extractor = self.make_extractor()
+        start_time = time.time()
+        if archive.lower().endswith(".zip"):
+            tarball = zipfile.ZipFile(archive)
+            extractor.extract_zip(tarball)
+            tarball.close()
+        else:
+            self.extract_tarball(extractor, archive)
+        self.announce_extraction(extractor, start_time)
+        
+    def get_decompressor(self, archive_name=None):
+        '''The command line for decompressing the tarball or None
+        
+        archive_name - the name of the file, which picks the format.
+                       Defaults to the name of the archive being fetched.
+        
+        None means that Python's tarfile module decompresses it.
+        '''
+        if archive_name is None:
+            archive_name = self.get_archive_name()
+        if self.decompressor == "python":
+            command = None
+        else:
+            command = find_decompressor(archive_name, self.decompressor)
+            if command is None and self.decompressor is not None:
+                self.announce("%s is not installed, decompressing %s with "
+                              "Python" % (self.decompressor, archive_name), 3)
+        if command is None and \
+           archive_name.lower().endswith((".zst", ".tzst")):
+            raise DistutilsError(
+                "zstd must be installed to unpack " + archive_name)
+        return command
+        
+    def extract_tarball(self, extractor, source, archive_name=None):
+        '''Unpack a tarball, decompressing it with get_decompressor
+        
+        source - the tarball's path or a file-like object to stream it from
+        archive_name - the tarball's file name, if it isn't the archive
+                       being fetched
+        '''
+        command = self.get_decompressor(archive_name)
+        start_time = time.time()
+        if command is None:
+            self.decompressed_with = "python"
+            if isinstance(source, basestring):
+                tarball = tarfile.open(source)
+            else:
+                tarball = tarfile.open(fileobj=source, mode="r|*")
+            extractor.extract_tar(tarball)
+            tarball.close()
+        else:
+            self.decompressed_with = os.path.basename(command[0])
+            pipe = DecompressorPipe(command, source, self.buffer_size)
+            try:
+                tarball = tarfile.open(fileobj=pipe.stdout, mode="r|")
+                extractor.extract_tar(tarball)
+                tarball.close()
+            except tarfile.TarError:
+                # The decompressor says why better if the archive is corrupt
+                exc_info = sys.exc_info()
+                pipe.close()
+                raise exc_info[0], exc_info[1], exc_info[2]
+            except:
+                exc_info = sys.exc_info()
+                pipe.abort()
+                raise exc_info[0], exc_info[1], exc_info[2]
+            pipe.close()
+        if isinstance(source, basestring):
+            compressed_size = os.path.getsize(source)
+        else:
+            compressed_size = source.bytes_read
+        elapsed = max(time.time() - start_time, .001)
+        self.announce("Decompressed %.1f MB with %s in %.1f sec (%.2f MB/sec)"
+                      % (compressed_size / 1e6, self.decompressed_with,
+                         elapsed, compressed_size / 1e6 / elapsed), 2)
+        
+    def make_extractor(self):
+        return ArchiveExtractor(self.unpack_dir, self.member_filter,
+                                self.extract_workers, self.buffer_size)
+    
+    def announce_extraction(self, extractor, start_time):
+        self.bytes_written += extractor.bytes_written
+        elapsed = max(time.time() - start_time, .001)
+        self.announce(
+            "Unpacked %d files (%.1f MB) in %.1f sec (%.0f files/sec)" %
+            (extractor.files_written, extractor.bytes_written / 1e6,
+             elapsed, extractor.files_written / elapsed), 2)
+        
+    def fetch_and_extract(self):
+        '''Unpack a tarball as it downloads
+        
+        The download is fed straight into tarfile's stream mode. If the
+        archive is cacheable, the downloaded bytes are also copied into
+        the download cache.
+        '''
+        cache_path = self.get_cache_path()
+        if cache_path is not None:
+            #
+            # Other builds may be downloading the same archive into the
+            # cache, so each one writes its own file.
+            #
+            self.make_cache_entry_dir(cache_path)
+            fd, part_path = tempfile.mkstemp(
+                dir=os.path.dirname(cache_path),
+                prefix=os.path.basename(cache_path) + ".", suffix=".part")
+            tee = os.fdopen(fd, "wb")
+        else:
+            tee = None
+        start_time = time.time()
+        extractor = self.make_extractor()
+        try:
+            try:
+                reader = ChunkReader(self.iter_download(), tee)
+                self.extract_tarball(extractor, reader)
+                # Read any padding after the end of the archive for the digest
+                reader.read()
+            finally:
+                if tee is not None:
+                    tee.close()
+            self.announce_throughput(start_time)
+            self.announce_extraction(extractor, start_time)
+            digest = reader.sha256.hexdigest()
+            if self.sha256 is not None and digest != self.sha256.lower():
+                raise DistutilsError(
+                    "SHA-256 digest of %s is %s, expected %s" %
+                    (self.url, digest, self.sha256))
+        except BaseException:
+            if cache_path is not None:
+                os.remove(part_path)
+            raise
+        self.archive_digest = digest
+        if cache_path is not None:
+            replace_file(part_path, cache_path)
+            self.write_cached_digest(cache_path, digest)
+            
+    def get_source_identity(self):
+        '''What identifies the unpacked source in every checkout
+        
+        This is None if the source can change, or the step hasn't run
+        yet and the archive's digest isn't pinned by the sha256 option or
+        known from the download cache.
+        '''
+        digest = self.get_archive_digest()
+        if not self.cacheable or digest is None:
+            return None
+        return dict(
+            archive=digest,
+            full_name=self.full_name,
+            source_dir=os.path.relpath(self.source_dir, self.build_lib),
+            tarball_source_dir=os.path.relpath(
+                os.path.join(self.unpack_dir, self.tarball_source_dir),
+                self.build_lib),
+            member_filter=describe_callable(self.member_filter),
+            post_fetch=describe_callable(self.post_fetch))
+    
+    def get_archive_name(self):
+        '''The file name of the archive, taken from the URL'''
+        return urlparse.urlparse(self.url).path.rpartition('/')[-1]
+            
+    def get_cache_path(self):
+        '''The archive's path in the download cache or None if not cached
+        
+        The cache entry for a URL that isn't pinned by a digest records
+        the digest of the first download, so that later cache hits can
+        be checked against it.
+        '''
+        if not self.cacheable or self.cache_dir is None:
+            return None
+        key = hashlib.sha256(self.url + "\n" + (self.sha256 or "")).hexdigest()
+        return os.path.join(self.cache_dir, "downloads", key[:2], key,
+                            self.get_archive_name())
+    
+    def make_cache_entry_dir(self, cache_path):
+        cache_entry = os.path.dirname(cache_path)
+        if not os.path.isdir(cache_entry):
+            try:
+                os.makedirs(cache_entry)
+            except OSError:
+                # Another build might have made it
+                if not os.path.isdir(cache_entry):
+                    raise
+    
+    def get_cached_archive(self):
+        '''The path to a valid copy of the archive in the cache or None'''
+        cache_path = self.get_cache_path()
+        if cache_path is None:
+            return None
+        digest_path = cache_path + ".sha256"
+        if os.path.isfile(cache_path) and os.path.isfile(digest_path):
+            with open(digest_path, "r") as fd:
+                expected_digest = fd.read().strip()
+            if file_sha256(cache_path) == expected_digest:
+                self.announce("Using cached copy of " + self.url, 2)
+                self.archive_digest = expected_digest
+                return cache_path
+            self.announce("Discarding corrupt cached copy of " + self.url, 3)
+        return None
+        
+    def get_archive(self):
+        '''Download the archive, into the download cache if cacheable
+        
+        Returns the path to the archive.
+        '''
+        target = self.get_cache_path()
+        if target is None:
+            target = os.path.join(os.path.dirname(self.source_dir),
+                                  self.get_archive_name())
+            self.download(target)
+            self.archive_digest = self.verify_download(target)
+            return target
+        self.make_cache_entry_dir(target)
+        self.download(target)
+        try:
+            digest = self.verify_download(target)
+        except DistutilsError:
+            os.remove(target)
+            raise
+        self.archive_digest = digest
+        self.write_cached_digest(target, digest)
+        return target
+    
+    def write_cached_digest(self, cache_path, digest):
+        '''Record the digest of an archive in the download cache
+        
+        The file is replaced in one go, so other builds never read half
+        of it. If the digest isn't pinned, the warning gives it, so that
+        it can be copied into the step's options in setup.py.
+        '''
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+        with os.fdopen(fd, "w") as fd:
+            fd.write(digest)
+        replace_file(tmp_path, cache_path + ".sha256")
+        if self.sha256 is None:
+            self.announce("%s: the digest of %s is not pinned, downloaded "
+                          "'sha256': '%s'" %
+                          (self.get_step_name(), self.url, digest), 3)
+    
+    def verify_download(self, path):
+        '''Check the downloaded archive against the sha256 option
+        
+        Returns the archive's SHA-256 digest.
+        '''
+        digest = file_sha256(path)
+        if self.sha256 is not None and digest != self.sha256.lower():
+            raise DistutilsError(
+                "SHA-256 digest of %s is %s, expected %s" %
+                (self.url, digest, self.sha256))
+        return digest
+        
+    def download(self, target):
+        '''Download the URL to the target path
+        
+        Each download writes into its own directory next to the target,
+        so builds that share the download cache don't get in each other's
+        way, and the file is moved to the target once complete. An
+        interrupted download is left in target + ".partial" for the next
+        one to pick up where it left off. It is only resumed if the
+        archive's digest is pinned, which catches a mismatched splice, or
+        if the server confirms with If-Range that the data hasn't changed.
+        '''
+        work_dir = tempfile.mkdtemp(
+            dir=os.path.dirname(target),
+            prefix=os.path.basename(target) + ".", suffix=".download")
+        part_path = os.path.join(work_dir, "data")
+        try:
+            validators = self.claim_partial(target, work_dir)
+            if os.path.exists(part_path):
+                offset = os.path.getsize(part_path)
+            else:
+                offset = 0
+            start_time = time.time()
+            try:
+                try:
+                    with open(part_path, "ab") as fd:
+                        for chunk in self.iter_download(offset, validators):
+                            fd.write(chunk)
+                except SourceChanged as e:
+                    self.announce("%s, starting over" % e, 3)
+                    with open(part_path, "wb") as fd:
+                        for chunk in self.iter_download():
+                            fd.write(chunk)
+            except BaseException:
+                self.park_partial(target, work_dir)
+                raise
+            replace_file(part_path, target)
+            self.announce_throughput(start_time)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    
+    def claim_partial(self, target, work_dir):
+        '''Take over an interrupted download of the target if it can resume
+        
+        The partial data is moved to work_dir/data. Returns the validators
+        recorded with it, see iter_download, or None if there's nothing to
+        resume.
+        '''
+        claimed = os.path.join(work_dir, "partial")
+        try:
+            #
+            # Renaming is atomic, so only one build gets the partial data
+            #
+            os.rename(target + ".partial", claimed)
+        except OSError:
+            return None
+        try:
+            with open(os.path.join(claimed, "validators.json"), "r") as fd:
+                validators = json.load(fd)
+        except (IOError, ValueError):
+            validators = {}
+        if self.sha256 is None and not validators:
+            return None
+        try:
+            os.rename(os.path.join(claimed, "data"),
+                      os.path.join(work_dir, "data"))
+        except OSError:
+            return None
+        return validators
+    
+    def park_partial(self, target, work_dir):
+        '''Leave an interrupted download for the next one to resume'''
+        part_path = os.path.join(work_dir, "data")
+        validators = getattr(self, "download_validators", None)
+        if not os.path.isfile(part_path) or \
+           os.path.getsize(part_path) == 0 or \
+           (self.sha256 is None and not validators):
+            return
+        parked = os.path.join(work_dir, "parked")
+        try:
+            os.mkdir(parked)
+            with open(os.path.join(parked, "validators.json"), "w") as fd:
+                json.dump(validators or {}, fd)
+            os.rename(part_path, os.path.join(parked, "data"))
+            os.rename(parked, target + ".partial")
+        except (IOError, OSError):
+            # e.g. another build already left a partial download
+            pass
+        
+    def announce_throughput(self, start_time):
+        elapsed = max(time.time() - start_time, .001)
+        self.announce(
+            "Fetched %s: %.1f MB in %.1f sec (%.2f MB/sec)" % 
+            (self.fetched_from or self.url, self.bytes_downloaded / 1e6,
+             elapsed,
+             self.bytes_downloaded / 1e6 / elapsed), 2)
+        
+    def get_mirror_stats(self):
+        if self.cache_dir is None:
+            return None
+        return MirrorStats(os.path.join(self.cache_dir, "mirrors.json"))
+    
+    def probe_mirror(self, url):
+        '''Time reading the start of the archive from a URL
+        
+        Returns the bytes per second, counting the time to connect, or None
+        if the URL failed.
+        '''
+        start_time = time.time()
+        received = 0
+        try:
+            stream = UrlStream(url, 0, self.timeout, end=self.probe_size)
+            try:
+                for chunk in stream.chunks(self.buffer_size):
+                    received += len(chunk)
+                    if received >= self.probe_size:
+                        break
+            finally:
+                stream.close()
+        except IOError:
+            return None
+        if received == 0:
+            return None
+        return received / max(time.time() - start_time, .001)
+    
+    def get_mirror_order(self):
+        '''The URLs to try, fastest first'''
+        if len(self.urls) == 1:
+            return list(self.urls)
+        probes = {}
+        def probe(url):
+            probes[url] = self.probe_mirror(url)
+        threads = [threading.Thread(target=probe, args=(url,))
+                   for url in self.urls]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = self.get_mirror_stats()
+        scores = {}
+        for url in self.urls:
+            remembered = None if stats is None else stats.get_throughput(url)
+            if probes[url] is None:
+                # Keep URLs that failed the probe as a last resort
+                scores[url] = -1
+                if stats is not None:
+                    stats.record_failure(url)
+            elif remembered is None:
+                scores[url] = probes[url]
+            else:
+                scores[url] = (probes[url] + remembered) / 2
+        urls = sorted(self.urls, key=lambda url: scores[url], reverse=True)
+        self.announce("Mirrors of %s, fastest first:" %
+                      self.get_archive_name(), 2)
+        for url in urls:
+            if scores[url] < 0:
+                self.announce("    %s: failed" % url, 2)
+            else:
+                self.announce("    %s: %.2f MB/sec" % (url, scores[url] / 1e6),
+                              2)
+        return urls
+        
+    def iter_download(self, offset=0, validators=None):
+        '''Iterate over the URL's data, starting at the given byte offset
+        
+        A transfer that breaks partway through is resumed with a range
+        request. If the server doesn't support ranges, the transfer
+        restarts and the data before the offset is skipped. Transient
+        errors are retried with exponential backoff. If there are mirrors,
+        each retry goes to the next one, and a mirror that fails for good
+        is dropped. The backoff only applies once every mirror has been
+        tried.
+        
+        validators - a dictionary of URL to the validator of the data
+                     before the offset, see get_validator. Resuming from
+                     one of those URLs sends it in If-Range, and
+                     SourceChanged is raised if the data has changed.
+        
+        The validators of the data received so far are kept in
+        self.download_validators.
+        '''
+        urls = self.get_mirror_order()
+        url = urls[0]
+        stats = self.get_mirror_stats()
+        validators = dict(validators or {})
+        self.download_validators = validators
+        attempt = 0
+        while True:
+            start_time = time.time()
+            length = 0
+            try:
+                with download_manager.transfer(url) as transfer:
+                    stream = UrlStream(url, offset, self.timeout,
+                                       if_range=validators.get(url))
+                    try:
+                        if offset > 0 and stream.offset == 0 and \
+                           url in validators and \
+                           stream.validator != validators[url]:
+                            raise SourceChanged(
+                                "%s changed after %d bytes were downloaded"
+                                % (url, offset))
+                        if stream.validator is not None:
+                            validators[url] = stream.validator
+                        if stream.offset > 0:
+                            self.announce("Resuming %s at byte %d" %
+                                          (url, stream.offset), 2)
+                        transfer["expected"] = stream.length
+                        skip = offset - stream.offset
+                        for chunk in stream.chunks(self.buffer_size):
+                            length += len(chunk)
+                            self.bytes_downloaded += len(chunk)
+                            transfer["received"] = length
+                            download_manager.report_progress()
+                            if skip >= len(chunk):
+                                skip -= len(chunk)
+                                continue
+                            elif skip > 0:
+                                chunk = chunk[skip:]
+                                skip = 0
+                            offset += len(chunk)
+                            yield chunk
+                    finally:
+                        stream.close()
+                if stream.length is not None and length != stream.length:
+                    raise IOError("connection closed after %d of %d bytes" %
+                                  (stream.offset + length,
+                                   stream.offset + stream.length))
+                if stats is not None:
+                    stats.record(url, length, time.time() - start_time)
+                self.fetched_from = url
+                return
+            except IOError as e:
+                if stats is not None:
+                    stats.record(url, length, time.time() - start_time)
+                    if len(urls) > 1:
+                        stats.record_failure(url)
+                if not is_transient_error(e):
+                    urls.remove(url)
+                    if len(urls) == 0:
+                        raise DistutilsError(
+                            "Failed to download %s: %s" % (url, e))
+                    self.announce("Can't download %s (%s), trying %s" %
+                                  (url, e, urls[0]), 3)
+                    url = urls[0]
+                    continue
+                if attempt == self.retries:
+                    raise DistutilsError(
+                        "Failed to download %s: %s" % (url, e))
+                next_url = urls[(urls.index(url) + 1) % len(urls)]
+                if next_url == urls[0]:
+                    delay = self.retry_delay * 2 ** attempt
+                else:
+                    delay = 0
+                attempt += 1
+                if next_url == url:
+                    self.announce(
+                        "Download of %s interrupted (%s), retrying in %g sec"
+                        % (url, e, delay), 3)
+                else:
+                    self.announce(
+                        "Download from %s interrupted (%s), continuing from "
+                        "%s in %g sec" % (url, e, next_url, delay), 3)
+                time.sleep(delay)
+                url = next_url
+        
+def make_synthetic_archive(path, files, file_size, top_dir="synthetic"):
+    '''Write a tarball or zip file full of small, compressible files
+    
+    path - the archive to write. The extension picks the format: .zip,
+           .tar, .tar.gz or .tar.bz2.
+    files - the number of files in the archive, 100 to a directory
+    file_size - the size of each file in bytes
+    top_dir - the directory in the archive that holds everything
+    '''
+    line = "int synthetic_function_%08d(int x) { return x * %d; }\n"
+    def contents(index):
+        data = "".join([line % (index, i) for i in range(
+            file_size / len(line % (0, 0)) + 1)])
+        return data[:file_size]
+    names = ["%s/d%04d/f%06d.c" % (top_dir, i / 100, i) for i in range(files)]
+    if path.lower().endswith(".zip"):
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            for i, name in enumerate(names):
+                zip_file.writestr(name, contents(i))
+        return
+    mode = "w"
+    for extension, compression in ((".gz", ":gz"), (".bz2", ":bz2")):
+        if path.lower().endswith(extension):
+            mode += compression
+    tarball = tarfile.open(path, mode)
+    try:
+        for i, name in enumerate(names):
+            data = contents(i)
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            tarball.addfile(info, StringIO.StringIO(data))
+    finally:
+        tarball.close()
+    
+class BenchmarkExtract(setuptools.Command):
+    '''Time ArchiveExtractor against tarfile's and zipfile's extractall
+    
+    Each archive format is unpacked both ways from the same synthetic
+    archive.
+    '''
+    command_name = "bench_extract"
+    description = "compare parallel archive extraction with extractall"
+    user_options = [
+        ("files=", None, "Number of files in each archive [default: 50000]"),
+        ("file-size=", None, "Size of each file in bytes [default: 2048]"),
+        ("formats=", None,
+         "Comma-separated archive formats [default: tar,tar.gz,tar.bz2,zip]"),
+        ("workers=", None, "Number of extraction threads"),
+        ("work-dir=", None, "Directory for the archives and unpacked files")]
+    
+    def initialize_options(self):
+        self.files = None
+        self.file_size = None
+        self.formats = None
+        self.workers = None
+        self.work_dir = None
+        
+    def finalize_options(self):
+        self.files = 50000 if self.files is None else int(self.files)
+        self.file_size = 2048 if self.file_size is None \
+            else int(self.file_size)
+        if self.formats is None:
+            self.formats = "tar,tar.gz,tar.bz2,zip"
+        self.formats = self.formats.split(",")
+        if self.workers is not None:
+            self.workers = int(self.workers)
+        
+    def run(self):
+        work_dir = self.work_dir or tempfile.mkdtemp()
+        try:
+            for archive_format in self.formats:
+                archive = os.path.join(work_dir, "synthetic." + archive_format)
+                self.announce("Writing %s" % archive, 2)
+                make_synthetic_archive(archive, self.files, self.file_size)
+                times = []
+                for method in (self.extractall, self.extract_parallel):
+                    dest = os.path.join(work_dir, "unpacked")
+                    start_time = time.time()
+                    method(archive, dest)
+                    times.append(time.time() - start_time)
+                    shutil.rmtree(dest)
+                os.remove(archive)
+                self.announce(
+                    "%-8s extractall %7.2f sec (%6.0f files/sec), "
+                    "ArchiveExtractor %7.2f sec (%6.0f files/sec), "
+                    "speedup %.2fx" %
+                    (archive_format, times[0], self.files / times[0],
+                     times[1], self.files / times[1], times[0] / times[1]),
+                    2)
+        finally:
+            if self.work_dir is None:
+                shutil.rmtree(work_dir)
+                
+    def extractall(self, archive, dest):
+        if archive.endswith(".zip"):
+            tarball = zipfile.ZipFile(archive)
+        else:
+            tarball = tarfile.open(archive)
+        tarball.extractall(dest)
+        tarball.close()
+        
+    def extract_parallel(self, archive, dest):
+        extractor = ArchiveExtractor(dest, workers=self.workers)
+        if archive.endswith(".zip"):
+            tarball = zipfile.ZipFile(archive)
+            extractor.extract_zip(tarball)
+        else:
+            tarball = tarfile.open(archive)
+            extractor.extract_tar(tarball)
+        tarball.close()
+
+def make_synthetic_project(path, units):
+    '''Write a tarball of a C library project with many translation units
+    
+    path - the .tar.gz file to write
+    units - the number of source files
+    
+    The project builds with CMake or, on Windows, with NMake and
+    Makefile.vc.
+    '''
+    files = {}
+    for i in range(units):
+        files["synthetic/src/unit%05d.c" % i] = "".join([
+            "int synthetic_%05d_%d(int x) { return x * %d + %d; }\n" %
+            (i, j, i, j) for j in range(20)])
+    sources = sorted(files)
+    files["synthetic/CMakeLists.txt"] = (
+        "cmake_minimum_required(VERSION 2.8)\n"
+        "project(synthetic C)\n"
+        "file(GLOB SOURCES src/*.c)\n"
+        "add_library(synthetic STATIC ${SOURCES})\n"
+        "install(TARGETS synthetic ARCHIVE DESTINATION lib)\n")
+    objects = " ".join([os.path.splitext(os.path.basename(name))[0] + ".obj"
+                        for name in sources])
+    files["synthetic/Makefile.vc"] = (
+        "OBJS = %s\n"
+        "synthetic.lib: $(OBJS)\n"
+        "\tlib /nologo /out:synthetic.lib $(OBJS)\n"
+        "{src}.c.obj:\n"
+        "\t$(CC) /nologo /c $<\n" % objects)
+    tarball = tarfile.open(path, "w:gz")
+    try:
+        for name in sorted(files):
+            info = tarfile.TarInfo(name)
+            info.size = len(files[name])
+            info.mtime = time.time()
+            tarball.addfile(info, StringIO.StringIO(files[name]))
+    finally:
+        tarball.close()
+
+class Benchmark(setuptools.Command):
+    '''Time the fetch, unpack and build steps on synthetic fixtures
+    
+    Synthetic archives are served by a local HTTP server and fetched
+    with FetchSource, saving them first and, for tarballs, unpacking them
+    while they download. A small C project with many translation units
+    is built with BuildWithCMake and, where NMake is installed, with
+    BuildWithNMake. Building again measures the overhead of a step that
+    is up to date.
+    
+    The results are compared with a baseline from an earlier run. The
+    command fails if any result is worse than the baseline by more than
+    the tolerance.
+    '''
+    command_name = "benchmark"
+    description = "benchmark fetching, unpacking and building"
+    user_options = [
+        ("work-dir=", None, "Directory for the fixtures and results"),
+        ("baseline=", None,
+         "JSON file of earlier results [default: benchmark-baseline.json]"),
+        ("save-baseline", None, "Save the results as the new baseline"),
+        ("tolerance=", None,
+         "How much worse than the baseline a result may be, "
+         "as a fraction [default: 0.25]"),
+        ("scale=", None, "Multiplier for the size of the fixtures "
+         "[default: 1]"),
+        ("units=", None,
+         "Number of translation units in the C project [default: 200]")]
+    boolean_options = ["save-baseline"]
+    #
+    # Differences of less than this many seconds are noise
+    #
+    min_difference = 0.05
+    
+    def initialize_options(self):
+        self.work_dir = None
+        self.baseline = None
+        self.save_baseline = 0
+        self.tolerance = None
+        self.scale = None
+        self.units = None
+        
+    def finalize_options(self):
+        if self.baseline is None:
+            self.baseline = "benchmark-baseline.json"
+        self.tolerance = 0.25 if self.tolerance is None \
+            else float(self.tolerance)
+        self.scale = 1.0 if self.scale is None else float(self.scale)
+        self.units = 200 if self.units is None else int(self.units)
         
     def run(self):
-	import requests
-        self.announce("Fetching " + self.url)
-        up = urlparse.urlparse(self.url)
-        target = os.path.join(os.path.dirname(self.source_dir),
-                              up.path.rpartition('/')[-1])
-        if not os.path.exists(self.source_dir):
-            os.makedirs(self.source_dir)
-        if up.scheme == 'ftp':
-            fdsrc = urllib2.urlopen(self.url)
-            with open(target, "wb") as fd:
-                while True:
-                    data = fdsrc.read()
-                    if len(data) == 0:
-                        break
-                    fd.write(data)
+        import BaseHTTPServer
+        import SimpleHTTPServer
+        import SocketServer
+        work_dir = self.work_dir or tempfile.mkdtemp()
+        fixture_dir = os.path.join(work_dir, "fixtures")
+        if not os.path.isdir(fixture_dir):
+            os.makedirs(fixture_dir)
+        class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+            def translate_path(self, path):
+                return os.path.join(fixture_dir, path.lstrip("/"))
+            def log_message(self, *args):
+                pass
+        class Server(SocketServer.ThreadingMixIn,
+                     BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+        server = Server(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base_url = "http://127.0.0.1:%d/" % server.server_address[1]
+        self.results = []
+        try:
+            self.benchmark_fetches(work_dir, fixture_dir)
+            self.benchmark_builds(work_dir, fixture_dir)
+        finally:
+            server.shutdown()
+            server.server_close()
+            if self.work_dir is None:
+                shutil.rmtree(work_dir)
+        self.compare_with_baseline()
+        
+    def add_result(self, name, value, unit, higher_is_better):
+        self.results.append((name, value, unit, higher_is_better))
+        self.announce("%-40s %10.2f %s" % (name, value, unit), 2)
+        
+    def make_fetch(self, work_dir, archive_name, stream_extract):
+        fetch = FetchSource(self.distribution)
+        fetch.package_name = os.path.splitext(archive_name)[0]
+        fetch.full_name = "synthetic"
+        fetch.url = self.base_url + archive_name
+        fetch.build_lib = work_dir
+        fetch.unpack_dir = os.path.join(work_dir, "unpacked", archive_name)
+        fetch.stream_extract = stream_extract
+        fetch.cacheable = False
+        #
+        # Keep the local server's mirror statistics out of the user's cache
+        #
+        fetch.cache_dir = os.path.join(work_dir, "cache")
+        fetch.ensure_finalized()
+        return fetch
+    
+    def benchmark_fetches(self, work_dir, fixture_dir):
+        fixtures = [
+            ("small-files.tar.gz", int(5000 * self.scale), 2048),
+            ("large-files.tar.gz", 8, int(4 * 1024 * 1024 * self.scale)),
+            ("small-files.zip", int(5000 * self.scale), 2048),
+            ("one-file.tar.gz", 1, 1024)]
+        for archive_name, files, file_size in fixtures:
+            archive = os.path.join(fixture_dir, archive_name)
+            self.announce("Writing " + archive, 2)
+            make_synthetic_archive(archive, files, file_size)
+            modes = [0]
+            if not archive_name.endswith(".zip"):
+                modes.append(1)
+            for stream_extract in modes:
+                fetch = self.make_fetch(work_dir, archive_name, stream_extract)
+                start_time = time.time()
+                fetch.run()
+                elapsed = max(time.time() - start_time, .001)
+                shutil.rmtree(fetch.unpack_dir)
+                name = archive_name + (" streamed" if stream_extract else "")
+                if files == 1:
+                    self.add_result("fetch overhead " + name, elapsed, "sec",
+                                    False)
+                    continue
+                phases = dict(fetch.phase_times)
+                self.add_result("fetch " + name,
+                                fetch.bytes_downloaded / 1e6 / elapsed,
+                                "MB/sec", True)
+                if "extract" in phases:
+                    self.add_result(
+                        "unpack " + name,
+                        files / max(phases["extract"], .001), "files/sec",
+                        True)
+                    
+    def benchmark_builds(self, work_dir, fixture_dir):
+        archive_name = "project.tar.gz"
+        make_synthetic_project(
+            os.path.join(fixture_dir, archive_name), self.units)
+        fetch = self.make_fetch(work_dir, archive_name, 0)
+        fetch.run()
+        for path in ("cmake-build", "cmake-install", "stamps"):
+            path = os.path.join(work_dir, path)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        if distutils.spawn.find_executable("cmake") is not None:
+            for attempt in ("", " up to date"):
+                build = BuildWithCMake(self.distribution)
+                build.source_dir = fetch.source_dir
+                build.target_dir = os.path.join(work_dir, "cmake-build")
+                build.install_root = os.path.join(work_dir, "cmake-install")
+                build.stamp_file = os.path.join(
+                    work_dir, "stamps", "cmake.json")
+                build.ensure_finalized()
+                build.artifact_cache = None
+                build.scratch_dir = None
+                self.time_build("cmake" + attempt, build)
         else:
-            request = requests.get(self.url, stream=True)
-            with open(target, "wb") as fd:
-                for chunk in request.iter_content(chunk_size = 65536):
-                    fd.write(chunk)
-        members = None
-        if target.lower().endswith(".zip"):
-            tarball = zipfile.ZipFile(target)
-            if self.member_filter is not None:
-                members = filter(self.member_filter, tarball.namelist)
+            self.announce("CMake is not installed, skipping CMake builds", 3)
+        if distutils.spawn.find_executable("nmake") is not None:
+            for attempt in ("", " up to date"):
+                build = BuildWithNMake(self.distribution)
+                build.source_dir = fetch.source_dir
+                build.makefile = "Makefile.vc"
+                build.stamp_file = os.path.join(
+                    work_dir, "stamps", "nmake.json")
+                build.ensure_finalized()
+                build.artifact_cache = None
+                self.time_build("nmake" + attempt, build)
         else:
-            tarball = tarfile.open(target)
-            if self.member_filter is not None:
-                def filter_fn(member, name_filter = self.member_filter):
-                    return name_filter(member.name)
-                members = filter(filter_fn, tarball.getmembers())
-        tarball.extractall(self.unpack_dir, members = members)
-	tarball.close()
-	tarball_source_dir = os.path.join(
-	    self.unpack_dir, self.tarball_source_dir)
-	if self.source_dir != self.tarball_source_dir:
-	    if os.path.isdir(self.source_dir):
-		shutil.rmtree(self.source_dir)
-	    shutil.move(tarball_source_dir, self.source_dir)
-        if self.post_fetch is not None:
-            self.post_fetch(self)
+            self.announce("NMake is not installed, skipping NMake builds", 3)
+        
+    def time_build(self, name, build):
+        start_time = time.time()
+        build.run()
+        elapsed = time.time() - start_time
+        if build.skipped:
+            self.add_result(name + " overhead", elapsed, "sec", False)
+            return
+        for phase, seconds in build.phase_times:
+            self.add_result("%s %s" % (name, phase), seconds, "sec", False)
+        self.add_result(name + " total", elapsed, "sec", False)
+        
+    def compare_with_baseline(self):
+        current = dict([(name, value) for name, value, _, _ in self.results])
+        regressions = []
+        if os.path.isfile(self.baseline):
+            with open(self.baseline, "r") as fd:
+                baseline = json.load(fd)
+            for name, value, unit, higher_is_better in self.results:
+                if name not in baseline:
+                    continue
+                expected = baseline[name]
+                if higher_is_better:
+                    worse = value < expected * (1 - self.tolerance)
+                else:
+                    worse = value > expected * (1 + self.tolerance) and \
+                        value - expected > self.min_difference
+                if worse:
+                    regressions.append("%s: %.2f %s, baseline %.2f" %
+                                       (name, value, unit, expected))
+        elif not self.save_baseline:
+            self.announce("No baseline in %s, use --save-baseline to make one"
+                          % self.baseline, 2)
+        if self.save_baseline:
+            with open(self.baseline, "w") as fd:
+                json.dump(current, fd, indent=2, sort_keys=True)
+            self.announce("Saved the results as the baseline in " +
+                          self.baseline, 2)
+        elif regressions:
+            raise DistutilsError(
+                "Slower than the baseline by more than %d%%:\n    %s" %
+                (self.tolerance * 100, "\n    ".join(regressions)))
         
 class BuildLibhdf5(BuildWithCMake):
     def initialize_options(self):
@@ -323,20 +3815,21 @@ class BuildLibhdf5(BuildWithCMake):
         self.szip_install_dir = None
         self.zlib_source_dir = None
         self.szip_source_dir = None
-        self.zlib_make_dir = None
-        self.szip_make_dir = None
         
     def finalize_options(self):
         BuildWithCMake.finalize_options(self)
+        #
+        # Only use what zlib and szip install. Their build trees may be
+        # in the scratch directory, which is emptied after the build, or
+        # restored without them from the artifact cache.
+        #
         self.set_undefined_options(
             'build_zlib', 
             ('install_dir', 'zlib_install_dir'),
-            ('target_dir', 'zlib_make_dir'),
             ('source_dir', 'zlib_source_dir'))
         self.set_undefined_options(
             'build_szip', 
             ('install_dir', 'szip_install_dir'),
-            ('target_dir', 'szip_make_dir'),
             ('source_dir','szip_source_dir'))
         if is_win:
             szip_lib = 'szip.' + lib_ext
@@ -347,9 +3840,9 @@ class BuildLibhdf5(BuildWithCMake):
         for varname, cmake_type, install_dir, folder in (
             ("SZIP_LIBRARY_RELEASE", "FILEPATH", 
              self.szip_install_dir, os.path.join("lib", szip_lib)),
-            ("SZIP_DIR", "PATH", self.szip_make_dir, None),
+            ("SZIP_DIR", "PATH", self.szip_install_dir, None),
             ("SZIP_INCLUDE_DIR", "PATH", self.szip_install_dir, "include"),
-            ("ZLIB_DIR", "PATH", self.zlib_make_dir, None),
+            ("ZLIB_DIR", "PATH", self.zlib_install_dir, None),
             ("ZLIB_INCLUDE_DIR", "PATH", self.zlib_install_dir, "include"),
             ("ZLIB_LIBRARY_RELEASE", "FILEPATH", 
              self.zlib_install_dir, os.path.join("lib", zlib_lib))):
@@ -360,145 +3853,372 @@ class BuildLibhdf5(BuildWithCMake):
             self.extra_cmake_options.append(
                 "\"-D{varname}:{cmake_type}={path}\"".format(**locals()))
             
-class BuildH5Py(setuptools.Command):
+class BuildH5Py(StampedStep):
+    '''Build h5py against the HDF5 library and install it
+    
+    h5py is installed from a wheel. The wheel is kept in the wheel cache,
+    keyed by the h5py source, the steps it builds on, the HDF5 library,
+    the compiler and the Python ABI, so other builds with the same
+    inputs, e.g. for other virtualenvs, install it without compiling.
+    
+    hdf5 - the prefix HDF5 is installed under
+    system_hdf5 - what SystemDependency.find found for a system HDF5 or
+                  None. h5py is then compiled against its include and
+                  library directories, which needn't be under the prefix.
+    
+    On Windows, h5py links against h5py_hdf5.lib and h5py_hdf5_hl.lib.
+    Copies of the built HDF5's libraries with those names go in temp_dir,
+    and the DLLs go into the built h5py package, so that they are in
+    the wheel. A system HDF5's DLLs are left where they are.
+    '''
     user_options = [("hdf5", None, "Location of libhdf5 install")]
     command_name = "build_h5py"
+    installs_python_packages = True
     
     def initialize_options(self):
+        StampedStep.initialize_options(self)
+        self.wheel_cache = None
         self.hdf5 = None
+        self.system_hdf5 = None
         self.source_dir = None
         self.temp_dir = None
         self.szip_install_dir = None
         self.zlib_install_dir = None
         
     def finalize_options(self):
-        if self.hdf5 is None:
+        StampedStep.finalize_options(self)
+        self.set_undefined_options('build', ('wheel_cache', 'wheel_cache'))
+        system = self.get_finalized_command('build').get_system_dependencies()
+        if self.hdf5 is None and "hdf5" in system:
+            self.system_hdf5 = system["hdf5"]
+            self.hdf5 = self.system_hdf5["prefix"]
+        elif self.hdf5 is None:
             self.set_undefined_options(
                 'build_libhdf5', ('install_dir', 'hdf5'))
-        if self.szip_install_dir is None:
-            self.set_undefined_options(
-                'build_szip', ('install_dir', 'szip_install_dir'))
-        if self.zlib_install_dir is None:
-            self.set_undefined_options(
-                'build_zlib', ('install_dir', 'zlib_install_dir'))
+        if self.system_hdf5 is None and is_win:
+            if self.szip_install_dir is None and "szip" not in system:
+                self.set_undefined_options(
+                    'build_szip', ('install_dir', 'szip_install_dir'))
+            if self.zlib_install_dir is None and "zlib" not in system:
+                self.set_undefined_options(
+                    'build_zlib', ('install_dir', 'zlib_install_dir'))
         if self.source_dir is None:
             self.set_undefined_options(
                 'fetch_h5py', ('source_dir', 'source_dir'))
         if self.temp_dir is None:
-            self.temp_dir = os.path.join(os.path.dirname(self.source_dir), "tmp")
+            self.temp_dir = self.get_scratch_path(
+                os.path.join(os.path.dirname(self.source_dir), "tmp"))
+            
+    def get_stamp_inputs(self):
+        inputs = StampedStep.get_stamp_inputs(self)
+        inputs.update(source=tree_digest(self.source_dir),
+                      hdf5=self.relative_to_build_lib(
+                          os.path.abspath(self.hdf5)),
+                      system_hdf5=self.system_hdf5,
+                      temp_dir=self.relative_to_build_lib(
+                          os.path.abspath(self.temp_dir)))
+        return inputs
+    
+    def get_intermediate_dirs(self):
+        return [self.temp_dir]
+    
+    def get_wheel_key(self):
+        '''The key of h5py's wheel in the wheel cache or None'''
+        inputs = self.get_artifact_inputs()
+        if inputs is None:
+            return None
+        if self.system_hdf5 is not None:
+            inputs["hdf5"] = self.system_hdf5
+        elif "after build_libhdf5" not in inputs:
+            # HDF5 is installed where the hdf5 option says
+            inputs["hdf5"] = [tree_digest(os.path.join(self.hdf5, directory))
+                              for directory in ("include", "lib")]
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
         
-    def run(self):
+    def run_step(self):
+        key = self.get_wheel_key()
+        wheel = self.find_wheel(key)
+        if wheel is None:
+            wheel = self.build_wheel(key)
+        with self.phase("install"):
+            self.install_wheel(wheel)
+    
+    def get_build_ext_options(self):
+        '''build_ext options for where HDF5 is, besides setup.py --hdf5'''
+        if self.system_hdf5 is not None:
+            return ["build_ext",
+                    "--include-dirs=%s" % self.system_hdf5["include_dir"],
+                    "--library-dirs=%s" % self.system_hdf5["library_dir"]]
+        if is_win:
+            return ["build_ext", "--library-dirs=%s" %
+                    os.path.abspath(os.path.join(self.temp_dir, "hdf5"))]
+        return []
+    
+    def get_dlls(self):
+        '''(path, name in the h5py package) of the DLLs to put in the wheel'''
+        if self.system_hdf5 is not None or not is_win:
+            return []
+        dlls = [(os.path.join(self.hdf5, "bin", "hdf5.dll"), "h5py_hdf5.dll"),
+                (os.path.join(self.hdf5, "bin", "hdf5_hl.dll"),
+                 "h5py_hdf5_hl.dll")]
+        for install_dir, name in ((self.szip_install_dir, "szip.dll"),
+                                  (self.zlib_install_dir, "zlib.dll")):
+            if install_dir is not None:
+                dlls.append((os.path.join(install_dir, "bin", name), name))
+        return dlls
+            
+    def build_wheel(self, key):
         hdf5 = os.path.abspath(self.hdf5)
-        for directory, ext in (('bin', 'dll'), ('lib', 'lib')):
-            hdf5_dll = os.path.join(self.hdf5, directory, "hdf5."+ext)
-            hdf5_hl_dll = os.path.join(self.hdf5, directory, "hdf5_hl."+ext)
-            szip_dll = os.path.join(
-                self.szip_install_dir, directory, "szip."+ext)
-            zlib_dll = os.path.join(
-                self.zlib_install_dir, directory, "zlib."+ext)
-            for src, destfile in ((hdf5_dll, "h5py_hdf5."+ext),
-                                  (hdf5_hl_dll, "h5py_hdf5_hl."+ext),
-                                  (szip_dll, "szip.dll"+ext),
-                                  (zlib_dll, "zlib.dll"+ext)):
-                dest = os.path.join(self.hdf5, directory, destfile)
-                self.copy_file(src, dest)
-        
-        old_curdir = os.path.abspath(os.curdir)
-        os.chdir(os.path.abspath(self.source_dir))
-        try:
+        if self.system_hdf5 is None and is_win:
+            self.mkpath(os.path.join(self.temp_dir, "hdf5"))
+            for name in ("hdf5", "hdf5_hl"):
+                self.copy_file(
+                    os.path.join(self.hdf5, "lib", name + ".lib"),
+                    os.path.join(self.temp_dir, "hdf5",
+                                 "h5py_%s.lib" % name))
+        
+        source_dir = os.path.abspath(self.source_dir)
+        env = None
+        if self.compiler_cache is not None and not is_win:
+            #
+            # distutils takes the compiler from $CC. It ignores it for
+            # MSVC, so the extension is compiled without the cache there.
+            #
+            compiler = os.environ.get(
+                "CC", distutils.sysconfig.get_config_var("CC"))
+            env = dict(CC="%s %s" % (self.compiler_cache, compiler))
+        #
+        # Build in temp_dir and make the wheel from there without building
+        # again
+        #
+        build_base = "--build-base=%s" % os.path.abspath(self.temp_dir)
+        self.check_wheel_package()
+        with self.phase("compile"):
             self.spawn([
-                "python", "setup.py", "build", '"--hdf5=%s"' % hdf5])
-            self.spawn(["python", "setup.py", "install"])
-        finally:
-            os.chdir(old_curdir)
+                "python", "setup.py", "build", '"--hdf5=%s"' % hdf5,
+                build_base] + self.get_build_ext_options(),
+                cwd=source_dir, env=env)
+        #
+        # The DLLs go where build put the h5py package
+        #
+        package_dir = os.path.join(
+            self.temp_dir, "lib.%s-%s" % (distutils.util.get_platform(),
+                                          sys.version[0:3]), "h5py")
+        dlls = self.get_dlls()
+        if dlls:
+            self.mkpath(package_dir)
+        for src, name in dlls:
+            self.copy_file(src, os.path.join(package_dir, name))
+        with self.phase("wheel"):
+            return self.make_wheel(
+                source_dir, ["build", build_base],
+                os.path.join(self.temp_dir, "dist"), key, env,
+                skip_build=True)
 
-class BuildBoost(setuptools.Command):
+class BuildBoost(StampedStep):
+    '''Bootstrap b2 and build the Boost libraries that vigra needs
+    
+    libraries - the Boost libraries to build, e.g. ["python"], or None to
+                build all of them. Vigra only links against boost.python.
+    jobs - the number of parallel compile jobs for b2
+    cache_dir - b2 is kept in <cache_dir>/b2 after it is bootstrapped so
+                that later builds of the same Boost don't bootstrap again.
+                None to always bootstrap.
+    '''
     command_name = "build_boost"
-    user_options = [('install-dir', None, "Boost install directory")]
+    user_options = [('install-dir', None, "Boost install directory"),
+                    ('jobs=', 'j', "Number of parallel compile jobs"),
+                    ('libraries=', None,
+                     'Comma-separated Boost libraries to build or "all" '
+                     '[default: python]')]
+    artifact_cacheable = True
+    # Boost.Python's templates take a lot of compiling
+    memory_per_job = 1536 * 1024 * 1024
     
     def initialize_options(self):
+        StampedStep.initialize_options(self)
         self.boost_src = None
-        self.build_lib = None
         self.install_dir = None
         self.temp_dir = None
+        self.jobs = None
+        self.cache_dir = None
+        self.libraries = None
         
     def finalize_options(self):
-        self.set_undefined_options(
-            'build', ('build_lib', 'build_lib'))
+        StampedStep.finalize_options(self)
         self.set_undefined_options(
             'fetch_boost', 
             ('source_dir', 'boost_src'))
+        self.set_undefined_options(
+            'build', ('jobs', 'jobs'), ('cache_dir', 'cache_dir'))
+        self.jobs = int(self.jobs)
+        if self.libraries is None:
+            self.libraries = ["python"]
+        elif isinstance(self.libraries, basestring):
+            if self.libraries.lower() == "all":
+                self.libraries = None
+            else:
+                self.libraries = [library.strip() for library in
+                                  self.libraries.split(",")]
         if self.install_dir is None:
             root, leaf = os.path.split(self.boost_src)
             self.install_dir = os.path.join(root, "install", leaf)
         if self.temp_dir is None:
             root, leaf = os.path.split(self.boost_src)
-            self.temp_dir = os.path.join(root, "tmp", leaf)
+            self.temp_dir = self.get_scratch_path(
+                os.path.join(root, "tmp", leaf))
+        if is_win:
+            self.toolset = toolset
+        else:
+            self.toolset = None
+            
+    def get_stamp_inputs(self):
+        inputs = StampedStep.get_stamp_inputs(self)
+        inputs.update(source=tree_digest(self.boost_src),
+                      install_dir=self.relative_to_build_lib(
+                          os.path.abspath(self.install_dir)),
+                      temp_dir=self.relative_to_build_lib(
+                          os.path.abspath(self.temp_dir)),
+                      libraries=self.libraries)
+        return inputs
     
-    def run(self):
-        self.bootstrap()
-        self.build()
+    def get_artifact_inputs(self):
+        inputs = StampedStep.get_artifact_inputs(self)
+        if inputs is not None:
+            inputs.update(libraries=self.libraries)
+        return inputs
+    
+    def get_outputs(self):
+        return [self.install_dir]
+    
+    def get_intermediate_dirs(self):
+        return [self.temp_dir]
+    
+    def run_step(self):
+        with self.phase("bootstrap"):
+            self.bootstrap()
+        with self.phase("compile"):
+            self.build()
+        
+    def get_b2_path(self):
+        return os.path.join(os.path.abspath(self.boost_src),
+                            "b2.exe" if is_win else "b2")
+    
+    def get_cached_b2_path(self):
+        '''Where b2 for this Boost and toolchain is cached or None'''
+        if self.cache_dir is None:
+            return None
+        key = hashlib.sha256("\n".join([
+            os.path.basename(os.path.abspath(self.boost_src)),
+            sys.platform, self.toolset or "",
+            get_compiler_identity()])).hexdigest()
+        return os.path.join(self.cache_dir, "b2", key[:2], key,
+                            os.path.basename(self.get_b2_path()))
         
     def build(self):
-        args = ["b2", '"--stagedir=%s"' % os.path.abspath(self.install_dir),
-                '"--build-dir=%s"' % os.path.abspath(self.temp_dir),
-                "--with-python", 
-                "link=shared", "variant=release", "threading=multi",
-                "address-model=64",
-                "runtime-link=shared"]
+        install_dir = os.path.abspath(self.install_dir)
+        args = [self.get_b2_path(), "-j", str(self.get_jobs()),
+                "--stagedir=%s" % install_dir,
+                "--build-dir=%s" % os.path.abspath(self.temp_dir)]
+        if self.libraries is not None:
+            args += ["--with-%s" % library for library in self.libraries]
+        args += ["link=shared", "variant=release", "threading=multi",
+                 "address-model=64",
+                 "runtime-link=shared"]
         args.append("stage")
-        self.spawn(args)
+        self.spawn(args, cwd=os.path.abspath(self.boost_src))
         
     def bootstrap(self):
         #
         # Boost has a bootstrapping script that builds bjam / b2
-        # The single parameter to the script is the toolchain to use
+        # The single parameter to the script is the toolchain to use.
+        # b2 only depends on the Boost version and the toolchain, so a
+        # copy is kept in the cache and reused.
         #
-        if is_win:
-            bootstrap_script = "bootstrap.bat"
-        else:
-            bootstrap_script = "boostrap.sh"
-        args = [bootstrap_script]
-        if is_win:
-	    self.toolset = toolset
-	    # vc90 -> vc9, vc100 -> vc10
-            args.append(self.toolset[:-1])
+        boost_src = os.path.abspath(self.boost_src)
+        b2_path = self.get_b2_path()
+        cached_b2_path = self.get_cached_b2_path()
+        if cached_b2_path is not None and os.path.isfile(cached_b2_path):
+            self.announce("Using cached b2 from " + cached_b2_path, 2)
+            shutil.copy2(cached_b2_path, b2_path)
         else:
-            self.toolset = None
-        self.spawn(args)
+            if is_win:
+                bootstrap_script = "bootstrap.bat"
+            else:
+                bootstrap_script = "bootstrap.sh"
+            args = [os.path.join(boost_src, bootstrap_script)]
+            if is_win:
+                # vc90 -> vc9, vc100 -> vc10
+                args.append(self.toolset[:-1])
+            self.spawn(args, cwd=boost_src)
+            if cached_b2_path is not None and not self.dry_run:
+                cache_entry = os.path.dirname(cached_b2_path)
+                if not os.path.isdir(cache_entry):
+                    try:
+                        os.makedirs(cache_entry)
+                    except OSError:
+                        if not os.path.isdir(cache_entry):
+                            raise
+                fd, part_path = tempfile.mkstemp(dir=cache_entry)
+                os.close(fd)
+                shutil.copy2(b2_path, part_path)
+                replace_file(part_path, cached_b2_path)
+        if not self.dry_run:
+            self.write_project_config()
+            
+    def write_project_config(self):
+        '''Write project-config.jam with the compiler and this Python
+        
+        On Windows, the compiler is the version of MSVC used to compile
+        Python (we may want to change this to detect the SDK). Elsewhere
+        it is gcc, or $CXX if set.
+        '''
+        from distutils.sysconfig import get_config_var, get_python_inc
+        def fixpath(path):
+            path = path.replace("\\", "/")
+            return path
         if is_win:
-            #
-            # Build the project configuration file to use the version of
-            # MSVC used to compile Python (we may want to change this
-            # to detect the SDK)
-            #
-            from distutils.sysconfig import get_config_var, get_python_inc
-            def fixpath(path):
-                path = path.replace("\\", "/")
-                return path
             libs_path = fixpath(os.path.join(get_config_var("prefix"), "libs"))
-            python_path = fixpath(sys.executable)
-            include_path = fixpath(get_python_inc())
-            project_config_path = os.path.join(
-                self.boost_src, "project-config.jam")
-            with open(project_config_path, "w") as fd:
-                fd.write("using msvc : %s ;\n" % build_version)
-                fd.write('using python : %d.%d : "%s" : "%s" : "%s" ;' % 
-                         (sys.version_info.major, sys.version_info.minor,
-                          python_path, include_path, libs_path))
-    
-    def spawn(self, args):
-        #
-        # Must... change... directory...
-        #
-        old_cwd = os.path.abspath(os.curdir)
-        os.chdir(os.path.abspath(self.boost_src))
-        try:
-            distutils.spawn.spawn(
-                args, verbose = self.verbose, dry_run=self.dry_run)
-        finally:
-            os.chdir(old_cwd)
+            if self.compiler_cache is None:
+                compiler = "using msvc : %s ;\n" % build_version
+            else:
+                #
+                # <compiler> replaces the "cl" that msvc.jam runs
+                # after setting up the environment.
+                #
+                compiler = 'using msvc : %s : : <compiler>"%s cl" ;\n' % (
+                    build_version, fixpath(self.compiler_cache))
+        else:
+            libs_path = get_config_var("LIBDIR")
+            cxx = os.environ.get("CXX", "g++")
+            if self.compiler_cache is not None:
+                cxx = "%s %s" % (self.compiler_cache, cxx)
+            compiler = "using gcc : : %s ;\n" % cxx
+        python_path = fixpath(sys.executable)
+        include_path = fixpath(get_python_inc())
+        project_config_path = os.path.join(
+            self.boost_src, "project-config.jam")
+        with open(project_config_path, "w") as fd:
+            fd.write(compiler)
+            fd.write('using python : %d.%d : "%s" : "%s" : "%s" ;\n' % 
+                     (sys.version_info.major, sys.version_info.minor,
+                      python_path, include_path, libs_path))
             
+class FetchLibhdf5(FetchSource):
+    '''Fetch the HDF5 library
+    
+    By default, the version is the one the installed h5py was built with.
+    It is only looked up when the command is finalized, so that starting
+    setup.py doesn't pay for probing h5py.
+    '''
+    default_version = "1.8.11"
+    
+    def finalize_options(self):
+        if self.version is None:
+            self.version = get_installed_packages().get("h5py", {}).get(
+                "hdf5_version", self.default_version)
+        FetchSource.finalize_options(self)
+        
 class FetchVigra(FetchSource):
     def initialize_options(self):
 	FetchSource.initialize_options(self)
@@ -509,6 +4229,8 @@ class FetchVigra(FetchSource):
 	if self.dependency_dir is None:
 	    self.dependency_dir = os.path.join(
 	        self.source_dir, "..", "dependencies")
+	# patch_vigra unpacks the win32 dependencies there
+	self.extra_paths = [self.dependency_dir]
 
 class BuildLibpng(BuildWithCMake):
     
@@ -536,6 +4258,9 @@ class BuildLibpng(BuildWithCMake):
 	
 class BuildVigra(BuildWithCMake):
     command_name = 'build_vigra'
+    # vigranumpy instantiates Boost.Python templates for every pixel type
+    memory_per_job = 1536 * 1024 * 1024
+    installs_python_packages = True
     
     def initialize_options(self):
         BuildWithCMake.initialize_options(self)
@@ -570,13 +4295,16 @@ class BuildVigra(BuildWithCMake):
         
     def finalize_options(self):
         BuildWithCMake.finalize_options(self)
-        self.set_undefined_options(
-            'build_szip', ('install_dir', 'szip_install_dir'))
-        if self.szip_library is None:
-            self.szip_library = os.path.join(
-                self.szip_install_dir, 'lib', 'szip.%s' % lib_ext)
-        self.extra_cmake_options.append(
-	    '"-DHDF5_SZ_LIBRARY:FILEPATH=%s"' % self.szip_library)
+        self.system_dependencies = \
+            self.get_finalized_command('build').get_system_dependencies()
+        if "szip" not in self.system_dependencies:
+            self.set_undefined_options(
+                'build_szip', ('install_dir', 'szip_install_dir'))
+            if self.szip_library is None:
+                self.szip_library = os.path.join(
+                    self.szip_install_dir, 'lib', 'szip.%s' % lib_ext)
+            self.extra_cmake_options.append(
+                '"-DHDF5_SZ_LIBRARY:FILEPATH=%s"' % self.szip_library)
         
         if is_win:
             self.set_undefined_options(
@@ -715,136 +4443,955 @@ class BuildVigra(BuildWithCMake):
                 '"-DBoost_INCLUDE_DIR:PATH=%s"' % self.boost_include_dir)
 	    self.extra_cmake_options.append(
 	        r'"-DCMAKE_CXX_FLAGS:STRING=/EHsc"')
+        self.add_system_dependency_options()
         
-    def run(self):
-        BuildWithCMake.run(self)
-        setup_directory = os.path.abspath(os.path.join(self.target_dir, "vigranumpy"))
-        old_cwd = os.path.abspath(os.curdir)
-        os.chdir(setup_directory)
-        try:
-            self.spawn(["nmake", "install"])
-        finally:
-            os.chdir(old_cwd)
-	#
-	# This is a non-standard way of putting the DLLs into the
-	# vigra package, but the whole install process is very non-standard
-	#
-	site_packages = distutils.sysconfig.get_python_lib()
-	vigra_target = os.path.join(site_packages, "vigra")
-	boost_python_dll = os.path.splitext(self.boost_python_library)[0]+".dll"
-	impex_dll = os.path.join(
-	    self.target_dir, "src", "impex", "vigraimpex.dll")
-	szip_dll = os.path.join(self.szip_install_dir, "bin", "szip.dll")
-	hdf_dlls = [
-	    os.path.join(self.libhdf5_install_dir, "bin", libname+".dll")
-	    for libname in ("hdf5", "hdf5_hl")]
-	zlib_dll = os.path.join(self.zlib_install_dir, "bin", "zlib.dll")
-	all_dlls = [boost_python_dll, impex_dll, szip_dll]
-	all_dlls += hdf_dlls
-	all_dlls.append(zlib_dll)
-	if os.path.exists(self.fftw_dll):
-	    all_dlls.append(self.fftw_dll)
-	for dll_path in all_dlls:
-	    filename = os.path.split(dll_path)[1]
-	    self.copy_file(dll_path, os.path.join(vigra_target, filename))
+    def add_system_dependency_options(self):
+        '''Point CMake at the libraries taken from the system
+        
+        These replace any options for the same variables that point at
+        libraries this build would have made.
+        '''
+        options = []
+        for dependency in system_dependencies:
+            found = self.system_dependencies.get(dependency.name)
+            if found is None:
+                continue
+            for variable, key in dependency.cmake_options:
+                options.append((variable.partition(":")[0],
+                                "-D%s=%s" % (variable, found[key])))
+        replaced = set([name for name, option in options])
+        self.extra_cmake_options = [
+            option for option in self.extra_cmake_options
+            if re.match(r'"?-D([^:=]+)', option) is None or
+            re.match(r'"?-D([^:=]+)', option).group(1) not in replaced]
+        self.extra_cmake_options += [option for name, option in options]
+        
+    def run_step(self):
+        BuildWithCMake.run_step(self)
+        with self.phase("install vigranumpy"):
+            if self.generator == "ninja":
+                # Ninja has one build file, with a per-directory install target
+                self.spawn(self.get_make_args("vigranumpy/install"),
+                           cwd=os.path.abspath(self.target_dir))
+            else:
+                setup_directory = os.path.abspath(os.path.join(self.target_dir, "vigranumpy"))
+                self.spawn(self.get_make_args("install"), cwd=setup_directory)
+        if not is_win:
+            return
+        #
+        # This is a non-standard way of putting the DLLs into the
+        # vigra package, but the whole install process is very non-standard.
+        # The system's own libraries are left where they are.
+        #
+        site_packages = distutils.sysconfig.get_python_lib()
+        vigra_target = os.path.join(site_packages, "vigra")
+        system = self.system_dependencies
+        all_dlls = [os.path.join(
+            self.target_dir, "src", "impex", "vigraimpex.dll")]
+        if "boost_python" not in system:
+            all_dlls.append(
+                os.path.splitext(self.boost_python_library)[0] + ".dll")
+        if "szip" not in system:
+            all_dlls.append(
+                os.path.join(self.szip_install_dir, "bin", "szip.dll"))
+        if "hdf5" not in system:
+            all_dlls += [
+                os.path.join(self.libhdf5_install_dir, "bin", libname+".dll")
+                for libname in ("hdf5", "hdf5_hl")]
+        if "zlib" not in system:
+            all_dlls.append(
+                os.path.join(self.zlib_install_dir, "bin", "zlib.dll"))
+        if "fftw" not in system and os.path.exists(self.fftw_dll):
+            all_dlls.append(self.fftw_dll)
+        for dll_path in all_dlls:
+            filename = os.path.split(dll_path)[1]
+            self.copy_file(dll_path, os.path.join(vigra_target, filename))
             
-class InstallIlastik(setuptools.Command):
+class InstallIlastik(BuildStep):
+    '''Install Ilastik from a wheel, built unless it is in the wheel cache
+    
+    The wheel's key covers the contents of the Ilastik source, the
+    compiler and the Python ABI. The source is keyed by its contents,
+    since fetch_ilastik follows a branch, so its commit changes.
+    '''
     command_name = 'install_ilastik'
     user_options = []
     
     def initialize_options(self):
         self.ilastik_src = None
+        self.wheel_cache = None
         
     def finalize_options(self):
+        self.set_undefined_options('build', ('wheel_cache', 'wheel_cache'))
         if self.ilastik_src is None:
             self.set_undefined_options(
                 'fetch_ilastik', ('source_dir', 'ilastik_src'))
+        #
+        # Ilastik goes in last, on top of vigra and h5py
+        #
+        self.add_dependency('build_vigra')
+        self.add_dependency('build_h5py')
+    
+    def get_wheel_key(self):
+        '''The key of Ilastik's wheel in the wheel cache or None'''
+        if self.wheel_cache is None or not os.path.isdir(self.ilastik_src):
+            return None
+        return hashlib.sha256(json.dumps(dict(
+            step=self.get_step_name(),
+            source=source_digest(self.ilastik_src),
+            toolchain=get_compiler_identity(), python=get_python_abi()),
+            sort_keys=True)).hexdigest()
     
     def run(self):
-        old_curdir = os.path.abspath('.')
-        os.chdir(os.path.abspath(self.ilastik_src))
-        try:
-            self.spawn(['python', 'setup.py', 'build', 'install'])
-        finally:
-            os.chdir(old_curdir)
+        key = self.get_wheel_key()
+        wheel = self.find_wheel(key)
+        if wheel is None:
+            with self.phase("wheel"):
+                wheel = self.make_wheel(
+                    self.ilastik_src, [],
+                    os.path.join(os.path.dirname(self.ilastik_src), "dist"),
+                    key)
+        with self.phase("install"):
+            self.install_wheel(wheel)
         
 class BuildIlastik(distutils.command.build.build):
     command_name = 'build'
     user_options = list(distutils.command.build.build.user_options)
     user_options.append(("cmake=", None, "Location of the CMake executable"))
+    user_options.append(("workers=", None,
+                         "Number of build steps to run at the same time "
+                         "[default: number of CPUs]"))
+    user_options.append(("cache-dir=", None,
+                         "Directory for caches shared between builds, "
+                         "or \"none\" [default: $BUILD_ILASTIK_CACHE or "
+                         "~/.cache/build-ilastik]"))
+    user_options.append(("stream-extract", None,
+                         "Unpack tarballs while they download"))
+    user_options.append(("jobs=", "j",
+                         "Number of parallel compile jobs per build step "
+                         "[default: number of CPUs]"))
+    user_options.append(("generator=", None,
+                         'Build with "make" (NMake on Windows) or "ninja" '
+                         '[default: make]'))
+    user_options.append(("compiler-cache=", None,
+                         'Compile through "ccache" or "sccache", only '
+                         'sccache on Windows'))
+    user_options.append(("compiler-cache-dir=", None,
+                         "Directory for the compiler cache "
+                         "[default: <cache-dir>/<compiler cache>]"))
+    user_options.append(("artifact-cache=", None,
+                         "Directory or URL of the cache of built "
+                         "dependencies, or \"none\" "
+                         "[default: <cache-dir>/artifacts]"))
+    user_options.append(("downloads=", None,
+                         "Number of downloads at the same time "
+                         "[default: 4]"))
+    user_options.append(("host-downloads=", None,
+                         "Number of downloads from the same host at the "
+                         "same time [default: 2]"))
+    user_options.append(("scratch-dir=", None,
+                         "Fast directory, e.g. on a tmpfs, for intermediate "
+                         "build trees, which are removed after the build"))
+    user_options.append(("wheel-cache=", None,
+                         "Directory of the cache of wheels of the Python "
+                         "packages, or \"none\" [default: <cache-dir>/wheels]"))
+    user_options.append(("system-deps=", None,
+                         "Comma-separated libraries to take from the "
+                         "system instead of building them, \"auto\" for "
+                         "any compatible ones installed or \"none\" "
+                         "[default: none on Windows, otherwise auto]"))
+    user_options.append(("only=", None,
+                         "Comma-separated steps to run, e.g. build_vigra"))
+    user_options.append(("from=", None,
+                         "Comma-separated steps to run along with every "
+                         "step after them, e.g. build_libhdf5"))
+    user_options.append(("with-deps", None,
+                         "Also run the steps the selected ones depend on "
+                         "that aren't done yet [default]"))
+    user_options.append(("no-deps", None,
+                         "Only run the selected steps"))
+    user_options.append(("plan", None,
+                         "Show the steps the build would run and how long "
+                         "they should take, without building anything"))
+    boolean_options = distutils.command.build.build.boolean_options + [
+        "stream-extract", "with-deps", "plan"]
+    negative_opt = {"no-deps": "with-deps"}
     
     def initialize_options(self):
         distutils.command.build.build.initialize_options(self)
         self.cmake = None
+        self.workers = None
+        self.cache_dir = None
+        self.stream_extract = 0
+        self.jobs = None
+        self.generator = None
+        self.compiler_cache = None
+        self.compiler_cache_dir = None
+        self.report_file = None
+        self.timings_file = None
+        self.memory_profile_file = None
+        self.artifact_cache = None
+        self.wheel_cache = None
+        self.system_deps = None
+        self.found_system_dependencies = None
+        self.only = None
+        #
+        # "from" is a keyword, so the option is only reachable via getattr
+        #
+        setattr(self, "from", None)
+        self.with_deps = 1
+        self.plan = 0
+        self.downloads = None
+        self.host_downloads = None
+        self.scratch_dir = None
+        
+    def finalize_options(self):
+        distutils.command.build.build.finalize_options(self)
+        if self.workers is None:
+            self.workers = multiprocessing.cpu_count()
+        else:
+            self.workers = int(self.workers)
+        if self.cache_dir is None:
+            self.cache_dir = default_cache_dir()
+        elif self.cache_dir.lower() == "none":
+            self.cache_dir = None
+        if self.jobs is None:
+            self.jobs = multiprocessing.cpu_count()
+        else:
+            self.jobs = int(self.jobs)
+        if self.generator is None:
+            self.generator = "make"
+        if self.compiler_cache is not None:
+            name = self.compiler_cache
+            if is_win and not os.path.basename(name).lower().startswith(
+                "sccache"):
+                # ccache can't run MSVC's cl
+                raise distutils.command.build.DistutilsOptionError(
+                    "Only sccache can be the compiler cache on Windows")
+            self.compiler_cache = distutils.spawn.find_executable(name)
+            if self.compiler_cache is None:
+                self.announce("%s is not installed, compiling without it" %
+                              name, 3)
+            elif self.compiler_cache_dir is None and \
+                 self.cache_dir is not None:
+                self.compiler_cache_dir = os.path.join(
+                    self.cache_dir, os.path.splitext(
+                        os.path.basename(self.compiler_cache))[0])
+        if self.report_file is None:
+            self.report_file = os.path.join(
+                self.build_lib, "build-report.json")
+        if self.timings_file is None:
+            self.timings_file = os.path.join(
+                self.build_lib, "step-times.json")
+        if self.memory_profile_file is None:
+            self.memory_profile_file = os.path.join(
+                self.build_lib, "memory-profile.json")
+        self.downloads = 4 if self.downloads is None else int(self.downloads)
+        self.host_downloads = 2 if self.host_downloads is None \
+            else int(self.host_downloads)
+        download_manager.configure(self.downloads, self.host_downloads)
+        if self.scratch_dir is not None:
+            #
+            # Keep build trees that share the scratch directory apart
+            #
+            key = hashlib.sha256(os.path.abspath(self.build_lib)).hexdigest()
+            self.scratch_dir = os.path.join(
+                os.path.abspath(self.scratch_dir), "build-ilastik-" + key[:12])
+        if self.artifact_cache is None:
+            if self.cache_dir is not None:
+                self.artifact_cache = os.path.join(self.cache_dir, "artifacts")
+        elif self.artifact_cache.lower() == "none":
+            self.artifact_cache = None
+        if self.wheel_cache is None:
+            if self.cache_dir is not None:
+                self.wheel_cache = os.path.join(self.cache_dir, "wheels")
+        elif self.wheel_cache.lower() == "none":
+            self.wheel_cache = None
+        if self.system_deps is None:
+            self.system_deps = "none" if is_win else "auto"
+        if self.system_deps.lower() == "none":
+            self.system_deps = []
+        elif self.system_deps.lower() != "auto":
+            self.system_deps = [name.strip()
+                                for name in self.system_deps.split(",")]
+            known = [dependency.name for dependency in system_dependencies]
+            for name in self.system_deps:
+                if name not in known:
+                    raise distutils.command.build.DistutilsOptionError(
+                        'Unknown system dependency "%s", use one of %s' %
+                        (name, ", ".join(known)))
+        known = [step_name for step_name, predicate in self.sub_commands]
+        self.only_steps = self.parse_step_names(self.only, "only", known)
+        self.from_steps = self.parse_step_names(
+            getattr(self, "from"), "from", known)
     
-    def needs_h5py(self):
+    def parse_step_names(self, value, option, known):
+        '''The list of step names in a comma-separated option value'''
+        if value is None:
+            return []
+        step_names = [name.strip() for name in value.split(",")
+                      if name.strip()]
+        for name in step_names:
+            if name not in known:
+                raise distutils.command.build.DistutilsOptionError(
+                    'Unknown step "%s" for --%s, use one of %s' %
+                    (name, option, ", ".join(known)))
+        return step_names
+    
+    def run(self):
+        #
+        # Finalize every step up front, in this thread, so that the
+        # dependencies are known before anything runs.
+        #
+        step_names = self.get_sub_commands()
+        dependencies = {}
+        memory_profile = self.read_json(self.memory_profile_file)
+        for step_name in step_names:
+            step = self.get_finalized_command(step_name)
+            dependencies[step_name] = getattr(step, "depends_on", [])
+            if getattr(step, "memory_per_job", None) is not None and \
+               step_name in memory_profile:
+                step.memory_per_job = memory_profile[step_name]
+        step_names = self.select_steps(step_names, dependencies)
+        if self.plan:
+            self.show_plan(step_names, dependencies)
+            return
+        compiler_cache_stats = self.get_compiler_cache_stats()
+        #
+        # Record when each step ran, relative to the start of the build
+        #
+        start_time = time.time()
+        step_times = {}
+        def run_step(step_name):
+            step_start_time = time.time()
+            try:
+                self.run_command(step_name)
+            finally:
+                step_times[step_name] = (step_start_time - start_time,
+                                         time.time() - step_start_time)
         try:
-            import h5py
-            return False
-        except ImportError:
-            return True
+            run_step_graph(step_names, dependencies, run_step, self.workers)
+        finally:
+            if not self.dry_run:
+                self.write_report(step_names, step_times,
+                                  time.time() - start_time)
+        self.announce_compiler_cache_stats(compiler_cache_stats)
+        self.clean_scratch_dir(step_names)
+    
+    def select_steps(self, step_names, dependencies):
+        '''The steps picked by --only and --from, in build order
+        
+        step_names - every step of the build
+        dependencies - a dictionary of step name to the names of the steps
+                       that have to finish first
+        
+        With --with-deps, the steps the selected ones depend on are added
+        unless they are done already: a stamped step is up to date, a
+        fetch finished and nothing they depend on has to run. To make
+        a step run regardless, select it. With --no-deps, only the
+        selected steps run and a warning names those they depend on that
+        aren't done.
+        '''
+        if not self.only_steps and not self.from_steps:
+            return step_names
+        for name in self.only_steps + self.from_steps:
+            if name not in step_names:
+                raise DistutilsError(
+                    "%s is not part of this build, e.g. because the "
+                    "system has the library" % name)
+        #
+        # The --from steps and everything downstream of them
+        #
+        downstream = set(self.from_steps)
+        for step_name in order_steps(step_names, dependencies):
+            if any([d in downstream for d in dependencies[step_name]]):
+                downstream.add(step_name)
+        selected = downstream.union(self.only_steps)
+        #
+        # The steps the selection depends on, upstream ones first
+        #
+        upstream = set()
+        pending = list(selected)
+        while pending:
+            for d in dependencies[pending.pop()]:
+                if d in step_names and d not in selected and \
+                   d not in upstream:
+                    upstream.add(d)
+                    pending.append(d)
+        needed = set()
+        for step_name in order_steps(step_names, dependencies):
+            if step_name not in upstream:
+                continue
+            step = self.get_finalized_command(step_name)
+            if any([d in needed for d in dependencies[step_name]]) or \
+               not self.is_step_done(step):
+                needed.add(step_name)
+        if self.with_deps:
+            selected.update(needed)
+        elif needed:
+            self.announce("Not running %s, which the selected steps "
+                          "depend on but aren't done" %
+                          ", ".join([step_name for step_name in step_names
+                                     if step_name in needed]), 3)
+        result = [step_name for step_name in step_names
+                  if step_name in selected]
+        self.announce("Running %d of %d steps: %s" % (
+            len(result), len(step_names), ", ".join(result)), 2)
+        return result
+    
+    def is_step_done(self, step):
+        '''Whether a step that isn't selected can be left out'''
+        if isinstance(step, StampedStep):
+            return step.is_up_to_date()
+        if isinstance(step, FetchSource):
+            return step.is_fetched()
+        return False
+    
+    def clean_scratch_dir(self, step_names):
+        '''Remove the steps' intermediate trees from the scratch directory
+        
+        Trees that are the output of a step are kept.
+        '''
+        if self.scratch_dir is None or self.dry_run:
+            return
+        for step_name in step_names:
+            step = self.get_finalized_command(step_name)
+            if not isinstance(step, StampedStep):
+                continue
+            outputs = [os.path.abspath(path) for path in step.get_outputs()]
+            for path in step.get_intermediate_dirs():
+                path = os.path.abspath(path)
+                if path not in outputs and os.path.isdir(path) and \
+                   path.startswith(self.scratch_dir + os.sep):
+                    self.announce("removing " + path, 2)
+                    shutil.rmtree(path)
+                    parent = os.path.dirname(path)
+                    while parent.startswith(self.scratch_dir) and \
+                          len(os.listdir(parent)) == 0:
+                        os.rmdir(parent)
+                        parent = os.path.dirname(parent)
+    
+    def write_report(self, step_names, step_times, wall_time):
+        '''Write the build report and announce a summary of it
+        
+        step_names - the steps in the build
+        step_times - a dictionary of step name to (start, wall time) for
+                     the steps that ran, whether or not they succeeded
+        wall_time - the time taken by the whole build
+        '''
+        steps = {}
+        for step_name in step_names:
+            if step_name not in step_times:
+                continue
+            step = self.get_finalized_command(step_name)
+            if isinstance(step, BuildStep):
+                report = step.get_report()
+            else:
+                report = {}
+            report["start"], report["wall_time"] = step_times[step_name]
+            report["succeeded"] = \
+                self.distribution.have_run.get(step_name, 0) == 1
+            steps[step_name] = report
+        report_dir = os.path.dirname(self.report_file)
+        if report_dir and not os.path.isdir(report_dir):
+            os.makedirs(report_dir)
+        with open(self.report_file, "w") as fd:
+            json.dump(dict(finished=time.time(), wall_time=wall_time,
+                           workers=self.workers, jobs=self.jobs,
+                           steps=steps), fd, indent=2, sort_keys=True)
+        #
+        # Keep the time each step took the last time it did its work,
+        # for estimating later builds.
+        #
+        timings = self.read_timings()
+        for step_name, report in steps.items():
+            if report["succeeded"] and not report.get("skipped"):
+                kind = "restore" if report.get("restored") else "run"
+                timings.setdefault(step_name, {})[kind] = report["wall_time"]
+        with open(self.timings_file, "w") as fd:
+            json.dump(timings, fd, indent=2, sort_keys=True)
+        self.update_memory_profile(steps)
+        self.announce("Build took %.1f sec, slowest steps first "
+                      "(report in %s):" % (wall_time, self.report_file), 2)
+        self.announce("    %8s %8s %8s %10s %10s  %s" % (
+            "wall", "cpu", "peak rss", "downloaded", "written", "step"), 2)
+        for step_name in sorted(
+                steps, key=lambda name: steps[name]["wall_time"],
+                reverse=True):
+            report = steps[step_name]
+            if report.get("skipped"):
+                step_name += " (up to date)"
+            elif report.get("restored"):
+                step_name += " (restored)"
+            elif not report["succeeded"]:
+                step_name += " (failed)"
+            self.announce("    %7.1fs %7.1fs %6.0fMB %8.1fMB %8.1fMB  %s" % (
+                report["wall_time"], report.get("cpu_time", 0),
+                report.get("peak_rss", 0) / 1e6,
+                report.get("bytes_downloaded", 0) / 1e6,
+                report.get("bytes_written", 0) / 1e6, step_name), 2)
+    
+    def read_timings(self):
+        '''Step name to {"run" or "restore": seconds} from earlier builds'''
+        return self.read_json(self.timings_file)
+    
+    def read_json(self, path):
+        '''Read a dictionary kept by an earlier build, or {} if there is none'''
+        if not os.path.isfile(path):
+            return {}
+        with open(path, "r") as fd:
+            try:
+                return json.load(fd)
+            except ValueError:
+                return {}
+    
+    def update_memory_profile(self, steps):
+        '''Learn the memory per compile job from the steps' peak RSS
+        
+        steps - step name to the step's report
+        
+        The peak RSS of a step is that of its biggest process, which is
+        one compile job. A higher peak replaces the remembered figure and
+        a lower one moves it halfway down, so one small rebuild doesn't
+        undo what a full build showed.
+        '''
+        profile = self.read_json(self.memory_profile_file)
+        for step_name, report in steps.items():
+            step = self.get_finalized_command(step_name)
+            if getattr(step, "memory_per_job", None) is None or \
+               not report["succeeded"] or report.get("skipped") or \
+               report.get("restored") or not report.get("peak_rss"):
+                continue
+            peak_rss = report["peak_rss"]
+            if step_name in profile and peak_rss < profile[step_name]:
+                peak_rss = (peak_rss + profile[step_name]) / 2
+            profile[step_name] = peak_rss
+        with open(self.memory_profile_file, "w") as fd:
+            json.dump(profile, fd, indent=2, sort_keys=True)
+    
+    def get_planned_action(self, step, changed):
+        '''What a step would do if the build ran now
+        
+        step - the finalized step
+        changed - the steps this one depends on that will do work
+        
+        Returns "run", "restore" or "skip" and a description.
+        '''
+        if isinstance(step, FetchSource):
+            if not self.force and step.is_fetched():
+                return "skip", "already fetched"
+            if step.git_error is not None:
+                return "run", "download and unpack (commit of %s unknown)" % \
+                    step.git_ref
+            if step.get_prepared_pack() is not None:
+                return "restore", "unpack prepared source"
+            cache_path = step.get_cache_path()
+            if cache_path is not None and os.path.isfile(cache_path) and \
+               os.path.isfile(cache_path + ".sha256"):
+                return "run", "unpack cached archive"
+            return "run", "download and unpack"
+        if not isinstance(step, StampedStep):
+            return "run", "run"
+        if changed:
+            return "run", "run (after %s)" % ", ".join(changed)
+        if step.is_up_to_date():
+            return "skip", "up to date"
+        try:
+            store, key = step.get_artifact_store()
+            if store is not None and store.contains(key):
+                return "restore", "restore from artifact cache"
+        except Exception as e:
+            self.announce("Can't check the artifact cache: %s" % e, 3)
+        return "run", "run"
+    
+    def show_plan(self, step_names, dependencies):
+        '''Announce what each step would do and the expected wall time'''
+        timings = self.read_timings()
+        ordered = order_steps(step_names, dependencies)
+        actions = {}
+        durations = {}
+        for step_name in ordered:
+            step = self.get_finalized_command(step_name)
+            changed = [d for d in dependencies[step_name]
+                       if isinstance(self.get_finalized_command(d),
+                                     StampedStep)
+                       and actions.get(d, ("skip",))[0] != "skip"]
+            actions[step_name] = self.get_planned_action(step, changed)
+            kind = actions[step_name][0]
+            if kind == "skip":
+                durations[step_name] = 0
+            else:
+                durations[step_name] = timings.get(step_name, {}).get(kind)
+        unknown = [step_name for step_name in ordered
+                   if durations[step_name] is None]
+        wall_time, critical_path = estimate_schedule(
+            ordered, dependencies,
+            dict([(step_name, durations[step_name] or 0)
+                  for step_name in ordered]), self.workers)
+        self.announce("Build plan, %d steps with %d workers "
+                      "(* = on the critical path):" %
+                      (len(ordered), self.workers), 2)
+        for step_name in ordered:
+            step = self.get_finalized_command(step_name)
+            kind, description = actions[step_name]
+            if durations[step_name] is None:
+                estimate = "?"
+            else:
+                estimate = "%.0fs" % durations[step_name]
+            self.announce("  %s %-18s %7s  %s" % (
+                "*" if step_name in critical_path else " ",
+                step_name, estimate, description), 2)
+            after = [d for d in dependencies[step_name] if d in ordered]
+            if after:
+                self.announce("        after: " + ", ".join(after), 2)
+            for attribute in ("url", "source_dir", "target_dir",
+                              "install_root", "install_dir",
+                              "extra_cmake_options"):
+                value = getattr(step, attribute, None)
+                if value:
+                    if isinstance(value, list):
+                        value = " ".join(value)
+                    self.announce("        %s: %s" % (attribute, value), 2)
+        self.announce("Estimated wall time: %.1f min, critical path: %s" %
+                      (wall_time / 60., " -> ".join(critical_path)), 2)
+        if unknown:
+            self.announce("No earlier timings for %s, counted as 0" %
+                          ", ".join(unknown), 2)
+    
+    def run_compiler_cache(self, *args):
+        '''Run the compiler cache with the given arguments
+        
+        Returns the output or None if there is no compiler cache or it
+        failed.
+        '''
+        if self.compiler_cache is None or self.dry_run:
+            return None
+        env = dict(os.environ, **compiler_cache_env(
+            self.compiler_cache, self.compiler_cache_dir))
+        try:
+            process = subprocess.Popen(
+                [self.compiler_cache] + list(args), env=env,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = process.communicate()[0]
+        except OSError as e:
+            self.announce("%s failed: %s" % (self.compiler_cache, e), 3)
+            return None
+        if process.returncode != 0:
+            self.announce("%s failed: %s" % (self.compiler_cache, output), 3)
+            return None
+        return output
+    
+    def get_compiler_cache_stats(self):
+        '''The compiler cache's counters or None if there is no cache'''
+        output = self.run_compiler_cache("--show-stats")
+        if output is None:
+            return None
+        return parse_compiler_cache_stats(output)
+    
+    def announce_compiler_cache_stats(self, before):
+        '''Announce how the compiler cache's counters changed in the build
+        
+        The cache directory can be shared with other builds, so the
+        counters aren't zeroed. Compiles by builds that ran at the same
+        time are counted too.
+        
+        before - the counters before the build started
+        '''
+        if before is None:
+            return
+        after = self.get_compiler_cache_stats()
+        if after is None:
+            return
+        before = dict(before)
+        self.announce("Compiler cache statistics for this build (%s):" %
+                      self.compiler_cache, 2)
+        for name, count in after:
+            change = count - before.get(name, 0)
+            if change != 0:
+                self.announce("    %s: %+d" % (name, change), 2)
+    
+    def needs_h5py(self):
+        return "h5py" not in get_installed_packages()
+        
+    def get_system_dependencies(self):
+        '''Name to details of the libraries taken from the system
+        
+        See SystemDependency.find for the details. The libraries are
+        looked for the first time this is called.
+        '''
+        if self.found_system_dependencies is not None:
+            return self.found_system_dependencies
+        found_system_dependencies = {}
+        wanted = [dependency for dependency in system_dependencies
+                  if self.system_deps == "auto" or
+                  dependency.name in self.system_deps]
+        found_all = find_system_dependencies(wanted, self.cmake or "cmake")
+        for dependency in wanted:
+            found = found_all[dependency.name]
+            if found is not None:
+                self.announce("Using the system's %s (%s)" % (
+                    " ".join([dependency.name, found["version"] or ""]).strip(),
+                    found["found_by"]), 2)
+                found_system_dependencies[dependency.name] = found
+            elif self.system_deps != "auto":
+                raise DistutilsError(
+                    "The system doesn't have %s" %
+                    dependency.get_requirement())
+        self.found_system_dependencies = found_system_dependencies
+        return found_system_dependencies
+    
+    def bundled(step_name):
+        '''A sub_commands predicate that skips a step that builds a library
+        the system has'''
+        def needs_step(self):
+            system = self.get_system_dependencies()
+            return not any([step_name in dependency.steps
+                            for dependency in system_dependencies
+                            if dependency.name in system])
+        return needs_step
         
     sub_commands = distutils.command.build.build.sub_commands + \
-        [('fetch_szip', None),
-         ('build_szip', None)]
+        [('fetch_szip', bundled('fetch_szip')),
+         ('build_szip', bundled('build_szip'))]
     
     if is_win:
         sub_commands += [
-            ('fetch_zlib', None),
-            ('build_zlib', None),
-            ('fetch_libhdf5', None),
-            ('build_libhdf5', None),
-	    ('fetch_jpeg', None),
-	    ('build_jpeg', None),
-	    ('fetch_libpng', None),
-	    ('build_libpng', None),
-	    ('fetch_tiff', None),
-	    ('build_tiff', None),
+            ('fetch_zlib', bundled('fetch_zlib')),
+            ('build_zlib', bundled('build_zlib')),
+            ('fetch_libhdf5', bundled('fetch_libhdf5')),
+            ('build_libhdf5', bundled('build_libhdf5')),
+            ('fetch_jpeg', bundled('fetch_jpeg')),
+            ('build_jpeg', bundled('build_jpeg')),
+            ('fetch_libpng', bundled('fetch_libpng')),
+            ('build_libpng', bundled('build_libpng')),
+            ('fetch_tiff', bundled('fetch_tiff')),
+            ('build_tiff', bundled('build_tiff')),
             ('fetch_h5py', needs_h5py),
             ('build_h5py', needs_h5py),
-            ('fetch_boost', None),
-            ('build_boost', None)]
+            ('fetch_boost', bundled('fetch_boost')),
+            ('build_boost', bundled('build_boost'))]
     sub_commands += [
         ('fetch_vigra', None),
         ('build_vigra', None),
         ('fetch_ilastik', None),
         ('install_ilastik', None)]
+    del bundled
+    
+class FilePatch(object):
+    '''A change to one file in a source tree, described as data
+    
+    path - the file's path relative to the source directory, with "/"
+    edits - a list of edits, each a tuple of an edit name and its
+            arguments. Line numbers are 1-based and refer to the file as
+            it was before any of the line edits:
+            ("delete_lines", first, last) - delete lines first to last
+            ("copy_line", line, before) - copy a line to before another
+            ("replace_in_line", line, old, new) - replace text in a line
+            ("replace", pattern, replacement) - re.sub over the file
+            ("delete_matching", pattern) - delete lines matching pattern
+            ("insert_before", pattern, text) - insert text before the
+                first line matching pattern
+            ("insert_after", pattern, text) - insert text after the first
+                line matching pattern
+            ("insert_at", index, text) - insert text at a list index into
+                the lines, e.g. -2 for before the last two lines
+            ("copy_file", path) - replace the contents with those of
+                another file in the source tree
+    pre_image - "<hash name>:<hex digest>" of the file that the edits were
+                written for, or None. Other contents are left alone.
+    post_image - "<hash name>:<hex digest>" of the patched file, or None.
+                 A file that already matches is left alone, and patching
+                 fails if the edits produce something else.
+    unless - a pattern that, if found in the file, means that it doesn't
+             need the patch, e.g. because upstream fixed it.
+    '''
+    def __init__(self, path, edits, pre_image=None, post_image=None,
+                 unless=None):
+        self.path = path
+        self.edits = edits
+        self.pre_image = pre_image
+        self.post_image = post_image
+        self.unless = unless
+        
+    def apply(self, source_dir, contents):
+        '''Return the result of applying the edits to the contents'''
+        lines = contents.splitlines(True)
+        deleted = set()
+        inserted = {}
+        text_edits = []
+        for edit in self.edits:
+            name, args = edit[0], edit[1:]
+            if name == "delete_lines":
+                first, last = args
+                deleted.update(range(first - 1, last))
+            elif name == "copy_line":
+                line, before = args
+                inserted.setdefault(before - 1, []).append(lines[line - 1])
+            elif name == "replace_in_line":
+                line, old, new = args
+                lines[line - 1] = lines[line - 1].replace(old, new)
+            else:
+                text_edits.append(edit)
+        lines = sum([inserted.get(i, []) + ([] if i in deleted else [line])
+                     for i, line in enumerate(lines)], [])
+        for edit in text_edits:
+            name, args = edit[0], edit[1:]
+            if name == "replace":
+                pattern, replacement = args
+                lines = re.sub(pattern, replacement, "".join(lines),
+                               flags=re.MULTILINE).splitlines(True)
+            elif name == "delete_matching":
+                lines = [line for line in lines
+                         if re.search(args[0], line) is None]
+            elif name in ("insert_before", "insert_after"):
+                pattern, text = args
+                for i, line in enumerate(lines):
+                    if re.search(pattern, line):
+                        if name == "insert_after":
+                            i += 1
+                        lines.insert(i, text)
+                        break
+            elif name == "insert_at":
+                index, text = args
+                lines.insert(len(lines) + index if index < 0 else index, text)
+            elif name == "copy_file":
+                with open(os.path.join(source_dir, args[0]), "rb") as fd:
+                    lines = fd.read().splitlines(True)
+            else:
+                raise DistutilsSetupError(
+                    "Unknown edit %r for %s" % (name, self.path))
+        return "".join(lines)
+
+def hash_matches(image, contents):
+    '''True if contents match a "<hash name>:<hex digest>" image'''
+    hash_name, _, digest = image.partition(":")
+    return hashlib.new(hash_name, contents).hexdigest() == digest.lower()
+
+def apply_patches(cmd, patches):
+    '''Apply FilePatches to the source directory of a fetch step
     
+    The state of each file is kept in build_lib/stamps/<step>-patches.json
+    so that a file that is still patched costs one hash check. A file that
+    is patched again, e.g. after the source was unpacked again, gets back
+    the modification time it had before if its patched contents are the
+    same, so that nothing that was built from it looks out of date.
+    '''
+    state_path = os.path.join(
+        cmd.build_lib, "stamps", cmd.get_step_name() + "-patches.json")
+    state = {}
+    if os.path.isfile(state_path):
+        with open(state_path, "r") as fd:
+            try:
+                state = json.load(fd)
+            except ValueError:
+                pass
+    for patch in patches:
+        path = os.path.join(cmd.source_dir, *patch.path.split("/"))
+        if os.path.isfile(path):
+            with open(path, "rb") as fd:
+                contents = fd.read()
+        else:
+            contents = ""
+        digest = "sha256:" + hashlib.sha256(contents).hexdigest()
+        previous = state.get(patch.path)
+        if previous is not None and previous["post"] == digest or \
+           patch.post_image is not None and \
+           hash_matches(patch.post_image, contents):
+            continue
+        if patch.pre_image is not None and \
+           not hash_matches(patch.pre_image, contents):
+            cmd.announce("Not patching %s, it isn't the expected version" %
+                         patch.path, 3)
+            continue
+        if patch.unless is not None and \
+           re.search(patch.unless, contents, re.MULTILINE):
+            continue
+        patched = patch.apply(cmd.source_dir, contents)
+        patched_digest = "sha256:" + hashlib.sha256(patched).hexdigest()
+        if patch.post_image is not None and \
+           not hash_matches(patch.post_image, patched):
+            raise DistutilsError("Patching %s didn't give the expected result"
+                                 % patch.path)
+        if patched == contents:
+            continue
+        cmd.announce("Patching " + patch.path, 2)
+        if cmd.dry_run:
+            continue
+        with open(path, "wb") as fd:
+            fd.write(patched)
+        if previous is not None and previous["post"] == patched_digest:
+            os.utime(path, (time.time(), previous["mtime"]))
+        state[patch.path] = dict(post=patched_digest,
+                                 mtime=os.path.getmtime(path))
+    cmd.patched_files = dict([
+        (patch.path, state[patch.path]["post"]) for patch in patches
+        if patch.path in state])
+    if not cmd.dry_run:
+        state_dir = os.path.dirname(state_path)
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        with open(state_path, "w") as fd:
+            json.dump(state, fd, indent=2, sort_keys=True)
+
+#
+# The SZip CMake file excludes ricehdf.h. It is the only private header,
+# so the private header section (lines 19-21) is deleted, ricehdf.h is put
+# in the public headers and the private headers are taken out of the
+# library definition.
+#
+szip_patches = [
+    FilePatch("src/CMakeLists.txt",
+              [("delete_lines", 19, 21),
+               ("copy_line", 20, 24),
+               ("replace_in_line", 28, "${SZIP_HDRS} ", "")],
+              pre_image="md5:fb8f11ef336e8d0a4d306aa479907979")]
+
+jpeg_patches = [
+    FilePatch("jconfig.h", [("copy_file", "jconfig.vc")])]
+
+#
+# missing ptrdiff_t: https://gcc.gnu.org/gcc-4.6/porting_to.html
+#
+vigra_patches = [
+    FilePatch("include/vigra/config.hxx",
+              [("insert_at", -2, "#include <cstddef>\n")],
+              unless=r"\s*#include\s+<cstddef>")]
+if is_win:
+    #
+    # Put the BOOST toolset def in
+    #
+    vigra_patches.append(FilePatch(
+        "CMakeLists.txt",
+        [("insert_after", r"IF\s\(MSVC\)",
+          'ADD_DEFINITIONS(-DBOOST_LIB_TOOLSET=\\"%s\\")\n' % toolset)],
+        unless="BOOST_LIB_TOOLSET"))
+
+#
+# ilastik.gui.volumeeditor - remove unused import of qimage2ndarray.qimageview
+# setup - search for .ui files everywhere under "ilastik"
+#
+ilastik_patches = [
+    FilePatch("ilastik/gui/volumeeditor.py",
+              [("delete_matching", "qimage2ndarray.qimageview")]),
+    FilePatch("setup.py",
+              [("insert_before", r"^setup\(", '''
+modulesFileList = []
+rootdir = 'ilastik/modules/'
+for root, subfolders, files in os.walk(rootdir):
+    for file in files:
+        if '.ui' in file:
+	    modulesFileList.append(os.path.join(root[len(rootdir):], file))
+'''),
+               ("replace", r"^(\s+package_data\s*=\s*{[^}\n]+)}",
+                r"\1, 'ilastik.modules' : modulesFileList}")])]
+
 def patch_szip(cmd):
     '''Patch the CMakeLists file to include ricehdf.h'''
-    expected_hash = 'fb8f11ef336e8d0a4d306aa479907979'
-    path = os.path.join(cmd.source_dir, "src", "CMakeLists.txt")
-    h = hashlib.md5(open(path, "rb").read())
-    if h.hexdigest() == expected_hash:
-        #
-        # SZip CMake needs patching. It excludes ricehdf.h
-        #
-        handle, filename = tempfile.mkstemp(suffix=".h")
-        fd = os.fdopen(handle, "w")
-        with open(path) as fdsrc:
-            for i, line in enumerate(fdsrc):
-                line_number = i+1
-                if line_number >= 19 and line_number < 22:
-                    # These are private header files and ricehdf.h
-                    # is the only one. So we delete the section.
-                    if line_number == 20:
-                        # This is the line that includes ricehdf.h
-                        saved = line
-                    continue
-                elif line_number == 24:
-                    # put the line in the public headers
-                    fd.write(saved)
-                elif line_number == 28:
-                    # remove the private headers from the library def
-                    line = line.replace("${SZIP_HDRS} ", "")
-                fd.write(line)
-        fd.close()
-        shutil.copyfile(filename, path)
+    apply_patches(cmd, szip_patches)
 	
 def patch_jpeg(cmd):
     '''patch the JPEG library'''
-    cmd.copy_file(os.path.join(cmd.source_dir, "jconfig.vc"),
-                  os.path.join(cmd.source_dir, "jconfig.h"))
+    apply_patches(cmd, jpeg_patches)
     
 def filter_boost(name):
     '''Filter out the image files in order to reduce the tarball size
@@ -855,202 +5402,143 @@ def filter_boost(name):
                    for ext in (".png", ".html")])
         
 def patch_vigra(cmd):
-    '''Patch Vigra to deal with future issues
-    
-    missing ptrdiff_t
-    https://gcc.gnu.org/gcc-4.6/porting_to.html
-    '''
-    config_hxx_path = os.path.join(
-        cmd.source_dir, "include", "vigra", "config.hxx")
-    pattern = r"\s*#include\s+<cstddef>"
-    with open(config_hxx_path, "r") as fdsrc:
-        lines = fdsrc.readlines()
-    if any([re.search(pattern, line) for line in lines]):
-        return
-    
-    lines.insert(len(lines) - 2, "#include <cstddef>\n")
-    with open(config_hxx_path, "w") as fd:
-        fd.write("".join(lines))
-    
-    #
-    # Put the BOOST toolset def in
-    #
-    cmakelists_path = os.path.join(cmd.source_dir, "CMakeLists.txt")
-    if is_win:
-	with open(cmakelists_path, "r") as fd:
-	    lines = fd.readlines()
-        with open(cmakelists_path, "w") as fd:
-	    first = True
-	    for line in lines:
-		fd.write(line)
-		if re.search(r"IF\s\(MSVC\)", line) and first:
-		    fd.write('ADD_DEFINITIONS(-DBOOST_LIB_TOOLSET=\\"%s\\")\n' %
-		             toolset)
-		    first = False
+    '''Patch Vigra to deal with future issues'''
+    apply_patches(cmd, vigra_patches)
     #
-    # Unpack the win32 dependencies
+    # Unpack the win32 dependencies, keeping their modification times
     #
-    tarball = zipfile.ZipFile(
-        os.path.join(cmd.source_dir, "vigra-dependencies-win32-vs8.zip"))
-    tarball.extractall(os.path.dirname(cmd.dependency_dir))
+    dependencies = os.path.join(
+        cmd.source_dir, "vigra-dependencies-win32-vs8.zip")
+    tarball = zipfile.ZipFile(dependencies)
+    ArchiveExtractor(os.path.dirname(cmd.dependency_dir)).extract_zip(tarball)
+    tarball.close()
 
 def patch_ilastik(cmd):
-    '''Ilastik source patches
-    
-    ilastik.gui.volumeeditor - remove unused import of qimage2ndarray.qimageview
-    setup - search for .ui files everywhere under "ilastik"
-    '''
-    path = os.path.join(cmd.source_dir, "ilastik", "gui", "volumeeditor.py")
-    lines = filter(
-        (lambda l:l.find("qimage2ndarray.qimageview") < 0),
-        open(path, "r").readlines())
-    with open(path, "w") as fd:
-	for line in lines:
-	    fd.write(line)
-	    
-    path = os.path.join(cmd.source_dir, "setup.py")
-    lines = open(path, "r").readlines()
-    pattern = r"""\s+package_data\s*=\s*{[^}]+}"""
-    with open(path, "w") as fd:
-	for line in lines:
-	    if line.startswith("setup("):
-		fd.write("""
-modulesFileList = []
-rootdir = 'ilastik/modules/'
-for root, subfolders, files in os.walk(rootdir):
-    for file in files:
-        if '.ui' in file:
-	    modulesFileList.append(os.path.join(root[len(rootdir):], file))
-""")
-	    elif re.search(pattern, line):
-		index = line.find("}")
-		line = line[:index] + ", 'ilastik.modules' : modulesFileList" +\
-		    line[index:]
-	    fd.write(line)
-
-try:
-    import h5py
-    libhdf5_version = h5py.version.hdf5_version
-except:
-    libhdf5_version = "1.8.11"
-
-try:
-    command_classes = dict([(cls.command_name, cls) for cls in (
-            BuildIlastik, BuildH5Py)])
-    for build_class in ('build_zlib', 'build_szip'):
-        command_classes[build_class] = BuildWithCMake
-    for fetch_command in ('fetch_libhdf5', 'fetch_szip', 'fetch_zlib',
-                          'fetch_boost', 'fetch_ilastik', 'fetch_fftw',
-                          'fetch_h5py', 'fetch_jpeg', 'fetch_libpng',
-                          'fetch_tiff'):
-        command_classes[fetch_command] = FetchSource
-    command_classes['build_boost'] = BuildBoost
-    command_classes['build_jpeg'] = BuildWithNMake
-    command_classes['build_libhdf5'] = BuildLibhdf5
-    command_classes['build_libpng'] = BuildLibpng
-    command_classes['build_tiff'] = BuildWithNMake
-    command_classes['fetch_vigra'] = FetchVigra
-    command_classes['build_vigra'] = BuildVigra
-    command_classes['install_ilastik'] = InstallIlastik
-    result = setuptools.setup(
-        cmdclass=command_classes,
-        options = {
-            'build_zlib': dict(
-                src_command='fetch_zlib',
-                extra_cmake_options = ["-DBUILD_SHARED_LIBS:BOOL=\"1\""]),
-            'build_szip': dict(
-                src_command='fetch_szip',
-                extra_cmake_options = ["-DBUILD_SHARED_LIBS:BOOL=\"1\""]),
-            'build_jpeg': dict(
-                src_command = 'fetch_jpeg',
-                makefile="Makefile.vc"),
-            'build_libhdf5': dict(
-                src_command='fetch_libhdf5',
-                extra_cmake_options = [
-                    '-DHDF5_ENABLE_SZIP_ENCODING:BOOL="1"',
-                    '-DBUILD_SHARED_LIBS:BOOL="1"',
-                    '-DHDF5_ENABLE_Z_LIB_SUPPORT:BOOL="1"',
-                    '-DHDF5_ENABLE_SZIP_SUPPORT:BOOL="1"',
-                    '-DHDF5_BUILD_HL_LIB:BOOL="1"',
-                    '-DSZIP_USE_EXTERNAL:BOOL="0"',
-                    '-DHDF5_ALLOW_EXTERNAL_SUPPORT:BOOL="0"',
-                    '-DHDF5_BUILD_CPP_LIB:BOOL="1"',
-                    '-DZLIB_USE_EXTERNAL:BOOL="0"',
-                    '-DCPACK_SOURCE_ZIP:BOOL="0"',
-                    "-DBUILD_SHARED_LIBS:BOOL=\"1\""]),
-            'build_libpng': dict(
-                src_command = 'fetch_libpng',
-                extra_cmake_options = [
-                    '-DPNG_NO_STDIO:BOOL="0"'
-                    ]),
-            'build_tiff': dict(
-                src_command = 'fetch_tiff',
-                makefile = "Makefile.vc"),
-            'build_vigra': dict(
-                src_command='fetch_vigra',
-                extra_cmake_options = [
-                    '-DCPACK_SOURCE_ZIP:BOOL="0"',
-                    '-DCPACK_SOURCE_7Z:BOOL="0"'],
-                do_install = False
-            ),
-            'fetch_jpeg': {
-                'package_name': 'jpeg',
-                'version': '8b',
-                'url': 'http://cellprofiler.org/linux/SOURCES/jpegsrc.v8b.tar.gz',
-                'post_fetch': patch_jpeg
-                },
-            'fetch_libpng': {
-                'version': '1.4.5',
-                'url': 'http://cellprofiler.org/linux/SOURCES/libpng-1.4.5.tar.bz2'
-                },
-            'fetch_tiff': {
-                'version': '3.9.4',
-                'url': 'http://cellprofiler.org/linux/SOURCES/tiff-3.9.4.tar.gz'
+    '''Ilastik source patches'''
+    apply_patches(cmd, ilastik_patches)
+
+if __name__ == "__main__":
+    try:
+        command_classes = dict([(cls.command_name, cls) for cls in (
+                BuildIlastik, BuildH5Py)])
+        for build_class in ('build_zlib', 'build_szip'):
+            command_classes[build_class] = BuildWithCMake
+        for fetch_command in ('fetch_szip', 'fetch_zlib',
+                              'fetch_boost', 'fetch_ilastik', 'fetch_fftw',
+                              'fetch_h5py', 'fetch_jpeg', 'fetch_libpng',
+                              'fetch_tiff'):
+            command_classes[fetch_command] = FetchSource
+        command_classes['build_boost'] = BuildBoost
+        command_classes['build_jpeg'] = BuildWithNMake
+        command_classes['fetch_libhdf5'] = FetchLibhdf5
+        command_classes['build_libhdf5'] = BuildLibhdf5
+        command_classes['build_libpng'] = BuildLibpng
+        command_classes['build_tiff'] = BuildWithNMake
+        command_classes['fetch_vigra'] = FetchVigra
+        command_classes['build_vigra'] = BuildVigra
+        command_classes['install_ilastik'] = InstallIlastik
+        command_classes['bench_extract'] = BenchmarkExtract
+        command_classes['benchmark'] = Benchmark
+        result = setuptools.setup(
+            cmdclass=command_classes,
+            options = {
+                'build_zlib': dict(
+                    src_command='fetch_zlib',
+                    extra_cmake_options = ["-DBUILD_SHARED_LIBS:BOOL=\"1\""]),
+                'build_szip': dict(
+                    src_command='fetch_szip',
+                    extra_cmake_options = ["-DBUILD_SHARED_LIBS:BOOL=\"1\""]),
+                'build_jpeg': dict(
+                    src_command = 'fetch_jpeg',
+                    makefile="Makefile.vc"),
+                'build_libhdf5': dict(
+                    src_command='fetch_libhdf5',
+                    extra_cmake_options = [
+                        '-DHDF5_ENABLE_SZIP_ENCODING:BOOL="1"',
+                        '-DBUILD_SHARED_LIBS:BOOL="1"',
+                        '-DHDF5_ENABLE_Z_LIB_SUPPORT:BOOL="1"',
+                        '-DHDF5_ENABLE_SZIP_SUPPORT:BOOL="1"',
+                        '-DHDF5_BUILD_HL_LIB:BOOL="1"',
+                        '-DSZIP_USE_EXTERNAL:BOOL="0"',
+                        '-DHDF5_ALLOW_EXTERNAL_SUPPORT:BOOL="0"',
+                        '-DHDF5_BUILD_CPP_LIB:BOOL="1"',
+                        '-DZLIB_USE_EXTERNAL:BOOL="0"',
+                        '-DCPACK_SOURCE_ZIP:BOOL="0"',
+                        "-DBUILD_SHARED_LIBS:BOOL=\"1\""]),
+                'build_libpng': dict(
+                    src_command = 'fetch_libpng',
+                    extra_cmake_options = [
+                        '-DPNG_NO_STDIO:BOOL="0"'
+                        ]),
+                'build_tiff': dict(
+                    src_command = 'fetch_tiff',
+                    makefile = "Makefile.vc"),
+                'build_vigra': dict(
+                    src_command='fetch_vigra',
+                    extra_cmake_options = [
+                        '-DCPACK_SOURCE_ZIP:BOOL="0"',
+                        '-DCPACK_SOURCE_7Z:BOOL="0"'],
+                    do_install = False
+                ),
+                'fetch_jpeg': {
+                    'package_name': 'jpeg',
+                    'version': '8b',
+                    'url': 'http://cellprofiler.org/linux/SOURCES/jpegsrc.v8b.tar.gz',
+                    'post_fetch': patch_jpeg
+                    },
+                'fetch_libpng': {
+                    'version': '1.4.5',
+                    'url': 'http://cellprofiler.org/linux/SOURCES/libpng-1.4.5.tar.bz2'
+                    },
+                'fetch_tiff': {
+                    'version': '3.9.4',
+                    'url': 'http://cellprofiler.org/linux/SOURCES/tiff-3.9.4.tar.gz'
+                    },
+                'fetch_szip': {
+                    'version': '2.1',
+                    'url': "https://www.hdfgroup.org/ftp/lib-external/{package_name}/{version}/src/{package_name}-{version}.tar.gz",
+                    'post_fetch': patch_szip
+                }, 
+                'fetch_zlib': {
+                    'version': '1.2.5',
+                    'url': "https://www.hdfgroup.org/ftp/lib-external/{package_name}/{package_name}-{version}.tar.gz"
                 },
-            'fetch_szip': {
-                'version': '2.1',
-                'url': "https://www.hdfgroup.org/ftp/lib-external/{package_name}/{version}/src/{package_name}-{version}.tar.gz",
-                'post_fetch': patch_szip
-            }, 
-            'fetch_zlib': {
-                'version': '1.2.5',
-                'url': "https://www.hdfgroup.org/ftp/lib-external/{package_name}/{package_name}-{version}.tar.gz"
+                'fetch_libhdf5': {
+                    'package_name': 'hdf5',
+                    'url': "https://www.hdfgroup.org/ftp/HDF5/releases/{package_name}-{version}/src/{package_name}-{version}.zip"
+                    },
+                'fetch_boost': {
+                    'version': '1.53.0',
+                    'full_name': '{package_name}_1_53_0',
+                    'url': "http://cellprofiler.org/linux/SOURCES/{full_name}.tar.bz2",
+                    'member_filter': filter_boost
+                    },
+                'fetch_h5py': {
+                    'version': '2.3.1'
+                    },
+                'fetch_fftw': {
+                    'version': '3.2.2',
+                    'url': "http://cellprofiler.org/linux/SOURCES/{package_name}-{version}.tar.gz"
+                    },
+                'fetch_vigra': {
+                    'version': '1.7.1',
+                    'url': "https://github.com/LeeKamentsky/vigra-ilastik-05/archive/Version-1-7-1.tar.gz",
+                    'tarball_source_dir': 'vigra-ilastik-05-Version-1-7-1',
+                    'post_fetch': patch_vigra
+                    },
+                'fetch_ilastik': {
+                    'version': 'v0.5.05',
+                    'git_repository': "https://github.com/LeeKamentsky/ilastik-0.5.git",
+                    'git_ref': 'cellprofiler/master',
+                    'url':"https://github.com/LeeKamentsky/ilastik-0.5/archive/{commit}.tar.gz",
+                    'tarball_source_dir': 'ilastik-0.5-{commit}',
+                    #'post_fetch': patch_ilastik
+                    }
             },
-            'fetch_libhdf5': {
-                'package_name': 'hdf5',
-                'version': libhdf5_version,
-                'url': "https://www.hdfgroup.org/ftp/HDF5/releases/{package_name}-{version}/src/{package_name}-{version}.zip"
-                },
-            'fetch_boost': {
-                'version': '1.53.0',
-                'full_name': '{package_name}_1_53_0',
-                'url': "http://cellprofiler.org/linux/SOURCES/{full_name}.tar.bz2",
-                'member_filter': filter_boost
-                },
-            'fetch_h5py': {
-                'version': '2.3.1'
-                },
-            'fetch_fftw': {
-                'version': '3.2.2',
-                'url': "http://cellprofiler.org/linux/SOURCES/{package_name}-{version}.tar.gz"
-                },
-            'fetch_vigra': {
-                'version': '1.7.1',
-                'url': "https://github.com/LeeKamentsky/vigra-ilastik-05/archive/Version-1-7-1.tar.gz",
-                'tarball_source_dir': 'vigra-ilastik-05-Version-1-7-1',
-                'post_fetch': patch_vigra
-                },
-            'fetch_ilastik': {
-                'version': 'v0.5.05',
-                'url':"https://github.com/LeeKamentsky/ilastik-0.5/archive/cellprofiler/master.tar.gz",
-                'tarball_source_dir': 'ilastik-0.5-cellprofiler-master',
-                #'post_fetch': patch_ilastik
-                }
-        },
-        setup_requires = ["requests"]
-    )
-except:
-    import traceback
-    traceback.print_exc()
-    sys.exit(1)
-sys.exit(0)
+            setup_requires = ["requests"]
+        )
+    except:
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+    sys.exit(0)
@@ -0,0 +1,199 @@
+'''Helpers shared by the tests of setup.py's build commands'''
+import BaseHTTPServer
+import distutils.log
+import hashlib
+import imp
+import os
+import shutil
+import SocketServer
+import StringIO
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+
+from setuptools.dist import Distribution
+
+def load_setup():
+    '''Import setup.py as a module, without running setup()'''
+    distutils.log.set_threshold(distutils.log.ERROR)
+    if "ilastik_setup" not in sys.modules:
+        imp.load_source("ilastik_setup", os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "..", "setup.py"))
+    return sys.modules["ilastik_setup"]
+
+def make_distribution(directory, cache_dir="none", **command_classes):
+    '''A Distribution whose build command builds under a directory
+
+    directory - the build base is directory/build
+    cache_dir - the build's cache directory or "none" for no caches
+    command_classes - the build steps to add, by command name
+    '''
+    setup = load_setup()
+    command_classes["build"] = setup.BuildIlastik
+    distribution = Distribution(dict(cmdclass=command_classes))
+    distribution.verbose = 0
+    build = distribution.get_command_obj("build")
+    build.build_base = os.path.join(directory, "build")
+    build.build_lib = os.path.join(directory, "build", "lib")
+    build.cache_dir = cache_dir
+    build.system_deps = "none"
+    return distribution
+
+def make_hdf5_distribution(directory, scratch_dir=None):
+    '''A Distribution that builds HDF5 with zlib and szip
+
+    The archives' digests are pinned, so the builds are cacheable.
+    '''
+    setup = load_setup()
+    distribution = make_distribution(
+        directory, os.path.join(directory, "cache"),
+        fetch_zlib=setup.FetchSource, fetch_szip=setup.FetchSource,
+        fetch_libhdf5=setup.FetchSource,
+        build_zlib=setup.BuildWithCMake, build_szip=setup.BuildWithCMake,
+        build_libhdf5=setup.BuildLibhdf5)
+    distribution.get_command_obj("build").scratch_dir = scratch_dir
+    for name, version in (("zlib", "1.2.5"), ("szip", "2.1"),
+                          ("libhdf5", "1.8.9")):
+        fetch = distribution.get_command_obj("fetch_" + name)
+        fetch.version = version
+        fetch.url = "http://example.com/%s.tar.gz" % name
+        fetch.sha256 = hashlib.sha256(name).hexdigest()
+        distribution.get_command_obj("build_" + name).src_command = \
+            "fetch_" + name
+    return distribution
+
+def make_tarball(files, mode="w:gz"):
+    '''The bytes of a tarball of a dictionary of name to contents'''
+    data = StringIO.StringIO()
+    tarball = tarfile.open(fileobj=data, mode=mode)
+    for name, contents in sorted(files.items()):
+        info = tarfile.TarInfo(name)
+        info.size = len(contents)
+        info.mtime = 1000000000
+        tarball.addfile(info, StringIO.StringIO(contents))
+    tarball.close()
+    return data.getvalue()
+
+class ServedFile(object):
+    '''What the LocalServer sends for one path
+
+    data - the file's contents
+    etag - the ETag header, or None to send none
+    ranges - False to ignore Range headers and always send the whole file
+    drops - the number of responses to cut short before the server sends
+            whole responses again
+    drop_after - the number of bytes to send before cutting a response short
+    delay - seconds to wait before answering
+    status - an error status to answer with instead, e.g. 404
+    '''
+    def __init__(self, data, etag=None, ranges=True, drops=0,
+                 drop_after=0, delay=0, status=None):
+        self.data = data
+        self.etag = etag
+        self.ranges = ranges
+        self.drops = drops
+        self.drop_after = drop_after
+        self.delay = delay
+        self.status = status
+
+class LocalServer(object):
+    '''A threaded HTTP server on 127.0.0.1 that serves ServedFiles
+
+    files - a dictionary of path, e.g. "/a.tar.gz", to ServedFile
+    requests - (path, Range header, If-Range header) of each request
+    '''
+    def __init__(self):
+        self.files = {}
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                served = server.files.get(self.path)
+                server.requests.append((self.path,
+                                        self.headers.get("Range"),
+                                        self.headers.get("If-Range")))
+                if served is None:
+                    self.send_error(404)
+                    return
+                if served.delay:
+                    time.sleep(served.delay)
+                if served.status is not None:
+                    self.send_error(served.status)
+                    return
+                data = served.data
+                start = 0
+                end = len(data) - 1
+                requested = self.headers.get("Range")
+                if_range = self.headers.get("If-Range")
+                if requested is not None and served.ranges and \
+                   (if_range is None or if_range == served.etag):
+                    first, _, last = \
+                        requested.partition("=")[2].partition("-")
+                    start = int(first)
+                    if last:
+                        end = min(int(last), end)
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes %d-%d/%d" %
+                                     (start, end, len(data)))
+                else:
+                    self.send_response(200)
+                if served.etag is not None:
+                    self.send_header("ETag", served.etag)
+                self.send_header("Content-Length", str(end + 1 - start))
+                self.end_headers()
+                body = data[start:end + 1]
+                if served.drops > 0:
+                    served.drops -= 1
+                    self.wfile.write(body[:served.drop_after])
+                    self.wfile.flush()
+                    self.close_connection = 1
+                    return
+                self.wfile.write(body)
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return "http://127.0.0.1:%d%s" % (self.server.server_address[1], path)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class FetchTestCase(unittest.TestCase):
+    '''A test case with a LocalServer and a scratch build directory'''
+    def setUp(self):
+        self.setup = load_setup()
+        self.server = LocalServer()
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.directory, "cache")
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def make_fetch(self, url, **options):
+        '''A finalized FetchSource for the URL with no retry delay'''
+        distribution = make_distribution(
+            self.directory, self.cache_dir, fetch_test=self.setup.FetchSource)
+        fetch = distribution.get_command_obj("fetch_test")
+        fetch.url = url
+        fetch.package_name = "test"
+        fetch.version = "1"
+        fetch.retry_delay = 0
+        for name, value in options.items():
+            setattr(fetch, name, value)
+        fetch.ensure_finalized()
+        return fetch
@@ -0,0 +1,98 @@
+'''Tests of reading the compiler cache's statistics'''
+import shutil
+import tempfile
+import unittest
+
+from distutils.errors import DistutilsOptionError
+
+from tests.support import load_setup, make_distribution
+
+setup = load_setup()
+
+CCACHE_3 = '''cache directory                     /home/me/.ccache
+primary config                      /home/me/.ccache/ccache.conf
+stats zero time                     Tue Oct 10 10:00:00 2023
+cache hit (direct)                    12
+cache hit (preprocessed)               3
+cache miss                            40
+cache hit rate                     27.27 %
+files in cache                       130
+cache size                           1.2 MB
+max cache size                       5.0 GB
+'''
+
+CCACHE_4 = '''Cacheable calls:   55 / 60 (91.67%)
+  Hits:            15 / 55 (27.27%)
+    Direct:        12 / 15 (80.00%)
+    Preprocessed:   3 / 15 (20.00%)
+  Misses:          40 / 55 (72.73%)
+Uncacheable calls:  5 / 60 ( 8.33%)
+Local storage:
+  Cache size (GB): 0.0 / 5.0 ( 0.03%)
+  Hits:            15 / 55 (27.27%)
+  Misses:          40 / 55 (72.73%)
+'''
+
+SCCACHE = '''Compile requests                     60
+Compile requests executed            55
+Cache hits                           15
+Cache misses                         40
+Cache hits rate                   27.27 %
+Cache location                  Local disk: "/home/me/.cache/sccache"
+Max cache size                       10 GiB
+'''
+
+class TestParseStats(unittest.TestCase):
+    def test_ccache_3(self):
+        self.assertEqual(setup.parse_compiler_cache_stats(CCACHE_3), [
+            ("cache hit (direct)", 12), ("cache hit (preprocessed)", 3),
+            ("cache miss", 40), ("files in cache", 130)])
+
+    def test_ccache_4_names_nested_counters(self):
+        stats = dict(setup.parse_compiler_cache_stats(CCACHE_4))
+        self.assertEqual(stats["Cacheable calls / Hits / Direct"], 12)
+        self.assertEqual(stats["Cacheable calls / Misses"], 40)
+        self.assertEqual(stats["Local storage / Hits"], 15)
+        self.assertNotIn("Local storage / Cache size (GB)", stats)
+
+    def test_sccache(self):
+        self.assertEqual(setup.parse_compiler_cache_stats(SCCACHE), [
+            ("Compile requests", 60), ("Compile requests executed", 55),
+            ("Cache hits", 15), ("Cache misses", 40)])
+
+class StatsBuild(setup.BuildIlastik):
+    '''A build whose compiler cache reports canned statistics'''
+    def run_compiler_cache(self, *args):
+        return self.outputs.pop(0)
+
+    def announce(self, msg, level=1):
+        self.messages.append(msg)
+
+class TestAnnounceStats(unittest.TestCase):
+    def test_announces_only_changes_in_this_build(self):
+        build = StatsBuild(make_distribution(tempfile.gettempdir()))
+        build.outputs = [CCACHE_3, CCACHE_3.replace(
+            "cache miss                            40",
+            "cache miss                            45")]
+        before = build.get_compiler_cache_stats()
+        build.messages = []
+        build.announce_compiler_cache_stats(before)
+        self.assertEqual(build.messages[1:], ["    cache miss: +5"])
+
+class TestWindows(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.is_win = setup.is_win
+        setup.is_win = True
+
+    def tearDown(self):
+        setup.is_win = self.is_win
+        shutil.rmtree(self.directory)
+
+    def test_only_sccache(self):
+        build = make_distribution(self.directory).get_command_obj("build")
+        build.compiler_cache = "ccache"
+        self.assertRaises(DistutilsOptionError, build.ensure_finalized)
+
+if __name__ == "__main__":
+    unittest.main()
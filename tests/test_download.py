@@ -0,0 +1,217 @@
+'''Tests of FetchSource's downloads against a local HTTP server'''
+import hashlib
+import os
+import threading
+import unittest
+
+from distutils.errors import DistutilsError
+
+from tests.support import FetchTestCase, ServedFile
+
+DATA = "".join(["%08d\n" % i for i in range(40000)])
+
+class TestIterDownload(FetchTestCase):
+    def test_whole_file(self):
+        self.server.files["/a.tar.gz"] = ServedFile(DATA)
+        fetch = self.make_fetch(self.server.url("/a.tar.gz"))
+        self.assertEqual("".join(fetch.iter_download()), DATA)
+        self.assertEqual(fetch.fetched_from, self.server.url("/a.tar.gz"))
+
+    def test_resumes_dropped_connection_with_range(self):
+        self.server.files["/a.tar.gz"] = ServedFile(
+            DATA, drops=1, drop_after=100000)
+        fetch = self.make_fetch(self.server.url("/a.tar.gz"))
+        self.assertEqual("".join(fetch.iter_download()), DATA)
+        self.assertEqual([r[1] for r in self.server.requests],
+                         [None, "bytes=100000-"])
+
+    def test_restarts_without_range_support(self):
+        self.server.files["/a.tar.gz"] = ServedFile(
+            DATA, ranges=False, drops=2, drop_after=50000)
+        fetch = self.make_fetch(self.server.url("/a.tar.gz"))
+        self.assertEqual("".join(fetch.iter_download()), DATA)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_starts_at_offset(self):
+        self.server.files["/a.tar.gz"] = ServedFile(DATA)
+        fetch = self.make_fetch(self.server.url("/a.tar.gz"))
+        self.assertEqual("".join(fetch.iter_download(1000)), DATA[1000:])
+
+    def test_gives_up_after_retries(self):
+        self.server.files["/a.tar.gz"] = ServedFile(
+            DATA, drops=10, drop_after=1000)
+        fetch = self.make_fetch(self.server.url("/a.tar.gz"), retries=2)
+        self.assertRaises(DistutilsError, "".join, fetch.iter_download())
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_does_not_retry_not_found(self):
+        fetch = self.make_fetch(self.server.url("/missing.tar.gz"))
+        self.assertRaises(DistutilsError, "".join, fetch.iter_download())
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_retries_server_errors(self):
+        served = ServedFile(DATA, status=503)
+        self.server.files["/a.tar.gz"] = served
+        fetch = self.make_fetch(self.server.url("/a.tar.gz"), retries=1)
+        self.assertRaises(DistutilsError, "".join, fetch.iter_download())
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_changed_data_raises_source_changed(self):
+        self.server.files["/a.tar.gz"] = ServedFile(DATA, etag='"v2"')
+        fetch = self.make_fetch(self.server.url("/a.tar.gz"))
+        validators = {self.server.url("/a.tar.gz"): '"v1"'}
+        self.assertRaises(self.setup.SourceChanged, "".join,
+                          fetch.iter_download(1000, validators))
+        self.assertEqual(self.server.requests[0][2], '"v1"')
+
+class TestMirrors(FetchTestCase):
+    def make_mirrored_fetch(self):
+        return self.make_fetch(
+            self.server.url("/slow/a.tar.gz"),
+            mirrors=self.server.url("/fast/a.tar.gz"))
+
+    def test_fastest_mirror_first(self):
+        self.server.files["/slow/a.tar.gz"] = ServedFile(DATA, delay=.5)
+        self.server.files["/fast/a.tar.gz"] = ServedFile(DATA)
+        fetch = self.make_mirrored_fetch()
+        self.assertEqual(fetch.get_mirror_order(), [
+            self.server.url("/fast/a.tar.gz"),
+            self.server.url("/slow/a.tar.gz")])
+
+    def test_fails_over_to_mirror(self):
+        self.server.files["/slow/a.tar.gz"] = ServedFile(DATA)
+        self.server.files["/fast/a.tar.gz"] = ServedFile(DATA, status=404)
+        fetch = self.make_mirrored_fetch()
+        self.assertEqual("".join(fetch.iter_download()), DATA)
+        self.assertEqual(fetch.fetched_from, self.server.url("/slow/a.tar.gz"))
+
+    def test_resumes_from_next_mirror(self):
+        self.server.files["/slow/a.tar.gz"] = ServedFile(DATA, delay=.5)
+        self.server.files["/fast/a.tar.gz"] = ServedFile(
+            DATA, drops=10, drop_after=100000)
+        fetch = self.make_mirrored_fetch()
+        self.assertEqual("".join(fetch.iter_download()), DATA)
+        self.assertEqual(fetch.fetched_from, self.server.url("/slow/a.tar.gz"))
+        self.assertIn(("/slow/a.tar.gz", "bytes=100000-", None),
+                      self.server.requests)
+
+    def test_remembers_throughput(self):
+        self.server.files["/slow/a.tar.gz"] = ServedFile(DATA)
+        self.server.files["/fast/a.tar.gz"] = ServedFile(DATA)
+        fetch = self.make_mirrored_fetch()
+        "".join(fetch.iter_download())
+        self.assertIsNotNone(
+            fetch.get_mirror_stats().get_throughput(fetch.fetched_from))
+
+class TestDownload(FetchTestCase):
+    def test_get_archive_records_digest(self):
+        self.server.files["/a.tar.gz"] = ServedFile(DATA)
+        fetch = self.make_fetch(self.server.url("/a.tar.gz"))
+        path = fetch.get_archive()
+        self.assertEqual(path, fetch.get_cache_path())
+        with open(path + ".sha256") as fd:
+            self.assertEqual(fd.read(), hashlib.sha256(DATA).hexdigest())
+        self.assertEqual(os.listdir(os.path.dirname(path)),
+                         ["a.tar.gz", "a.tar.gz.sha256"])
+
+    def get_archive_warnings(self, **options):
+        '''The warnings announced by get_archive'''
+        fetch = self.make_fetch(self.server.url("/a.tar.gz"), **options)
+        warnings = []
+        def announce(msg, level=1):
+            if level >= 3:
+                warnings.append(msg)
+        fetch.announce = announce
+        fetch.get_archive()
+        return warnings
+
+    def test_warns_about_unpinned_digest(self):
+        self.server.files["/a.tar.gz"] = ServedFile(DATA)
+        warnings = self.get_archive_warnings()
+        self.assertEqual(len(warnings), 1)
+        self.assertIn(hashlib.sha256(DATA).hexdigest(), warnings[0])
+
+    def test_pinned_digest_gives_no_warning(self):
+        self.server.files["/a.tar.gz"] = ServedFile(DATA)
+        self.assertEqual(self.get_archive_warnings(
+            sha256=hashlib.sha256(DATA).hexdigest()), [])
+
+    def test_rejects_wrong_digest(self):
+        self.server.files["/a.tar.gz"] = ServedFile(DATA)
+        fetch = self.make_fetch(self.server.url("/a.tar.gz"),
+                                sha256="0" * 64)
+        self.assertRaises(DistutilsError, fetch.get_archive)
+        self.assertFalse(os.path.exists(fetch.get_cache_path()))
+
+    def interrupt(self, served, **options):
+        '''Fail a download partway through, leaving a partial download'''
+        served.drops = 1
+        served.drop_after = 100000
+        fetch = self.make_fetch(self.server.url("/a.tar.gz"), retries=0,
+                                **options)
+        self.assertRaises(DistutilsError, fetch.get_archive)
+        self.assertTrue(os.path.isdir(fetch.get_cache_path() + ".partial"))
+        del self.server.requests[:]
+
+    def test_resumes_partial_download_if_unchanged(self):
+        served = ServedFile(DATA, etag='"v1"')
+        self.server.files["/a.tar.gz"] = served
+        self.interrupt(served)
+        path = self.make_fetch(self.server.url("/a.tar.gz")).get_archive()
+        with open(path, "rb") as fd:
+            self.assertEqual(fd.read(), DATA)
+        self.assertEqual(self.server.requests,
+                         [("/a.tar.gz", "bytes=100000-", '"v1"')])
+        self.assertFalse(os.path.exists(path + ".partial"))
+
+    def test_starts_over_if_changed(self):
+        served = ServedFile(DATA, etag='"v1"')
+        self.server.files["/a.tar.gz"] = served
+        self.interrupt(served)
+        served.data = DATA.upper() + "changed"
+        served.etag = '"v2"'
+        path = self.make_fetch(self.server.url("/a.tar.gz")).get_archive()
+        with open(path, "rb") as fd:
+            self.assertEqual(fd.read(), served.data)
+
+    def test_resumes_pinned_download_without_validator(self):
+        served = ServedFile(DATA)
+        self.server.files["/a.tar.gz"] = served
+        digest = hashlib.sha256(DATA).hexdigest()
+        self.interrupt(served, sha256=digest)
+        path = self.make_fetch(self.server.url("/a.tar.gz"),
+                               sha256=digest).get_archive()
+        with open(path, "rb") as fd:
+            self.assertEqual(fd.read(), DATA)
+        self.assertEqual(self.server.requests,
+                         [("/a.tar.gz", "bytes=100000-", None)])
+
+    def test_drops_unverifiable_partial_download(self):
+        served = ServedFile(DATA)
+        self.server.files["/a.tar.gz"] = served
+        served.drops = 1
+        served.drop_after = 100000
+        fetch = self.make_fetch(self.server.url("/a.tar.gz"), retries=0)
+        self.assertRaises(DistutilsError, fetch.get_archive)
+        self.assertFalse(os.path.exists(fetch.get_cache_path() + ".partial"))
+
+    def test_concurrent_downloads_share_the_cache(self):
+        self.server.files["/a.tar.gz"] = ServedFile(DATA)
+        fetches = [self.make_fetch(self.server.url("/a.tar.gz"))
+                   for _ in range(4)]
+        paths = []
+        threads = [threading.Thread(
+            target=lambda fetch=fetch: paths.append(fetch.get_archive()))
+                   for fetch in fetches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(paths), 4)
+        with open(paths[0], "rb") as fd:
+            self.assertEqual(fd.read(), DATA)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(paths[0]))),
+                         ["a.tar.gz", "a.tar.gz.sha256"])
+
+if __name__ == "__main__":
+    unittest.main()
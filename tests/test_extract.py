@@ -0,0 +1,270 @@
+'''Tests of unpacking archives'''
+import hashlib
+import os
+import shutil
+import StringIO
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+from distutils.errors import DistutilsError
+
+from tests.support import FetchTestCase, ServedFile, load_setup, \
+     make_tarball
+
+def read_tree(directory):
+    '''A dictionary of relative path to contents of the files under a dir'''
+    result = {}
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path, "rb") as fd:
+                result[os.path.relpath(path, directory)] = fd.read()
+    return result
+
+FILES = {
+    "test-1/README": "read me\n",
+    "test-1/src/a.c": "int a;\n" * 1000,
+    "test-1/src/b.c": "int b;\n" * 1000}
+
+class TestArchiveExtractor(unittest.TestCase):
+    def setUp(self):
+        self.setup = load_setup()
+        self.directory = tempfile.mkdtemp()
+        self.dest = os.path.join(self.directory, "dest")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def extract_tar(self, data, **options):
+        extractor = self.setup.ArchiveExtractor(self.dest, **options)
+        tarball = tarfile.open(fileobj=StringIO.StringIO(data), mode="r|*")
+        extractor.extract_tar(tarball)
+        tarball.close()
+        return extractor
+
+    def test_unpacks_files_with_attributes(self):
+        extractor = self.extract_tar(make_tarball(FILES), workers=3)
+        self.assertEqual(read_tree(self.dest), FILES)
+        self.assertEqual(extractor.files_written, 3)
+        self.assertEqual(extractor.bytes_written,
+                         sum(len(contents) for contents in FILES.values()))
+        self.assertEqual(os.path.getmtime(
+            os.path.join(self.dest, "test-1", "src", "a.c")), 1000000000)
+
+    def test_copies_big_files_in_buffers(self):
+        extractor = self.setup.ArchiveExtractor(self.dest, buffer_size=100)
+        extractor.large_file_size = 1000
+        tarball = tarfile.open(
+            fileobj=StringIO.StringIO(make_tarball(FILES)), mode="r|*")
+        extractor.extract_tar(tarball)
+        self.assertEqual(read_tree(self.dest), FILES)
+
+    def test_links_and_directories(self):
+        data = StringIO.StringIO()
+        tarball = tarfile.open(fileobj=data, mode="w")
+        directory = tarfile.TarInfo("top/dir")
+        directory.type = tarfile.DIRTYPE
+        directory.mode = 0755
+        directory.mtime = 1000000000
+        tarball.addfile(directory)
+        info = tarfile.TarInfo("top/dir/file")
+        info.size = 5
+        tarball.addfile(info, StringIO.StringIO("hello"))
+        for name, kind in (("top/symlink", tarfile.SYMTYPE),
+                           ("top/hardlink", tarfile.LNKTYPE)):
+            link = tarfile.TarInfo(name)
+            link.type = kind
+            link.linkname = "dir/file" if kind == tarfile.SYMTYPE \
+                else "top/dir/file"
+            tarball.addfile(link)
+        tarball.close()
+        self.extract_tar(data.getvalue())
+        top = os.path.join(self.dest, "top")
+        self.assertEqual(os.readlink(os.path.join(top, "symlink")),
+                         "dir/file")
+        with open(os.path.join(top, "hardlink"), "rb") as fd:
+            self.assertEqual(fd.read(), "hello")
+        self.assertEqual(os.path.getmtime(os.path.join(top, "dir")),
+                         1000000000)
+
+    def test_member_filter(self):
+        self.extract_tar(make_tarball(FILES),
+                         member_filter=lambda name: name.endswith(".c"))
+        self.assertEqual(sorted(read_tree(self.dest)),
+                         [os.path.join("test-1", "src", "a.c"),
+                          os.path.join("test-1", "src", "b.c")])
+
+    def test_refuses_members_outside_dest(self):
+        data = make_tarball({"../outside": "x"})
+        self.assertRaises(DistutilsError, self.extract_tar, data)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, "outside")))
+
+    def test_zip(self):
+        data = StringIO.StringIO()
+        zip_file = zipfile.ZipFile(data, "w")
+        for name, contents in FILES.items():
+            zip_file.writestr(name, contents)
+        zip_file.close()
+        extractor = self.setup.ArchiveExtractor(self.dest)
+        extractor.extract_zip(zipfile.ZipFile(data))
+        self.assertEqual(read_tree(self.dest), FILES)
+
+class TestDecompressors(unittest.TestCase):
+    def setUp(self):
+        self.setup = load_setup()
+        self.decompressors = self.setup.decompressors
+        self.setup.decompressors = [
+            ((".gz", ".tgz"), [["no-such-decompressor", "-d"],
+                               ["gzip", "-d", "-c"]])]
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.setup.decompressors = self.decompressors
+        shutil.rmtree(self.directory)
+
+    def test_find_decompressor(self):
+        command = self.setup.find_decompressor("A.TAR.GZ")
+        self.assertEqual(os.path.basename(command[0]), "gzip")
+        self.assertEqual(command[1:], ["-d", "-c"])
+        self.assertIsNone(self.setup.find_decompressor(
+            "a.tar.gz", "no-such-decompressor"))
+        self.assertIsNone(self.setup.find_decompressor("a.tar.xz"))
+
+    def make_pipe(self, data, from_path):
+        command = self.setup.find_decompressor("a.tar.gz")
+        if from_path:
+            path = os.path.join(self.directory, "a.tar.gz")
+            with open(path, "wb") as fd:
+                fd.write(data)
+            return self.setup.DecompressorPipe(command, path)
+        return self.setup.DecompressorPipe(
+            command, StringIO.StringIO(data), buffer_size=1000)
+
+    def test_pipe(self):
+        data = make_tarball(FILES)
+        for from_path in (True, False):
+            pipe = self.make_pipe(data, from_path)
+            tarball = tarfile.open(fileobj=pipe.stdout, mode="r|")
+            self.assertEqual(sorted(member.name for member in tarball),
+                             sorted(FILES))
+            pipe.close()
+
+    def test_corrupt_archive_fails_on_close(self):
+        data = make_tarball(FILES)
+        for from_path in (True, False):
+            pipe = self.make_pipe(data[:len(data) // 2], from_path)
+            pipe.stdout.read()
+            self.assertRaises(DistutilsError, pipe.close)
+
+    def test_abort_stops_decompressor(self):
+        pipe = self.make_pipe(make_tarball(FILES), False)
+        pipe.abort()
+        self.assertIsNotNone(pipe.process.returncode)
+
+class TestStreamExtract(FetchTestCase):
+    def test_unpacks_while_downloading_and_caches_archive(self):
+        data = make_tarball(FILES)
+        self.server.files["/test-1.tar.gz"] = ServedFile(data)
+        fetch = self.make_fetch(self.server.url("/test-1.tar.gz"),
+                                stream_extract=1, decompressor="python")
+        fetch.run()
+        self.assertEqual(read_tree(fetch.unpack_dir), FILES)
+        self.assertEqual([phase for phase, seconds in fetch.phase_times],
+                         ["download and extract", "store prepared"])
+        digest = hashlib.sha256(data).hexdigest()
+        self.assertEqual(fetch.archive_digest, digest)
+        with open(fetch.get_cache_path(), "rb") as fd:
+            self.assertEqual(fd.read(), data)
+        self.assertTrue(fetch.is_fetched())
+
+    def test_wrong_digest_leaves_nothing_in_cache(self):
+        self.server.files["/test-1.tar.gz"] = ServedFile(make_tarball(FILES))
+        fetch = self.make_fetch(self.server.url("/test-1.tar.gz"),
+                                stream_extract=1, decompressor="python",
+                                sha256="0" * 64)
+        self.assertRaises(DistutilsError, fetch.run)
+        cache_dir = os.path.dirname(fetch.get_cache_path())
+        self.assertEqual(os.listdir(cache_dir), [])
+        self.assertFalse(fetch.is_fetched())
+
+    def test_decompresses_with_installed_program(self):
+        decompressors = self.setup.decompressors
+        self.setup.decompressors = [((".gz",), [["gzip", "-d", "-c"]])]
+        try:
+            self.server.files["/test-1.tar.gz"] = ServedFile(
+                make_tarball(FILES))
+            for stream_extract in (0, 1):
+                fetch = self.make_fetch(self.server.url("/test-1.tar.gz"),
+                                        stream_extract=stream_extract,
+                                        cacheable=False, force=1)
+                fetch.run()
+                self.assertEqual(fetch.decompressed_with, "gzip")
+                self.assertEqual(
+                    read_tree(fetch.source_dir)["README"], "read me\n")
+        finally:
+            self.setup.decompressors = decompressors
+
+def write_dependencies(fetch):
+    '''A post_fetch that writes beside the source, like patch_vigra'''
+    for name, contents in (("dependencies", "dll"), ("other", "build tree")):
+        directory = os.path.join(fetch.unpack_dir, name)
+        os.makedirs(directory)
+        with open(os.path.join(directory, "file"), "wb") as fd:
+            fd.write(contents)
+
+class TestPreparedPack(FetchTestCase):
+    def setUp(self):
+        FetchTestCase.setUp(self)
+        self.data = make_tarball(FILES)
+        self.server.files["/test-1.tar.gz"] = ServedFile(self.data)
+
+    def make_prepared_fetch(self):
+        return self.make_fetch(
+            self.server.url("/test-1.tar.gz"),
+            sha256=hashlib.sha256(self.data).hexdigest(),
+            post_fetch=write_dependencies, extra_paths=[os.path.join(
+                self.directory, "build", "lib", "test", "dependencies")])
+
+    def test_restores_pack_instead_of_unpacking(self):
+        fetch = self.make_prepared_fetch()
+        fetch.run()
+        self.assertIsNotNone(fetch.get_prepared_pack())
+        shutil.rmtree(os.path.join(self.directory, "build"))
+        fetch = self.make_prepared_fetch()
+        self.assertEqual(
+            fetch.get_finalized_command("build").get_planned_action(
+                fetch, [])[0], "restore")
+        fetch.run()
+        self.assertTrue(fetch.restored)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(fetch.archive_digest,
+                         hashlib.sha256(self.data).hexdigest())
+        self.assertTrue(fetch.is_fetched())
+
+    def test_packs_only_source_and_extra_paths(self):
+        self.make_prepared_fetch().run()
+        shutil.rmtree(os.path.join(self.directory, "build"))
+        fetch = self.make_prepared_fetch()
+        fetch.run()
+        expected = dict(FILES)
+        expected[os.path.join("dependencies", "file")] = "dll"
+        self.assertEqual(read_tree(fetch.unpack_dir), expected)
+
+    def test_extra_paths_change_the_pack(self):
+        fetch = self.make_prepared_fetch()
+        packed = fetch.get_prepared_base()
+        fetch.extra_paths = []
+        self.assertNotEqual(fetch.get_prepared_base(), packed)
+
+    def test_outside_unpack_dir_is_not_packed(self):
+        fetch = self.make_prepared_fetch()
+        fetch.extra_paths = [self.directory]
+        fetch.run()
+        self.assertIsNone(fetch.get_prepared_pack())
+        self.assertTrue(fetch.is_fetched())
+
+if __name__ == "__main__":
+    unittest.main()
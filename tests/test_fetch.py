@@ -0,0 +1,114 @@
+'''Tests of skipping finished fetches and fetching git branches'''
+import distutils.spawn
+import os
+import subprocess
+import unittest
+
+from distutils.errors import DistutilsError
+
+from tests.support import FetchTestCase, ServedFile, make_tarball
+
+def git(*args, **kwargs):
+    '''Run git quietly, returning its output'''
+    return subprocess.check_output(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com"]
+        + list(args), stderr=subprocess.STDOUT, **kwargs).strip()
+
+class TestFetchStamp(FetchTestCase):
+    def setUp(self):
+        FetchTestCase.setUp(self)
+        self.server.files["/test-1.tar.gz"] = ServedFile(
+            make_tarball({"test-1/README": "read me\n"}))
+
+    def test_skips_finished_fetch(self):
+        fetch = self.make_fetch(self.server.url("/test-1.tar.gz"))
+        self.assertFalse(fetch.is_fetched())
+        fetch.run()
+        self.assertTrue(fetch.is_fetched())
+        fetch = self.make_fetch(self.server.url("/test-1.tar.gz"))
+        build = fetch.get_finalized_command("build")
+        self.assertEqual(build.get_planned_action(fetch, [])[0], "skip")
+        fetch.run()
+        self.assertTrue(fetch.skipped)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_force_fetches_again(self):
+        self.make_fetch(self.server.url("/test-1.tar.gz")).run()
+        fetch = self.make_fetch(self.server.url("/test-1.tar.gz"), force=1)
+        fetch.run()
+        self.assertFalse(getattr(fetch, "skipped", False))
+
+    def test_new_patches_fetch_again(self):
+        self.make_fetch(self.server.url("/test-1.tar.gz")).run()
+        def post_fetch(fetch):
+            pass
+        fetch = self.make_fetch(self.server.url("/test-1.tar.gz"),
+                                post_fetch=post_fetch)
+        self.assertFalse(fetch.is_fetched())
+
+@unittest.skipIf(distutils.spawn.find_executable("git") is None,
+                 "git is not installed")
+class TestGitRef(FetchTestCase):
+    def setUp(self):
+        FetchTestCase.setUp(self)
+        self.repository = os.path.join(self.directory, "repository")
+        git("init", "-q", self.repository)
+        self.commit()
+
+    def commit(self):
+        '''Add a commit on the branch and serve its archive'''
+        git("checkout", "-q", "-B", "feature/x", cwd=self.repository)
+        git("commit", "-q", "--allow-empty", "-m", "commit",
+            cwd=self.repository)
+        commit = git("rev-parse", "HEAD", cwd=self.repository)
+        self.server.files["/archive/%s.tar.gz" % commit] = ServedFile(
+            make_tarball({"test-%s/README" % commit: commit}))
+        return commit
+
+    def make_git_fetch(self, repository=None):
+        return self.make_fetch(
+            self.server.url("/archive/{commit}.tar.gz"),
+            git_repository=repository or self.repository, git_ref="feature/x",
+            tarball_source_dir="test-{commit}")
+
+    def read_readme(self, fetch):
+        with open(os.path.join(fetch.source_dir, "README")) as fd:
+            return fd.read()
+
+    def test_fetches_commit_of_branch(self):
+        fetch = self.make_git_fetch()
+        commit = git("rev-parse", "HEAD", cwd=self.repository)
+        self.assertEqual(fetch.commit, commit)
+        fetch.run()
+        self.assertEqual(self.read_readme(fetch), commit)
+
+    def test_refetches_when_branch_moves(self):
+        self.make_git_fetch().run()
+        self.assertTrue(self.make_git_fetch().is_fetched())
+        commit = self.commit()
+        fetch = self.make_git_fetch()
+        self.assertFalse(fetch.is_fetched())
+        fetch.run()
+        self.assertEqual(self.read_readme(fetch), commit)
+
+    def test_uses_last_commit_when_repository_is_unreachable(self):
+        fetch = self.make_git_fetch()
+        fetch.run()
+        missing = os.path.join(self.directory, "missing")
+        offline = self.make_git_fetch(missing)
+        self.assertEqual(offline.commit, fetch.commit)
+        self.assertTrue(offline.is_fetched())
+
+    def test_unreachable_repository_without_earlier_fetch(self):
+        fetch = self.make_git_fetch(os.path.join(self.directory, "missing"))
+        self.assertIsNone(fetch.commit)
+        self.assertRaises(DistutilsError, fetch.run)
+        self.assertEqual(self.server.requests, [])
+
+    def test_unknown_branch(self):
+        self.assertRaises(DistutilsError, self.make_fetch,
+                          self.server.url("/archive/{commit}.tar.gz"),
+                          git_repository=self.repository, git_ref="nothing")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+'''Tests of sharing memory between the compile jobs of running steps'''
+import threading
+import unittest
+
+from tests.support import load_setup
+
+setup = load_setup()
+
+MB = 1024 * 1024
+
+class TestMemoryGovernor(unittest.TestCase):
+    def setUp(self):
+        self.get_available_memory = setup.get_available_memory
+        self.available = 4096 * MB
+        setup.get_available_memory = lambda: self.available
+        self.governor = setup.MemoryGovernor()
+        self.governor.reserve = 0
+        self.governor.poll_interval = .01
+
+    def tearDown(self):
+        setup.get_available_memory = self.get_available_memory
+
+    def test_grants_what_fits(self):
+        self.assertEqual(self.governor.acquire("a", 16, 512 * MB),
+                         (8, 4096 * MB))
+        self.governor.release("a")
+        self.assertEqual(self.governor.acquire("a", 4, 512 * MB)[0], 4)
+
+    def test_counts_grants_not_in_use_yet(self):
+        self.assertEqual(self.governor.acquire("a", 4, 512 * MB)[0], 4)
+        self.assertEqual(self.governor.acquire("b", 8, 512 * MB)[0], 4)
+
+    def test_follows_memory_in_use(self):
+        self.governor.acquire("a", 4, 512 * MB)
+        # a only uses half of its grant
+        self.available -= 1024 * MB
+        self.assertEqual(self.governor.acquire("b", 8, 512 * MB)[0], 4)
+
+    def test_follows_memory_used_elsewhere(self):
+        self.governor.acquire("a", 2, 512 * MB)
+        # a uses all of its grant and something else uses as much
+        self.available -= 2048 * MB
+        self.assertEqual(self.governor.acquire("b", 8, 512 * MB)[0], 4)
+
+    def test_counts_grants_since_each_reading(self):
+        self.governor.acquire("a", 2, 512 * MB)
+        self.available -= 1024 * MB
+        self.governor.acquire("b", 2, 512 * MB)
+        # a's memory is in use, but b's isn't yet
+        self.assertEqual(self.governor.get_unused(self.available), 1024 * MB)
+        self.available -= 1024 * MB
+        self.assertEqual(self.governor.get_unused(self.available), 0)
+
+    def test_always_grants_one_job(self):
+        self.available = 100 * MB
+        self.assertEqual(self.governor.acquire("a", 4, 512 * MB)[0], 1)
+
+    def test_waits_for_release(self):
+        self.governor.acquire("a", 8, 512 * MB)
+        result = []
+        thread = threading.Thread(target=lambda: result.append(
+            self.governor.acquire("b", 2, 512 * MB)))
+        thread.start()
+        thread.join(.1)
+        self.assertEqual(result, [])
+        self.governor.release("a")
+        thread.join(10)
+        self.assertEqual(result[0][0], 2)
+
+    def test_waits_for_memory(self):
+        self.governor.acquire("a", 4, 512 * MB)
+        self.available = 0
+        result = []
+        thread = threading.Thread(target=lambda: result.append(
+            self.governor.acquire("b", 2, 512 * MB)))
+        thread.start()
+        thread.join(.1)
+        self.assertEqual(result, [])
+        self.available = 3072 * MB
+        thread.join(10)
+        self.assertEqual(result[0][0], 2)
+
+    def test_unknown_memory(self):
+        setup.get_available_memory = lambda: None
+        self.assertEqual(self.governor.acquire("a", 16, 512 * MB), (16, None))
+        self.assertEqual(self.governor.acquire("b", 16, 512 * MB), (16, None))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+'''Tests of FilePatch and apply_patches'''
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from distutils.errors import DistutilsError, DistutilsSetupError
+
+from tests.support import load_setup
+
+setup = load_setup()
+
+ORIGINAL = "one\ntwo\nthree\nfour\n"
+
+class PatchStep(object):
+    '''Stands in for the fetch step that apply_patches is given'''
+    def __init__(self, directory):
+        self.build_lib = os.path.join(directory, "build")
+        self.source_dir = os.path.join(directory, "source")
+        self.dry_run = 0
+        self.messages = []
+
+    def get_step_name(self):
+        return "fetch_test"
+
+    def announce(self, msg, level=1):
+        self.messages.append(msg)
+
+def digest(hash_name, contents):
+    return "%s:%s" % (hash_name, hashlib.new(hash_name, contents).hexdigest())
+
+class TestFilePatch(unittest.TestCase):
+    def test_line_edits_refer_to_original_lines(self):
+        patch = setup.FilePatch("f", [("delete_lines", 1, 2),
+                                      ("copy_line", 1, 4),
+                                      ("replace_in_line", 3, "three", "3")])
+        self.assertEqual(patch.apply(None, ORIGINAL), "3\none\nfour\n")
+
+    def test_text_edits(self):
+        patch = setup.FilePatch("f", [
+            ("insert_before", "^three", "2.5\n"),
+            ("insert_after", "^three", "3.5\n"),
+            ("delete_matching", "^one"),
+            ("replace", "^four$", "4"),
+            ("insert_at", -1, "last but one\n")])
+        self.assertEqual(patch.apply(None, ORIGINAL),
+                         "two\n2.5\nthree\n3.5\nlast but one\n4\n")
+
+    def test_unknown_edit(self):
+        patch = setup.FilePatch("f", [("frobnicate",)])
+        self.assertRaises(DistutilsSetupError, patch.apply, None, ORIGINAL)
+
+class TestApplyPatches(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.step = PatchStep(self.directory)
+        os.makedirs(self.step.source_dir)
+        self.path = os.path.join(self.step.source_dir, "f.txt")
+        self.write(ORIGINAL)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, contents):
+        with open(self.path, "wb") as fd:
+            fd.write(contents)
+
+    def read(self):
+        with open(self.path, "rb") as fd:
+            return fd.read()
+
+    def test_patches_once(self):
+        patches = [setup.FilePatch("f.txt", [("delete_lines", 1, 1)])]
+        setup.apply_patches(self.step, patches)
+        self.assertEqual(self.read(), "two\nthree\nfour\n")
+        os.utime(self.path, (1000000000, 1000000000))
+        setup.apply_patches(self.step, patches)
+        self.assertEqual(self.read(), "two\nthree\nfour\n")
+        self.assertEqual(os.path.getmtime(self.path), 1000000000)
+        self.assertEqual(self.step.patched_files, {
+            "f.txt": digest("sha256", "two\nthree\nfour\n")})
+
+    def test_repatch_keeps_modification_time(self):
+        patches = [setup.FilePatch("f.txt", [("delete_lines", 1, 1)])]
+        setup.apply_patches(self.step, patches)
+        mtime = os.path.getmtime(self.path)
+        #
+        # The source is unpacked again
+        #
+        self.write(ORIGINAL)
+        os.utime(self.path, (mtime + 100, mtime + 100))
+        setup.apply_patches(self.step, patches)
+        self.assertEqual(self.read(), "two\nthree\nfour\n")
+        self.assertAlmostEqual(os.path.getmtime(self.path), mtime, 2)
+
+    def test_skips_unexpected_version(self):
+        patches = [setup.FilePatch("f.txt", [("delete_lines", 1, 1)],
+                                   pre_image=digest("md5", "other\n"))]
+        setup.apply_patches(self.step, patches)
+        self.assertEqual(self.read(), ORIGINAL)
+        self.assertEqual(len(self.step.messages), 1)
+
+    def test_skips_file_that_is_already_fixed(self):
+        patches = [setup.FilePatch("f.txt", [("insert_at", 0, "two\n")],
+                                   unless="^two$")]
+        setup.apply_patches(self.step, patches)
+        self.assertEqual(self.read(), ORIGINAL)
+
+    def test_checks_post_image(self):
+        patches = [setup.FilePatch("f.txt", [("delete_lines", 1, 1)],
+                                   post_image=digest("sha256", "other\n"))]
+        self.assertRaises(DistutilsError, setup.apply_patches,
+                          self.step, patches)
+        self.assertEqual(self.read(), ORIGINAL)
+
+    def test_dry_run_leaves_file_alone(self):
+        self.step.dry_run = 1
+        patches = [setup.FilePatch("f.txt", [("delete_lines", 1, 1)])]
+        setup.apply_patches(self.step, patches)
+        self.assertEqual(self.read(), ORIGINAL)
+
+if __name__ == "__main__":
+    unittest.main()
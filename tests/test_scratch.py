@@ -0,0 +1,54 @@
+'''Tests of building intermediate trees in a scratch directory'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from tests.support import make_hdf5_distribution
+
+class TestScratchDir(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.scratch_dir = os.path.join(self.directory, "scratch")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_distribution(self):
+        return make_hdf5_distribution(self.directory, self.scratch_dir)
+
+    def test_build_trees_go_in_scratch_dir(self):
+        distribution = self.make_distribution()
+        build = distribution.get_command_obj("build")
+        step = distribution.get_command_obj("build_zlib")
+        step.ensure_finalized()
+        self.assertTrue(step.target_dir.startswith(build.scratch_dir + os.sep))
+        self.assertFalse(step.install_root.startswith(self.scratch_dir))
+
+    def test_hdf5_only_uses_installed_dependencies(self):
+        distribution = self.make_distribution()
+        step = distribution.get_command_obj("build_libhdf5")
+        step.ensure_finalized()
+        options = [option for option in step.extra_cmake_options
+                   if "ZLIB" in option or "SZIP" in option]
+        self.assertEqual(len(options), 6)
+        for name in ("build_zlib", "build_szip"):
+            dependency = distribution.get_command_obj(name)
+            for option in options:
+                self.assertNotIn(dependency.target_dir, option)
+
+    def test_clean_scratch_dir_keeps_outputs(self):
+        distribution = self.make_distribution()
+        build = distribution.get_command_obj("build")
+        build.ensure_finalized()
+        step = distribution.get_command_obj("build_zlib")
+        step.ensure_finalized()
+        for path in step.target_dir, step.install_root:
+            os.makedirs(path)
+        build.clean_scratch_dir(["fetch_zlib", "build_zlib"])
+        self.assertFalse(os.path.exists(step.target_dir))
+        self.assertTrue(os.path.isdir(step.install_root))
+        self.assertFalse(os.path.exists(build.scratch_dir))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,221 @@
+'''Tests of skipping unchanged steps with stamps and artifacts'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from distutils.errors import DistutilsError
+
+from tests.support import FetchTestCase, ServedFile, load_setup, \
+     make_distribution, make_hdf5_distribution
+
+setup = load_setup()
+
+class CountingStep(setup.StampedStep):
+    '''A step that writes one output file and counts its runs
+
+    setting - a stamp input
+    fail - True to fail instead of writing the output
+    '''
+    def initialize_options(self):
+        setup.StampedStep.initialize_options(self)
+        self.setting = 1
+        self.fail = False
+        self.runs = 0
+
+    def get_output_dir(self):
+        return os.path.join(self.build_lib, "counting")
+
+    def get_outputs(self):
+        return [self.get_output_dir()]
+
+    def get_stamp_inputs(self):
+        inputs = setup.StampedStep.get_stamp_inputs(self)
+        inputs["setting"] = self.setting
+        return inputs
+
+    def run_step(self):
+        self.runs += 1
+        if self.fail:
+            raise DistutilsError("failed")
+        if not os.path.isdir(self.get_output_dir()):
+            os.makedirs(self.get_output_dir())
+        with open(os.path.join(self.get_output_dir(), "out"), "w") as fd:
+            fd.write(str(self.setting))
+
+class StepTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_step(self, directory=None, cache_dir="none", **options):
+        '''A finalized CountingStep building under the directory'''
+        if directory is None:
+            directory = self.directory
+        distribution = make_distribution(
+            directory, cache_dir, build_counting=CountingStep)
+        step = distribution.get_command_obj("build_counting")
+        for name, value in options.items():
+            setattr(step, name, value)
+        step.ensure_finalized()
+        return step
+
+class TestStamps(StepTestCase):
+    def test_skips_unchanged_step(self):
+        step = self.make_step()
+        step.run()
+        self.assertEqual(step.runs, 1)
+        self.assertTrue(os.path.isfile(step.stamp_file))
+        step = self.make_step()
+        step.run()
+        self.assertEqual(step.runs, 0)
+        self.assertTrue(step.skipped)
+
+    def test_runs_if_inputs_change(self):
+        self.make_step().run()
+        step = self.make_step(setting=2)
+        step.run()
+        self.assertEqual(step.runs, 1)
+
+    def test_runs_if_output_is_missing(self):
+        step = self.make_step()
+        step.run()
+        shutil.rmtree(step.get_output_dir())
+        step = self.make_step()
+        step.run()
+        self.assertEqual(step.runs, 1)
+
+    def test_force(self):
+        self.make_step().run()
+        step = self.make_step(force=1)
+        step.run()
+        self.assertEqual(step.runs, 1)
+
+    def test_failure_leaves_no_stamp(self):
+        step = self.make_step(fail=True)
+        self.assertRaises(DistutilsError, step.run)
+        self.assertIsNone(step.read_stamp())
+
+    def test_counts_growth_of_outputs_as_written(self):
+        step = self.make_step(setting=12345)
+        step.run()
+        self.assertEqual(step.get_report()["bytes_written"], 5)
+
+    def test_site_packages_is_an_input_for_installing_steps(self):
+        step = self.make_step()
+        self.assertNotIn("site_packages", step.get_stamp_inputs())
+        step.installs_python_packages = True
+        self.assertIn("site_packages", step.get_stamp_inputs())
+
+class CacheableStep(CountingStep):
+    artifact_cacheable = True
+
+class TestArtifacts(StepTestCase):
+    def make_cacheable_step(self, checkout, **options):
+        distribution = make_distribution(
+            os.path.join(self.directory, checkout),
+            os.path.join(self.directory, "cache"),
+            build_counting=CacheableStep)
+        step = distribution.get_command_obj("build_counting")
+        for name, value in options.items():
+            setattr(step, name, value)
+        step.ensure_finalized()
+        return step
+
+    def test_restores_artifact_in_another_checkout(self):
+        step = self.make_cacheable_step("a", setting=5)
+        step.run()
+        self.assertEqual(step.runs, 1)
+        store, key = step.get_artifact_store()
+        self.assertTrue(store.contains(key))
+        step = self.make_cacheable_step("b", setting=5)
+        step.run()
+        self.assertEqual(step.runs, 0)
+        self.assertTrue(step.restored)
+        with open(os.path.join(step.get_output_dir(), "out")) as fd:
+            self.assertEqual(fd.read(), "5")
+        self.assertIsNotNone(step.read_stamp())
+
+    def test_no_artifact_without_cacheable_class(self):
+        step = self.make_step(cache_dir=os.path.join(self.directory, "cache"))
+        self.assertEqual(step.get_artifact_store(), (None, None))
+
+class TestArtifactKeys(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_step(self, checkout, scratch_dir):
+        distribution = make_hdf5_distribution(
+            os.path.join(self.directory, checkout),
+            os.path.join(self.directory, scratch_dir))
+        step = distribution.get_command_obj("build_libhdf5")
+        step.ensure_finalized()
+        return step
+
+    def test_same_key_in_every_checkout_and_scratch_dir(self):
+        first = self.get_step("a", "scratch-a")
+        second = self.get_step("b", "scratch-b")
+        self.assertIsNotNone(first.get_artifact_key())
+        self.assertEqual(first.get_artifact_inputs(),
+                         second.get_artifact_inputs())
+        self.assertEqual(
+            first.relative_to_build_lib(os.path.abspath(first.target_dir)),
+            second.relative_to_build_lib(os.path.abspath(second.target_dir)))
+
+    def test_key_changes_with_dependency(self):
+        first = self.get_step("a", "scratch")
+        second = self.get_step("b", "scratch")
+        second.distribution.get_command_obj("fetch_zlib").sha256 = "0" * 64
+        self.assertNotEqual(first.get_artifact_key(),
+                            second.get_artifact_key())
+
+class TestArtifactStores(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.artifact = os.path.join(self.directory, "artifact.tar.gz")
+        with open(self.artifact, "wb") as fd:
+            fd.write("artifact")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_local_store(self):
+        store = setup.LocalArtifactStore(os.path.join(self.directory, "a"))
+        path = os.path.join(self.directory, "fetched")
+        self.assertFalse(store.contains("abcd"))
+        self.assertFalse(store.fetch("abcd", path))
+        store.store("abcd", self.artifact)
+        self.assertTrue(store.contains("abcd"))
+        self.assertTrue(store.fetch("abcd", path))
+        with open(path, "rb") as fd:
+            self.assertEqual(fd.read(), "artifact")
+        self.assertEqual(os.listdir(os.path.join(self.directory, "a", "ab")),
+                         ["abcd.tar.gz"])
+
+    def test_open_artifact_store(self):
+        store = setup.open_artifact_store(self.directory)
+        self.assertIsInstance(store, setup.LocalArtifactStore)
+        store = setup.open_artifact_store("file:///var/cache/artifacts")
+        self.assertEqual(store.directory, "/var/cache/artifacts")
+        store = setup.open_artifact_store("https://example.com/artifacts/")
+        self.assertIsInstance(store, setup.HttpArtifactStore)
+        self.assertEqual(store.get_url("abcd"),
+                         "https://example.com/artifacts/ab/abcd.tar.gz")
+
+class TestHttpArtifactStore(FetchTestCase):
+    def test_fetch(self):
+        self.server.files["/artifacts/ab/abcd.tar.gz"] = ServedFile("artifact")
+        store = self.setup.HttpArtifactStore(self.server.url("/artifacts"))
+        path = os.path.join(self.directory, "fetched")
+        self.assertTrue(store.fetch("abcd", path))
+        with open(path, "rb") as fd:
+            self.assertEqual(fd.read(), "artifact")
+        self.assertFalse(store.fetch("abce", path))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+'''Tests of the build step graph: ordering, scheduling and selection'''
+import threading
+import time
+import unittest
+
+from distutils.errors import DistutilsError, DistutilsSetupError
+from setuptools.dist import Distribution
+
+from tests.support import load_setup
+
+setup = load_setup()
+
+#
+# fetch_a -> build_a -> build_b -> install
+# fetch_b ------------^
+#
+STEPS = ["fetch_a", "build_a", "fetch_b", "build_b", "install"]
+DEPENDENCIES = {
+    "fetch_a": [],
+    "build_a": ["fetch_a", "build"],
+    "fetch_b": [],
+    "build_b": ["fetch_b", "build_a"],
+    "install": ["build_b"]}
+
+class TestOrderSteps(unittest.TestCase):
+    def test_keeps_preferred_order(self):
+        self.assertEqual(setup.order_steps(STEPS, DEPENDENCIES), STEPS)
+
+    def test_moves_steps_after_dependencies(self):
+        self.assertEqual(
+            setup.order_steps(list(reversed(STEPS)), DEPENDENCIES),
+            ["fetch_b", "fetch_a", "build_a", "build_b", "install"])
+
+    def test_circular_dependency(self):
+        self.assertRaises(DistutilsSetupError, setup.order_steps,
+                          ["a", "b"], dict(a=["b"], b=["a"]))
+
+class TestEstimateSchedule(unittest.TestCase):
+    durations = dict(fetch_a=10, build_a=100, fetch_b=50, build_b=20,
+                     install=5)
+
+    def test_enough_workers(self):
+        wall_time, critical_path = setup.estimate_schedule(
+            STEPS, DEPENDENCIES, self.durations, 4)
+        self.assertEqual(wall_time, 135)
+        self.assertEqual(critical_path,
+                         ["fetch_a", "build_a", "build_b", "install"])
+
+    def test_one_worker(self):
+        wall_time, critical_path = setup.estimate_schedule(
+            STEPS, DEPENDENCIES, self.durations, 1)
+        self.assertEqual(wall_time, sum(self.durations.values()))
+
+class TestRunStepGraph(unittest.TestCase):
+    def run_graph(self, workers, fail=None):
+        finished = []
+        lock = threading.Lock()
+        def run_step(step):
+            for dependency in DEPENDENCIES[step]:
+                if dependency in STEPS:
+                    self.assertIn(dependency, finished)
+            time.sleep(.01)
+            if step == fail:
+                raise DistutilsError("%s failed" % step)
+            with lock:
+                finished.append(step)
+        setup.run_step_graph(STEPS, DEPENDENCIES, run_step, workers)
+        return finished
+
+    def test_runs_every_step_after_its_dependencies(self):
+        for workers in (1, 3):
+            self.assertEqual(sorted(self.run_graph(workers)), sorted(STEPS))
+
+    def test_reraises_failure(self):
+        self.assertRaises(DistutilsError, self.run_graph, 3, "build_a")
+
+class SelectionBuild(setup.BuildIlastik):
+    '''A build whose steps are only names, some of them already done'''
+    done = ()
+
+    def get_finalized_command(self, command, create=1):
+        return command
+
+    def is_step_done(self, step):
+        return step in self.done
+
+class TestSelectSteps(unittest.TestCase):
+    def select(self, only=(), start=(), with_deps=1, done=()):
+        build = SelectionBuild(Distribution())
+        build.only_steps = list(only)
+        build.from_steps = list(start)
+        build.with_deps = with_deps
+        build.done = done
+        return build.select_steps(STEPS, DEPENDENCIES)
+
+    def test_everything_without_selection(self):
+        self.assertEqual(self.select(), STEPS)
+
+    def test_only_adds_dependencies_that_are_not_done(self):
+        self.assertEqual(self.select(only=["build_b"]), [
+            "fetch_a", "build_a", "fetch_b", "build_b"])
+        self.assertEqual(self.select(
+            only=["build_b"], done=["fetch_a", "build_a", "fetch_b"]),
+            ["build_b"])
+
+    def test_dependency_of_a_step_that_runs_runs(self):
+        self.assertEqual(self.select(
+            only=["build_b"], done=["build_a", "fetch_b"]),
+            ["fetch_a", "build_a", "build_b"])
+
+    def test_only_without_dependencies(self):
+        self.assertEqual(self.select(only=["build_b"], with_deps=0),
+                         ["build_b"])
+
+    def test_from_adds_downstream_steps(self):
+        self.assertEqual(self.select(
+            start=["build_a"], done=["fetch_a", "fetch_b"]),
+            ["build_a", "build_b", "install"])
+        self.assertEqual(self.select(start=["fetch_b"], with_deps=0),
+                         ["fetch_b", "build_b", "install"])
+
+    def test_step_outside_the_build(self):
+        self.assertRaises(DistutilsError, self.select, only=["build_c"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,188 @@
+'''Tests of taking libraries from the system instead of building them'''
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from tests.support import load_setup, make_hdf5_distribution
+
+setup = load_setup()
+
+SYSTEM_HDF5 = dict(
+    version="1.8.16", found_by="pkg-config hdf5-serial", prefix="/usr",
+    include_dir="/usr/include/hdf5/serial",
+    library_dir="/usr/lib/x86_64-linux-gnu/hdf5/serial",
+    library="/usr/lib/x86_64-linux-gnu/hdf5/serial/libhdf5.so",
+    hl="/usr/lib/x86_64-linux-gnu/hdf5/serial/libhdf5_hl.so")
+
+class CountingDependency(setup.SystemDependency):
+    '''A dependency whose find returns the found attribute and counts'''
+    def find(self, cmake="cmake"):
+        self.finds = getattr(self, "finds", 0) + 1
+        return self.found
+
+class TestSystemDependency(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.include_dir = os.path.join(self.directory, "include", "foo")
+        self.library_dir = os.path.join(self.directory, "lib", "x86_64")
+        for directory in self.include_dir, self.library_dir:
+            os.makedirs(directory)
+        with open(os.path.join(self.library_dir, "libfoo.so"), "w"):
+            pass
+        self.default_cache_dir = setup.default_cache_dir
+        setup.default_cache_dir = lambda: os.path.join(
+            self.directory, "cache")
+
+    def tearDown(self):
+        setup.default_cache_dir = self.default_cache_dir
+        shutil.rmtree(self.directory)
+
+    def write_header(self, contents):
+        with open(os.path.join(self.include_dir, "ilastik_foo.h"), "w") as fd:
+            fd.write(contents)
+
+    def make_dependency(self, cls=setup.SystemDependency):
+        return cls(
+            "foo", (), "ilastik_foo.h", dict(library=("foo",)),
+            min_version="2.0", version_pattern=r'FOO_VERSION "([^"]+)"',
+            compatible=((r"#include <bar.h>", "2.1"),))
+
+    def check(self, version=None, prefix=None):
+        return self.make_dependency().check(
+            "test", version, [self.include_dir], [self.library_dir], prefix)
+
+    def test_finds_version_in_header(self):
+        self.write_header('#define FOO_VERSION "2.3"\n')
+        found = self.check()
+        self.assertEqual(found["version"], "2.3")
+        self.assertEqual(found["prefix"], self.directory)
+        self.assertEqual(found["library_dir"], self.library_dir)
+        self.assertEqual(found["library"],
+                         os.path.join(self.library_dir, "libfoo.so"))
+        self.assertEqual(self.check(prefix="/opt")["prefix"], "/opt")
+
+    def test_min_version(self):
+        self.write_header('#define FOO_VERSION "1.9"\n')
+        self.assertIsNone(self.check())
+        self.write_header("\n")
+        self.assertIsNone(self.check())
+        self.assertEqual(self.check("2.0")["version"], "2.0")
+
+    def test_compatible_replacement(self):
+        self.write_header("#include <bar.h>\n")
+        self.assertEqual(self.check()["version"], "2.1")
+        self.assertEqual(self.check("1.0")["version"], "2.1")
+
+    def test_caches_probes(self):
+        dependency = self.make_dependency(CountingDependency)
+        dependency.found = dict(
+            include_dir=self.include_dir,
+            library=os.path.join(self.library_dir, "libfoo.so"))
+        missing = self.make_dependency(CountingDependency)
+        missing.name = "bar"
+        missing.found = None
+        for dependencies in [dependency, missing], [dependency, missing]:
+            result = setup.find_system_dependencies(dependencies)
+            self.assertEqual(result, dict(foo=dependency.found, bar=None))
+        self.assertEqual(dependency.finds, 1)
+        self.assertEqual(missing.finds, 1)
+        dependency.min_version = "2.2"
+        setup.find_system_dependencies([dependency])
+        self.assertEqual(dependency.finds, 2)
+
+    def test_probes_again_when_library_is_gone(self):
+        dependency = self.make_dependency(CountingDependency)
+        dependency.found = dict(
+            include_dir=self.include_dir,
+            library=os.path.join(self.library_dir, "libfoo.so"))
+        setup.find_system_dependencies([dependency])
+        os.remove(dependency.found["library"])
+        setup.find_system_dependencies([dependency])
+        self.assertEqual(dependency.finds, 2)
+
+class TestInstallPrefix(unittest.TestCase):
+    def test_prefix_is_above_include(self):
+        self.assertEqual(setup.get_install_prefix("/usr/include"), "/usr")
+        self.assertEqual(
+            setup.get_install_prefix("/usr/include/hdf5/serial"), "/usr")
+        self.assertEqual(setup.get_install_prefix("/opt/hdf5/headers"),
+                         "/opt/hdf5")
+
+class TestBuildH5Py(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.is_win = setup.is_win
+
+    def tearDown(self):
+        setup.is_win = self.is_win
+        shutil.rmtree(self.directory)
+
+    def get_step(self, system, checkout="a"):
+        distribution = make_hdf5_distribution(
+            os.path.join(self.directory, checkout))
+        distribution.cmdclass.update(
+            fetch_h5py=setup.FetchSource, build_h5py=setup.BuildH5Py)
+        fetch = distribution.get_command_obj("fetch_h5py")
+        fetch.version = "2.3.0"
+        fetch.url = "http://example.com/h5py.tar.gz"
+        fetch.sha256 = hashlib.sha256("h5py").hexdigest()
+        distribution.get_command_obj("build").found_system_dependencies = \
+            system
+        for name in ("build_zlib", "build_szip", "build_libhdf5"):
+            distribution.get_command_obj(name).cmake = "cmake"
+        step = distribution.get_command_obj("build_h5py")
+        step.wheel_cache = os.path.join(self.directory, "wheels")
+        step.ensure_finalized()
+        return step
+
+    def test_system_hdf5(self):
+        setup.is_win = True
+        step = self.get_step(dict(hdf5=SYSTEM_HDF5))
+        self.assertEqual(step.hdf5, "/usr")
+        self.assertEqual(step.depends_on, ["build", "fetch_h5py"])
+        self.assertIsNone(step.szip_install_dir)
+        self.assertEqual(step.get_dlls(), [])
+        self.assertEqual(step.get_build_ext_options(), [
+            "build_ext", "--include-dirs=/usr/include/hdf5/serial",
+            "--library-dirs=/usr/lib/x86_64-linux-gnu/hdf5/serial"])
+
+    def test_wheel_key_follows_system_hdf5(self):
+        setup.is_win = False
+        key = self.get_step(dict(hdf5=SYSTEM_HDF5)).get_wheel_key()
+        self.assertIsNotNone(key)
+        self.assertEqual(
+            self.get_step(dict(hdf5=SYSTEM_HDF5), "b").get_wheel_key(), key)
+        upgraded = dict(SYSTEM_HDF5, version="1.8.18")
+        self.assertNotEqual(
+            self.get_step(dict(hdf5=upgraded), "c").get_wheel_key(), key)
+
+    def test_built_hdf5_on_windows(self):
+        setup.is_win = True
+        step = self.get_step(dict(szip=dict(SYSTEM_HDF5)))
+        libhdf5 = step.distribution.get_command_obj("build_libhdf5")
+        self.assertEqual(step.hdf5, libhdf5.install_dir)
+        self.assertIn("build_zlib", step.depends_on)
+        self.assertNotIn("build_szip", step.depends_on)
+        zlib = step.distribution.get_command_obj("build_zlib")
+        self.assertEqual(
+            [os.path.basename(src) for src, name in step.get_dlls()],
+            ["hdf5.dll", "hdf5_hl.dll", "zlib.dll"])
+        self.assertEqual(step.get_dlls()[-1][0], os.path.join(
+            zlib.install_dir, "bin", "zlib.dll"))
+        for src, name in step.get_dlls():
+            self.assertFalse(src.startswith(step.temp_dir))
+        self.assertEqual(step.get_build_ext_options(), [
+            "build_ext", "--library-dirs=%s" %
+            os.path.abspath(os.path.join(step.temp_dir, "hdf5"))])
+
+    def test_built_hdf5_elsewhere(self):
+        setup.is_win = False
+        step = self.get_step({})
+        self.assertNotIn("build_zlib", step.depends_on)
+        self.assertEqual(step.get_dlls(), [])
+        self.assertEqual(step.get_build_ext_options(), [])
+
+if __name__ == "__main__":
+    unittest.main()
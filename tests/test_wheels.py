@@ -0,0 +1,146 @@
+'''Tests of caching the wheels of the Python packages the build installs'''
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from distutils.errors import DistutilsError
+
+from tests.support import load_setup, make_distribution
+
+setup = load_setup()
+
+def write_files(directory, files):
+    '''Write a dictionary of relative path to contents under a directory'''
+    for name, contents in files.items():
+        path = os.path.join(directory, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as fd:
+            fd.write(contents)
+
+SOURCE = {
+    "setup.py": "from setuptools import setup\n",
+    os.path.join("package", "__init__.py"): "x = 1\n"}
+
+class TestWheelCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = setup.WheelCache(os.path.join(self.directory, "wheels"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_store_and_find(self):
+        self.assertIsNone(self.cache.find("abcd"))
+        wheel = os.path.join(self.directory, "package-1-py2-none-any.whl")
+        with open(wheel, "wb") as fd:
+            fd.write("wheel")
+        path = self.cache.store("abcd", wheel)
+        self.assertEqual(os.path.dirname(path), self.cache.get_dir("abcd"))
+        self.assertEqual(self.cache.find("abcd"), path)
+        with open(path, "rb") as fd:
+            self.assertEqual(fd.read(), "wheel")
+        self.assertEqual(os.listdir(self.cache.get_dir("abcd")),
+                         [os.path.basename(wheel)])
+        self.assertIsNone(self.cache.find("abce"))
+
+    def test_keys_are_apart(self):
+        self.assertEqual(self.cache.get_dir("abcd"), os.path.join(
+            self.directory, "wheels", "ab", "abcd"))
+        self.assertNotEqual(self.cache.get_dir("abcd"),
+                            self.cache.get_dir("abce"))
+
+class TestSourceDigest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_source(self, name, files=SOURCE):
+        path = os.path.join(self.directory, name)
+        write_files(path, files)
+        return path
+
+    def test_same_source_anywhere(self):
+        first = self.make_source("a")
+        second = self.make_source("b")
+        os.utime(os.path.join(second, "setup.py"),
+                 (time.time() - 1000, time.time() - 1000))
+        self.assertEqual(setup.source_digest(first),
+                         setup.source_digest(second))
+
+    def test_leaves_out_what_setup_writes(self):
+        source = self.make_source("a")
+        digest = setup.source_digest(source)
+        write_files(source, {
+            os.path.join("build", "lib", "package", "__init__.py"): "",
+            os.path.join("dist", "package.whl"): "",
+            os.path.join("package.egg-info", "PKG-INFO"): "",
+            os.path.join("package", "__init__.pyc"): ""})
+        self.assertEqual(setup.source_digest(source), digest)
+
+    def test_changes_with_contents(self):
+        changed = dict(SOURCE)
+        changed[os.path.join("package", "__init__.py")] = "x = 2\n"
+        self.assertNotEqual(
+            setup.source_digest(self.make_source("a")),
+            setup.source_digest(self.make_source("b", changed)))
+
+    def test_build_directory_in_package_counts(self):
+        source = self.make_source("a")
+        digest = setup.source_digest(source)
+        write_files(source, {os.path.join("package", "build", "x.py"): ""})
+        self.assertNotEqual(setup.source_digest(source), digest)
+
+class WheelStep(setup.BuildStep):
+    '''A step that only has a wheel cache'''
+    def initialize_options(self):
+        self.wheel_cache = None
+
+    def finalize_options(self):
+        pass
+
+class TestWheelStep(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.had_result = hasattr(setup.has_wheel_package, "result")
+        self.result = getattr(setup.has_wheel_package, "result", None)
+
+    def tearDown(self):
+        if self.had_result:
+            setup.has_wheel_package.result = self.result
+        elif hasattr(setup.has_wheel_package, "result"):
+            del setup.has_wheel_package.result
+        shutil.rmtree(self.directory)
+
+    def make_step(self):
+        distribution = make_distribution(self.directory, build_wheel=WheelStep)
+        step = distribution.get_command_obj("build_wheel")
+        step.ensure_finalized()
+        return step
+
+    def test_find_wheel(self):
+        step = self.make_step()
+        self.assertIsNone(step.find_wheel("abcd"))
+        step.wheel_cache = os.path.join(self.directory, "wheels")
+        self.assertIsNone(step.find_wheel("abcd"))
+        self.assertIsNone(step.find_wheel(None))
+        wheel = os.path.join(self.directory, "package-1-py2-none-any.whl")
+        with open(wheel, "wb") as fd:
+            fd.write("wheel")
+        path = setup.WheelCache(step.wheel_cache).store("abcd", wheel)
+        self.assertEqual(step.find_wheel("abcd"), path)
+
+    def test_fails_without_wheel_package(self):
+        setup.has_wheel_package.result = False
+        self.assertRaises(DistutilsError, self.make_step().check_wheel_package)
+
+    def test_passes_with_wheel_package(self):
+        setup.has_wheel_package.result = True
+        self.make_step().check_wheel_package()
+
+if __name__ == "__main__":
+    unittest.main()